@@ -0,0 +1,121 @@
+import json
+import logging
+import os
+
+from threading import Lock
+
+import constants
+
+from inspection_cache import InspectionCache
+from layer_cache import chain_ids
+
+log = logging.getLogger("base_image_index")
+
+
+class BaseImageIndex(object):
+    """
+    Index of the layer chains of named images, kept at host and updated
+    with the images tagged since last update. It is a trie of layer chains
+    stored by chain ID: as a chain ID stands for a layer and all layers
+    below it, the nodes on the path of an image are the chain IDs of its
+    layers and only nodes of named images need to be stored. The nearest
+    named ancestor of an image is its longest prefix found in the index.
+    """
+    def __init__(self, cache=None, path=constants.BASE_IMAGE_INDEX):
+        self.cache = cache or InspectionCache()
+        self.path = path
+        # chain ID of top layer -> {image id: names}
+        self.nodes = {}
+        # image id -> names it was indexed with
+        self.indexed = {}
+        # an index may be shared by concurrent test runs
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        """
+        Load index saved by earlier runs
+        """
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as fin:
+                saved = json.load(fin)
+        except ValueError:
+            log.warning("Ignoring unreadable base image index %s", self.path)
+            return
+        self.nodes = saved["nodes"]
+        self.indexed = saved["indexed"]
+
+    def save(self):
+        """
+        Save index at host
+        """
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(self.path + ".tmp", "wb") as fout:
+            json.dump({"nodes": self.nodes, "indexed": self.indexed}, fout)
+        os.rename(self.path + ".tmp", self.path)
+
+    def chain_of(self, inspection):
+        """
+        Chain IDs of layers of given image inspection from base layer up,
+        empty for docker versions not reporting the RootFS of images
+        """
+        return chain_ids((inspection.get("RootFS") or {}).get("Layers")
+                         or [])
+
+    def image_id(self, inspection):
+        return inspection.get("Id", inspection.get("id", ""))
+
+    def add(self, inspection, names):
+        """
+        Index image of given inspection under given names
+        """
+        chain = self.chain_of(inspection)
+        image_id = self.image_id(inspection)
+        self.indexed[image_id] = sorted(names)
+        if chain:
+            self.nodes.setdefault(chain[-1], {})[image_id] = sorted(names)
+
+    def update(self):
+        """
+        Index local images tagged since last update, only they are
+        inspected
+        """
+        images = dict((image["Id"], sorted(image["RepoTags"]))
+                      for image in self.cache.docker.state.images()["id"]
+                      .itervalues() if image["RepoTags"])
+        with self.lock:
+            new = [image_id for image_id, names in images.iteritems()
+                   if self.indexed.get(image_id) != names]
+            if not new:
+                return
+            for inspection in self.cache.inspect_images(new):
+                self.add(inspection, images[self.image_id(inspection)])
+            log.debug("Indexed %d named images.", len(new))
+            self.save()
+
+    def lookup(self, inspection):
+        """
+        Nearest named ancestor of image of given inspection, the image
+        itself excluded, None if no ancestor is indexed
+        """
+        chain = self.chain_of(inspection)
+        image_id = self.image_id(inspection)
+        for n in range(len(chain) - 1, -1, -1):
+            node = self.nodes.get(chain[n])
+            if not node:
+                continue
+            candidates = sorted((ancestor_id, names)
+                                for ancestor_id, names in node.items()
+                                if ancestor_id != image_id)
+            if candidates:
+                ancestor_id, names = candidates[0]
+                return {"Name": names[0],
+                        "Names": names,
+                        "Id": ancestor_id,
+                        "Number_of_layers": n + 1,
+                        }
+        return None
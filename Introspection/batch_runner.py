@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import re
+import sys
+
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore, Lock
+
+import constants
+
+from base_image_index import BaseImageIndex
+from dockerutils import get_docker_utils
+from executor import get_executor
+from inspection_cache import InspectionCache
+from layer_cache import LayerCache
+from test_runner import TestRunner
+from utils import ImageUtils
+
+log = logging.getLogger("batch_runner")
+
+
+def read_image_list(path):
+    """
+    Read image names, one per line, from file at given path or from stdin
+    if path is "-". Blank lines and lines starting with # are skipped.
+    """
+    if path == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(path) as fin:
+            lines = fin.readlines()
+    images = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#") and line not in images:
+            images.append(line)
+    return images
+
+
+class BatchRunner(object):
+    """
+    Introspect many images concurrently, each image by a TestRunner on a
+    bounded pool of workers. Names resolving to the same image id are
+    introspected once, in one output dir per image. Pulls, test containers
+    and analysis at host are limited separately, so that a worker waiting
+    on a pull does not hold back workers ready to run containers.
+    """
+    def __init__(self, images, output_dir, workers=constants.BATCH_WORKERS,
+                 pull_limit=constants.BATCH_PULL_LIMIT,
+                 container_limit=constants.BATCH_CONTAINER_LIMIT,
+                 analysis_limit=constants.BATCH_ANALYSIS_LIMIT, **kwargs):
+        self.images = images
+        self.output_dir = output_dir
+        self.workers = workers
+        self.pull_slots = BoundedSemaphore(pull_limit)
+        self.kwargs = kwargs
+        self.kwargs.update(
+            container_slots=BoundedSemaphore(container_limit),
+            analysis_slots=BoundedSemaphore(analysis_limit),
+            layer_cache=LayerCache(),
+            base_images=BaseImageIndex(),
+        )
+        self.docker = get_docker_utils()
+        self.imageutils = ImageUtils()
+        self.inspections = InspectionCache()
+        self.lock = Lock()
+        # image id -> names and output dir of its run
+        self.runs = {}
+
+    def image_id_of(self, image):
+        """
+        Id of given image, pulled first if it is not present locally
+        """
+        if not self.imageutils.is_image_present_locally(image):
+            with self.pull_slots:
+                log.info("Pulling image %s.", image)
+                self.imageutils.pull_image_from_registry(image)
+        return self.inspections.inspect_image(image)["Id"]
+
+    def output_dir_of(self, image, image_id):
+        """
+        Output dir of image named after its first name and short id
+        """
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", image)
+        short_id = image_id.split(":", 1)[-1][:12]
+        return os.path.join(self.output_dir, "%s-%s" % (name, short_id))
+
+    def claim(self, image, image_id):
+        """
+        Record image name under its image id, returns the run of the image
+        id if it is new and None if another name already claimed it
+        """
+        with self.lock:
+            if image_id in self.runs:
+                self.runs[image_id]["names"].append(image)
+                return None
+            run = {"names": [image],
+                   "output_dir": self.output_dir_of(image, image_id),
+                   "error": None}
+            self.runs[image_id] = run
+            return run
+
+    def introspect(self, image):
+        """
+        Introspect given image unless a name of the same image id is
+        introspected already. Errors are recorded, not raised, so that one
+        image does not stop the batch. Commands of the introspection run in
+        an executor group of the image id, a failed test cancels only
+        commands of its own image.
+        """
+        try:
+            image_id = self.image_id_of(image)
+        except Exception as e:
+            log.error("Can not resolve image %s: %s", image, e)
+            return {"image": image, "error": str(e)}
+        run = self.claim(image, image_id)
+        if run is None:
+            log.info("Image %s is introspected under another name.", image)
+            return {"image": image, "image_id": image_id}
+        try:
+            # results of a previous batch in the same output dir are
+            # overwritten
+            if not os.path.isdir(run["output_dir"]):
+                os.makedirs(run["output_dir"])
+            with get_executor().group(image_id):
+                TestRunner(image=image, output_dir=run["output_dir"],
+                           **self.kwargs).run()
+        except Exception as e:
+            log.exception("Introspection of image %s failed.", image)
+            run["error"] = str(e)
+        return {"image": image, "image_id": image_id}
+
+    def summary(self):
+        """
+        Runs of the batch by image id, with all names of each image
+        """
+        return dict((image_id, dict(run)) for image_id, run in
+                    self.runs.iteritems())
+
+    def run(self):
+        """
+        Introspect all images and write a summary of the batch in output
+        dir, returns the summary. An interrupted batch cancels the commands
+        of all images, the workers end as soon as their commands are
+        killed.
+        """
+        pool = ThreadPool(self.workers)
+        unresolved = []
+        try:
+            results = pool.imap_unordered(self.introspect, self.images)
+            while True:
+                # a blocking wait without timeout is not interrupted by
+                # SIGINT in Python 2
+                try:
+                    result = results.next(constants.BATCH_POLL_INTERVAL)
+                except TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+                if "error" in result:
+                    unresolved.append(result)
+        except BaseException:
+            log.error("Batch interrupted, cancelling all commands.")
+            get_executor().cancel()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        summary = {"images": self.summary(), "unresolved": unresolved}
+        with open(os.path.join(self.output_dir, constants.BATCH_SUMMARY),
+                  "wb") as fout:
+            json.dump(summary, fout, indent=4)
+        log.info("Introspected %d images of %d names, %d not resolved.",
+                 len(self.runs), len(self.images), len(unresolved))
+        return summary
@@ -3,7 +3,12 @@ from os import path
 
 PACKAGE_TESTS = "package_tests.py"
 RPM_VERIFY_TESTS = "rpm_verify_tests.py"
+RPMDB_UTILS = "rpmdb_utils.py"
 ELF_TESTS = "elf_tests.py"
+EXECUTOR = "executor.py"
+PROBE_AGENT = "probe_agent.py"
+SCHEDULER = "scheduler.py"
+TEST_REGISTRY = "test_registry.py"
 SHELL_SCRIPT = "introspection_script.sh"
 LOGFILE_PATH = "/var/tmp/introspection.log"
 
@@ -11,7 +16,12 @@ TEST_SCRIPTS_NAME = [
     SHELL_SCRIPT,
     PACKAGE_TESTS,
     RPM_VERIFY_TESTS,
-#     ELF_TESTS,
+    RPMDB_UTILS,
+    ELF_TESTS,
+    EXECUTOR,
+    PROBE_AGENT,
+    SCHEDULER,
+    TEST_REGISTRY,
 ]
 
 if path.exists(path.join("usr/bin", SHELL_SCRIPT)):
@@ -25,7 +35,12 @@ TEST_SCRIPTS_PATH = [
     SHELL_SCRIPT_PATH,
     path.join(path.dirname(__file__), PACKAGE_TESTS),
     path.join(path.dirname(__file__), RPM_VERIFY_TESTS),
-#     path.join(path.dirname(__file__), ELF_TESTS),
+    path.join(path.dirname(__file__), RPMDB_UTILS),
+    path.join(path.dirname(__file__), ELF_TESTS),
+    path.join(path.dirname(__file__), EXECUTOR),
+    path.join(path.dirname(__file__), PROBE_AGENT),
+    path.join(path.dirname(__file__), SCHEDULER),
+    path.join(path.dirname(__file__), TEST_REGISTRY),
 ]
 
 
@@ -37,6 +52,74 @@ CERT_TEMP_PARENT_DIR = "/tmp/"
 
 REPORT_DIR = "/var/tmp/introspection_report/"
 
+# caches kept at host across test runs, probes find them in shared volume
+CACHE_DIR = "/var/tmp/introspection_cache/"
+ELF_PARSE_CACHE = "elf_parse_cache.json"
+PROBE_CACHE_FILES = [
+    ELF_PARSE_CACHE,
+]
+# entries of a probe cache, by path, above which the least recently used
+# ones are dropped when caches of test runs are merged
+PROBE_CACHE_MAX_ENTRIES = 100000
+
+# probe results of introspected images by layer chain ID, reused by images
+# sharing their layers and used to verify images deriving from them
+# incrementally; the delta is handed to the probe in shared volume
+LAYER_CACHE_DIR = path.join(CACHE_DIR, "layers")
+LAYER_CACHE_MAX_BYTES = 512 * 1024 * 1024
+VERIFY_DELTA = "verify_delta.json"
+DOCKER_ROOT = "/var/lib/docker"
+
+# inspections of images by image id, kept across test runs
+INSPECTION_CACHE_DIR = path.join(CACHE_DIR, "inspections")
+INSPECTION_CACHE_MAX_ENTRIES = 2000
+
+# layer chains of named images, to find the base image of an image
+BASE_IMAGE_INDEX = path.join(CACHE_DIR, "base_images.json")
+
+# environment of probes run inside container
+VERIFY_WORKERS_ENV = "INTROSPECTION_VERIFY_WORKERS"
+VERIFY_MODE_ENV = "INTROSPECTION_VERIFY_MODE"
+VERIFY_DIGEST_PATHS_ENV = "INTROSPECTION_VERIFY_DIGEST_PATHS"
+VERIFY_MODES = ["rpm", "fast", "full"]
+VERIFY_OUTPUT_ENV = "INTROSPECTION_VERIFY_OUTPUT"
+
+# how to talk to docker daemon
+DOCKER_BACKENDS = ["cli", "api"]
+DOCKER_SOCKET = "/var/run/docker.sock"
+# seconds image and container listings are reused for presence checks
+DOCKER_STATE_TTL = 10
+
+# batch mode: concurrent introspections and separate limits of pulls,
+# test containers and analysis at host
+BATCH_WORKERS = 4
+BATCH_PULL_LIMIT = 2
+BATCH_CONTAINER_LIMIT = 2
+BATCH_ANALYSIS_LIMIT = 2
+BATCH_SUMMARY = "BatchSummary.json"
+# seconds between checks for an interrupt while a batch runs
+BATCH_POLL_INTERVAL = 1
+
+# warm containers kept idle per image id, probes of an image run again are
+# run in its container by docker exec; containers idle longer than the
+# timeout are removed, and the least recently used above the pool size
+CONTAINER_POOL_DIR = "/var/tmp/introspection_pool/"
+CONTAINER_POOL_SIZE = 8
+CONTAINER_POOL_IDLE_TIMEOUT = 6 * 60 * 60
+CONTAINER_POOL_PREFIX = "introspection_pool_"
+
+# seconds docker commands are given before they are killed: quick ones
+# like listing, inspecting or removing, pulls, image load and save, and
+# probes run in a container by docker run, docker exec or nsenter
+DOCKER_COMMAND_TIMEOUT = 5 * 60
+DOCKER_PULL_TIMEOUT = 30 * 60
+IMAGE_TRANSFER_TIMEOUT = 30 * 60
+CONTAINER_RUN_TIMEOUT = 2 * 60 * 60
+
+# image archives loaded in a single pass, compressed or not
+IMAGE_ARCHIVE_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2",
+                            ".tar.xz")
+
 INVALID_IMAGE = 0
 LOCAL_IMAGE = 1
 REGISTRY_IMAGE = 2
@@ -47,3 +130,17 @@ FTP_GZFILE_IMAGE = 6
 GZFILE_IMAGE = 7
 
 PACKAGE_REPORT = "PackageTests.json"
+ADHOC_REPORT = "AdhocFiles.json"
+RPM_VERIFY_REPORT = "RPMVerifyTest.json"
+RPM_VERIFY_REPORT_LINES = "RPMVerifyTest.jsonl"
+ELF_REPORT = "ELFTests.json"
+# status and duration of test phases of a run
+PHASE_REPORT = "Phases.json"
+# reports written by the probes run inside container
+PROBE_REPORTS = [
+    PACKAGE_REPORT,
+    ADHOC_REPORT,
+    RPM_VERIFY_REPORT,
+    RPM_VERIFY_REPORT_LINES,
+    ELF_REPORT,
+]
@@ -0,0 +1,250 @@
+import fcntl
+import logging
+import os
+import time
+
+from shutil import copy, rmtree
+from threading import Lock
+
+import constants
+
+from dockerutils import get_docker_utils
+
+log = logging.getLogger("container_pool")
+
+# idle containers sleep in a loop, they are removed forcefully
+IDLE_ENTRYPOINT = "/bin/sh"
+IDLE_COMMAND = ["-c", "while :; do sleep 3600; done"]
+
+
+class ContainerPool(object):
+    """
+    Warm containers kept idle at host, one per image id, so that probes of
+    an image run again are run in its container by docker exec instead of
+    creating, relabeling and removing a container every time. Each
+    container has its own shared directory mounted, files of a test run are
+    copied in before and out after the probes. The pool is kept across
+    processes: every container has a lock file at host, locked while the
+    container is leased by a test run and touched when it is released.
+    Containers idle longer than idle_timeout are removed, and the least
+    recently used ones above max_containers.
+    """
+    def __init__(self, pool_dir=constants.CONTAINER_POOL_DIR,
+                 max_containers=constants.CONTAINER_POOL_SIZE,
+                 idle_timeout=constants.CONTAINER_POOL_IDLE_TIMEOUT):
+        self.docker = get_docker_utils()
+        self.pool_dir = pool_dir
+        self.max_containers = max_containers
+        self.idle_timeout = idle_timeout
+        self.counts = {"warm": 0, "started": 0, "busy": 0, "removed": 0}
+        # a pool may be shared by concurrent test runs
+        self.lock = Lock()
+
+    def key_of(self, image_id):
+        return image_id.split(":", 1)[-1]
+
+    def lock_path(self, key):
+        """
+        Path of lock file of container of given key, its mtime is the time
+        the container was last used
+        """
+        return os.path.join(self.pool_dir, "%s.lock" % key)
+
+    def shared_dir(self, key):
+        """
+        Directory at host mounted in container of given key
+        """
+        return os.path.join(self.pool_dir, key)
+
+    def container_name(self, key):
+        return "%s%s" % (constants.CONTAINER_POOL_PREFIX, key[:12])
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] += 1
+
+    def _try_lock(self, key):
+        """
+        Open and lock lock file of given key, created if there is none.
+        Returns None if it is locked by another test run.
+        """
+        path = self.lock_path(key)
+        lock_file = open(path, "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return None
+        # the container may have been removed before lock was taken
+        if not os.path.exists(path) or \
+                os.stat(path).st_ino != os.fstat(lock_file.fileno()).st_ino:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _keys(self):
+        """
+        Keys of pooled containers, least recently used first
+        """
+        if not os.path.isdir(self.pool_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.pool_dir):
+            if not name.endswith(".lock"):
+                continue
+            try:
+                used = os.stat(os.path.join(self.pool_dir, name)).st_mtime
+            except OSError:
+                continue
+            entries.append((used, name[:-len(".lock")]))
+        return [key for _, key in sorted(entries)]
+
+    def _start(self, image, image_id, key):
+        """
+        Start idle container of given image id with an empty shared
+        directory. It is run by id, a tag moved to another image since the
+        image was inspected must not start a container under this key.
+        """
+        name = self.container_name(key)
+        shared_dir = self.shared_dir(key)
+        # a container left by an interrupted run is replaced
+        self.docker.remove_container_forcefully(name)
+        rmtree(shared_dir, ignore_errors=True)
+        os.makedirs(shared_dir)
+        os.chmod(shared_dir, 0777)
+        volumes = "%s:%s:Z" % (shared_dir, constants.TEST_SCRIPTS_DIR_IN_CONT)
+        log.info("Starting warm container %s of image %s (%s).", name, image,
+                 image_id)
+        self.docker.start_container(
+            ["run", "-v", volumes, "--entrypoint", IDLE_ENTRYPOINT,
+             "--name", name, image_id] + IDLE_COMMAND)
+
+    def lease(self, image, image_id):
+        """
+        Lease warm container of given image id, started if there is none.
+        Returns None if it is leased by another test run.
+        """
+        if not os.path.isdir(self.pool_dir):
+            os.makedirs(self.pool_dir)
+        self.expire()
+        key = self.key_of(image_id)
+        lock_file = self._try_lock(key)
+        if lock_file is None:
+            self.count("busy")
+            return None
+        container = {"key": key,
+                     "name": self.container_name(key),
+                     "lock_file": lock_file}
+        try:
+            self.docker.state.invalidate_containers()
+            if self.docker.is_container_running(container["name"]):
+                log.debug("Reusing warm container %s.", container["name"])
+                self.count("warm")
+            else:
+                self._start(image, image_id, key)
+                self.count("started")
+        except Exception:
+            self._remove(key, lock_file)
+            raise
+        self.evict()
+        return container
+
+    def release(self, container):
+        """
+        Return leased container to pool, idle from now on
+        """
+        os.utime(self.lock_path(container["key"]), None)
+        container["lock_file"].close()
+
+    def _sync(self, source, destination):
+        """
+        Replace files of destination directory by files of source
+        directory
+        """
+        for name in os.listdir(destination):
+            path = os.path.join(destination, name)
+            if os.path.isdir(path):
+                rmtree(path, ignore_errors=True)
+            else:
+                os.unlink(path)
+        for name in os.listdir(source):
+            path = os.path.join(source, name)
+            if os.path.isfile(path):
+                copy(path, destination)
+
+    def run(self, container, test_dir, cmd, env=None, user=None):
+        """
+        Run cmd in leased container by docker exec, with files of test dir
+        at host in its shared directory. Files left there are copied back
+        in test dir.
+        """
+        shared_dir = self.shared_dir(container["key"])
+        self._sync(test_dir, shared_dir)
+        try:
+            self.docker.exec_in_container(container["name"], cmd, env, user)
+        finally:
+            self._sync(shared_dir, test_dir)
+
+    def _remove(self, key, lock_file=None):
+        """
+        Remove container of given key and its shared directory, unless it
+        is leased by another test run
+        """
+        if lock_file is None:
+            lock_file = self._try_lock(key)
+            if lock_file is None:
+                return False
+        try:
+            name = self.container_name(key)
+            log.debug("Removing warm container %s.", name)
+            self.docker.remove_container_forcefully(name)
+            rmtree(self.shared_dir(key), ignore_errors=True)
+            os.unlink(self.lock_path(key))
+        finally:
+            lock_file.close()
+        self.count("removed")
+        return True
+
+    def expire(self):
+        """
+        Remove containers idle longer than idle timeout
+        """
+        now = time.time()
+        for key in self._keys():
+            try:
+                used = os.stat(self.lock_path(key)).st_mtime
+            except OSError:
+                continue
+            if now - used > self.idle_timeout:
+                self._remove(key)
+
+    def evict(self):
+        """
+        Remove least recently used idle containers above max containers
+        """
+        keys = self._keys()
+        excess = len(keys) - self.max_containers
+        for key in keys:
+            if excess <= 0:
+                break
+            if self._remove(key):
+                excess -= 1
+
+    def drain(self):
+        """
+        Remove all idle containers of pool, returns number of those left
+        as they are leased
+        """
+        left = 0
+        for key in self._keys():
+            if not self._remove(key):
+                left += 1
+        return left
+
+    def stats(self):
+        """
+        Counts of containers reused, started, removed and found busy by
+        this process
+        """
+        with self.lock:
+            return dict(self.counts)
@@ -1,18 +1,179 @@
+import httplib
 import json
 import logging
 import os
 import re
-import tarfile
-import tempfile
+import socket
+import struct
+import sys
+import time
 
-from shutil import rmtree
-from subprocess import Popen, PIPE
+from Queue import Queue, Empty, Full
+from threading import Lock
+from urllib import quote, urlencode
 from urllib2 import HTTPError
 
+import constants
 import introexceptions
 
+from executor import CommandTimeout, get_executor
+from image_archive import ImageArchive
+
 log = logging.getLogger("dockerutils")
 
+# idle keep-alive connections kept to the docker daemon
+DOCKER_API_POOL_SIZE = 4
+# length of image and container ids as docker prints them truncated
+SHORT_ID_LENGTH = 12
+DEFAULT_REGISTRY = "docker.io/"
+
+
+class DockerState(object):
+
+    """
+    Local images and containers, listed once and indexed by id, name and
+    tag. Listings are refreshed after ttl seconds or when invalidated by
+    a call changing them.
+    """
+
+    def __init__(self, docker, ttl=constants.DOCKER_STATE_TTL):
+        self.docker = docker
+        self.ttl = ttl
+        self._images = None
+        self._images_time = 0
+        self._containers = None
+        self._containers_time = 0
+        # listings are shared by concurrent tests
+        self.lock = Lock()
+
+    def _stale(self, listed_at):
+        return time.time() - listed_at > self.ttl
+
+    def invalidate_images(self):
+        """
+        Drop image listing, it is listed again on next lookup
+        """
+        self._images = None
+
+    def invalidate_containers(self):
+        """
+        Drop container listing, it is listed again on next lookup
+        """
+        self._containers = None
+
+    def _index_id(self, index, image_or_container_id, value):
+        """
+        Index value by full id, id without digest algorithm and short id
+        """
+        long_id = image_or_container_id.split(":", 1)[-1]
+        index[image_or_container_id] = value
+        index[long_id] = value
+        index[long_id[:SHORT_ID_LENGTH]] = value
+
+    def images(self):
+        """
+        Index of local images, listed again if stale
+        """
+        with self.lock:
+            images = self._images
+            if images is None or self._stale(self._images_time):
+                images = self._list_images()
+                self._images = images
+                self._images_time = time.time()
+        return images
+
+    def _list_images(self):
+        """
+        Index local images by id, name:tag or name@digest, and name
+        """
+        by_id, by_tag, by_name = {}, {}, {}
+        for image in self.docker.list_image_records():
+            self._index_id(by_id, image["Id"], image)
+            for repo_digest in image.get("RepoDigests") or []:
+                by_tag[repo_digest] = image
+                if repo_digest.startswith(DEFAULT_REGISTRY):
+                    by_tag[repo_digest[len(DEFAULT_REGISTRY):]] = image
+            for repo_tag in image["RepoTags"]:
+                name = repo_tag.rsplit(":", 1)[0]
+                names = [repo_tag, name]
+                # docker on some distributions lists images pulled
+                # from Docker Hub with registry prefix
+                if repo_tag.startswith(DEFAULT_REGISTRY):
+                    names.append(repo_tag[len(DEFAULT_REGISTRY):])
+                    names.append(name[len(DEFAULT_REGISTRY):])
+                for n in names[0::2]:
+                    by_tag[n] = image
+                for n in names[1::2]:
+                    by_name.setdefault(n, set()).add(image["Id"])
+        return {"id": by_id, "tag": by_tag, "name": by_name}
+
+    def containers(self):
+        """
+        Index of containers, listed again if stale
+        """
+        with self.lock:
+            containers = self._containers
+            if containers is None or self._stale(self._containers_time):
+                containers = self._list_containers()
+                self._containers = containers
+                self._containers_time = time.time()
+        return containers
+
+    def _list_containers(self):
+        """
+        Index containers by id and name
+        """
+        by_id, by_name = {}, {}
+        for container in self.docker.list_container_records():
+            self._index_id(by_id, container["Id"], container)
+            for name in container["Names"]:
+                by_name[name] = container
+        return {"id": by_id, "name": by_name}
+
+    def find_image(self, image):
+        """
+        Image record of given image id, name:tag or name@digest, None if
+        not present. A name without tag is looked up with tag latest, as
+        docker does, never with another tag.
+        """
+        images = self.images()
+        record = images["id"].get(image) or images["tag"].get(image)
+        if record is None and "@" not in image and \
+                ":" not in image.rsplit("/", 1)[-1]:
+            record = images["tag"].get("%s:latest" % image)
+        return record
+
+    def image_ids(self):
+        """
+        Ids of all local images
+        """
+        return list(set(image["Id"]
+                        for image in self.images()["id"].values()))
+
+    def image_ids_of_repository(self, name):
+        """
+        Ids of images of given name, or of given name:tag
+        """
+        images = self.images()
+        if name in images["tag"]:
+            return [images["tag"][name]["Id"]]
+        return list(images["name"].get(name, []))
+
+    def find_container(self, container):
+        """
+        Container record of given container id or name, None if there is
+        no such container
+        """
+        containers = self.containers()
+        found = containers["name"].get(container) or \
+            containers["id"].get(container)
+        if found is None and len(container) < SHORT_ID_LENGTH:
+            # docker also accepts any unique id prefix
+            for container_id, record in containers["id"].iteritems():
+                if container_id.startswith(container):
+                    return record
+        return found
+
 
 class DockerUtils(object):
 
@@ -22,15 +183,18 @@ class DockerUtils(object):
 
     def __init__(self):
         self.docker_bin = "/usr/bin/docker"
+        self.state = DockerState(self)
+        self._docker_version = None
+        # inspections and histories of images by image id, which names
+        # immutable image content
+        self.image_inspections = {}
+        self.image_histories = {}
 
-    def command(self, cmd):
+    def command(self, cmd, timeout=constants.DOCKER_COMMAND_TIMEOUT):
         """
-        Run command
+        Run command, killed after timeout seconds
         """
-        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        p.wait()
-        out, error = p.communicate()
-        return (out, error)
+        return get_executor().run(cmd, timeout=timeout)
 
     def is_docker_running(self):
         """
@@ -42,31 +206,83 @@ class DockerUtils(object):
 
     def docker_version(self):
         """
-        Returns Docker version
+        Returns Docker version, asked once per process
+        """
+        if self._docker_version is None:
+            self._docker_version = self.query_docker_version()
+        return self._docker_version
+
+    def query_docker_version(self):
+        """
+        Ask Docker version
         """
         cmd = [self.docker_bin, "--version"]
         return self.command(cmd)[0]
 
+    def list_image_records(self):
+        """
+        List local images as records with Id, RepoTags and RepoDigests
+        """
+        cmd = [self.docker_bin, "images", "-a", "--digests", "--no-trunc",
+               "--format", "{{.ID}}\t{{.Repository}}\t{{.Tag}}\t{{.Digest}}"]
+        out, error = self.command(cmd)
+        if error:
+            log.warning(error)
+        images = {}
+        for line in out.splitlines():
+            fields = line.split("\t")
+            if len(fields) != 4:
+                continue
+            image_id, repository, tag, digest = fields
+            image = images.setdefault(image_id, {"Id": image_id,
+                                                 "RepoTags": [],
+                                                 "RepoDigests": []})
+            if repository == "<none>":
+                continue
+            repo_tag = "%s:%s" % (repository, tag)
+            if tag != "<none>" and repo_tag not in image["RepoTags"]:
+                image["RepoTags"].append(repo_tag)
+            repo_digest = "%s@%s" % (repository, digest)
+            if digest != "<none>" and repo_digest not in image["RepoDigests"]:
+                image["RepoDigests"].append(repo_digest)
+        return images.values()
+
+    def list_container_records(self):
+        """
+        List all containers as records with Id, Names and Running
+        """
+        cmd = [self.docker_bin, "ps", "-a", "--no-trunc", "--format",
+               "{{.ID}}\t{{.Names}}\t{{.Status}}"]
+        out, error = self.command(cmd)
+        if error:
+            log.warning(error)
+        containers = []
+        for line in out.splitlines():
+            fields = line.split("\t")
+            if len(fields) != 3:
+                continue
+            containers.append({"Id": fields[0],
+                               "Names": fields[1].split(","),
+                               "Running": fields[2].startswith("Up"),
+                               })
+        return containers
+
     def is_image_present(self, image):
         """
         Check if image is present locally
         """
-        cmd = [self.docker_bin, "images"]
-        out, _ = self.command(cmd)
-        # TODO: provision for checking presence of image Id, now it checks
-        # using image name
-        if out.find(self.name_without_tag(image)) == -1:
-            return False
-        return True
+        return self.state.find_image(image) is not None
 
     def pull_image(self, image):
         """
         Pull an image from registry
         """
         cmd = [self.docker_bin, "pull", image]
+        self.state.invalidate_images()
         try:
-            (out, error) = self.command(cmd)
-        except HTTPError:
+            (out, error) = self.command(
+                cmd, timeout=constants.DOCKER_PULL_TIMEOUT)
+        except (HTTPError, CommandTimeout):
             raise introexceptions.ImagePullError(image)
         else:
             if not self.is_image_present(image) and error != "":
@@ -81,18 +297,83 @@ class DockerUtils(object):
         """
         cmd = [self.docker_bin, "tag", image, tag]
         self.command(cmd)
+        self.state.invalidate_images()
+
+    def remember_inspection(self, inspection):
+        """
+        Keep image inspection by image id
+        """
+        image_id = inspection.get("Id", inspection.get("id"))
+        if image_id:
+            self.image_inspections[image_id] = inspection
+        return inspection
 
     def inspect_image(self, image):
+        """
+        Inspection of given image, inspected once per image id
+        """
+        if image in self.image_inspections:
+            return self.image_inspections[image]
+        return self.remember_inspection(self.query_image_inspection(image))
+
+    def inspect_images(self, image_ids):
+        """
+        Inspections of given image ids, those not inspected yet are
+        inspected at once. Ids of images not present are left out.
+        """
+        missing = [image_id for image_id in image_ids
+                   if image_id not in self.image_inspections]
+        if missing:
+            for inspection in self.query_image_inspections(missing):
+                self.remember_inspection(inspection)
+        return [self.image_inspections[image_id] for image_id in image_ids
+                if image_id in self.image_inspections]
+
+    def image_history(self, image_id):
+        """
+        Ids of the layers of given image id from top layer down, as far
+        as they are present locally, asked once per image id
+        """
+        if image_id not in self.image_histories:
+            self.image_histories[image_id] = self.query_image_history(
+                image_id)
+        return self.image_histories[image_id]
+
+    def query_image_inspection(self, image):
         """
         Run inspect command on image and return output
         """
         cmd = [self.docker_bin, "inspect", image]
         return json.loads(self.command(cmd)[0])[0]
 
+    def query_image_inspections(self, images):
+        """
+        Run one inspect command on all given images and return the
+        inspections of those present
+        """
+        cmd = [self.docker_bin, "inspect", "--type", "image"] + images
+        out, error = self.command(cmd)
+        if error:
+            log.debug(error)
+        return json.loads(out) if out.strip() else []
+
+    def query_image_history(self, image):
+        """
+        Run history command on image and return the ids of its layers,
+        layers pulled from a registry have no id locally
+        """
+        cmd = [self.docker_bin, "history", "--no-trunc", "-q", image]
+        out, error = self.command(cmd)
+        if error:
+            log.debug(error)
+        return [line.strip() for line in out.splitlines()
+                if line.strip() and line.strip() != "<missing>"]
+
     def _remove_image(self, cmd):
         """
         Remove given image
         """
+        self.state.invalidate_images()
         try:
             self.command(cmd)
         except Exception:
@@ -123,9 +404,7 @@ class DockerUtils(object):
         """
         Check if container is present
         """
-        cmd = [self.docker_bin, "ps", "-a"]
-        out, error = self.command(cmd)
-        if container in out:
+        if self.state.find_container(container):
             log.debug("Container: %s is present", container)
             return True
         else:
@@ -137,20 +416,52 @@ class DockerUtils(object):
         Create container
         """
         params.insert(0, self.docker_bin)
+        _, error = self.command(params,
+                                timeout=constants.CONTAINER_RUN_TIMEOUT)
+        self.state.invalidate_containers()
+        if error:
+            msg = "Command used: %s\n" % params
+            msg += "Error:%s" % error
+            raise introexceptions.CannotCreateContainer(msg)
+
+    def start_container(self, params):
+        """
+        Create container and leave it running in background, params are
+        those of `docker run`
+        """
+        # assumes params start with "run"
+        params = [self.docker_bin, params[0], "-d"] + params[1:]
         _, error = self.command(params)
+        self.state.invalidate_containers()
         if error:
             msg = "Command used: %s\n" % params
             msg += "Error:%s" % error
             raise introexceptions.CannotCreateContainer(msg)
 
+    def exec_in_container(self, container, cmd, env=None, user=None):
+        """
+        Run cmd in running container and wait for it to finish
+        """
+        params = [self.docker_bin, "exec"]
+        if user:
+            params.extend(["--user", user])
+        for key, value in sorted((env or {}).items()):
+            params.extend(["--env", "%s=%s" % (key, value)])
+        params.append(container)
+        params.extend(cmd)
+        _, error = self.command(params,
+                                timeout=constants.CONTAINER_RUN_TIMEOUT)
+        if error:
+            msg = "Command used: %s\n" % params
+            msg += "Error:%s" % error
+            raise introexceptions.CannotExecInContainer(msg)
+
     def is_container_running(self, container):
         """
         Check if container is running
         """
-        cmd = [self.docker_bin, "ps"]
-        if " %s" % container in self.command(cmd)[0]:
-            return True
-        return False
+        found = self.state.find_container(container)
+        return bool(found and found["Running"])
 
     def _remove_container(self, cmd):
         """
@@ -165,6 +476,7 @@ class DockerUtils(object):
             log.warning(msg)
             return False
         else:
+            self.state.invalidate_containers()
             if out[:-1] == cmd[-1] or not self.is_container_present(cmd[-1]):
                 log.debug("Container: %s is removed.", cmd[-1])
                 return True
@@ -209,7 +521,7 @@ class DockerUtils(object):
         """
         Run nsenter command
         """
-        self.command(nsenter_cmd)
+        self.command(nsenter_cmd, timeout=constants.CONTAINER_RUN_TIMEOUT)
 
     def pid_of_container(self, container):
         """
@@ -291,83 +603,86 @@ class DockerUtils(object):
                 "tag": tag,
                 }
 
+    def load_image_stream(self, stream):
+        """
+        Load an image from tar stream read from given file object
+        """
+        cmd = [self.docker_bin, "load"]
+        _, error = get_executor().run(
+            cmd, timeout=constants.IMAGE_TRANSFER_TIMEOUT, stdin=stream)
+        if error:
+            log.debug(error)
+            raise Exception(error)
+
     def load_image_from_tar(self, tar_path, tmpdir=None):
         """
-        Load an image from tarfile
+        Load an image from tarfile, which may be compressed with gzip,
+        bzip2 or xz. Archive is read once, metadata is parsed while it is
+        loaded.
         returns the imported image name
         """
-        cmd = [self.docker_bin, "load", "-i", tar_path]
-        log.debug("Loading image from tar: %s", cmd)
+        log.debug("Loading image from tar: %s", tar_path)
+        archive = ImageArchive(tar_path)
+        self.state.invalidate_images()
         try:
-            out, error = self.command(cmd)
-            if error:
-                log.debug(error)
-                raise Exception(error)
+            metadata = archive.ingest(self.load_image_stream)
             log.info("Image is loaded from tarpath.")
+        except introexceptions.InvalidTarFileImage:
+            raise
         except Exception as e:
             msg = "tar/gz file: %s \n %s" % (tar_path, e)
             raise introexceptions.ImageLoadErrorFromTarfile(msg)
-        else:
-            return self.find_image_name_from_tar(tar_path, tmpdir)
+        log.debug("Layer digests of loaded image: %s",
+                  metadata["layer_digests"])
+        return archive.repositories_of_metadata(metadata)
 
-    def extract_tarpath(self, tarpath, destpath):
+    def save_image_stream(self, image, consume):
         """
-        Extract the tar path
+        Stream image archive, as `docker save` writes it, into consume
+        called with a file object to read it from. Returns what consume
+        returns.
         """
-        try:
-            tar = tarfile.open(tarpath)
-            tar.extractall(path=destpath)
-        except tarfile.TarError:
-            msg = "Can not open the tar/gz file: %s" % tarpath
-            log.error(msg)
-            raise introexceptions.ImageLoadErrorFromTarfile(msg)
+        cmd = [self.docker_bin, "save", image]
+        failed = []
+
+        def read(stream):
+            try:
+                return consume(stream)
+            except Exception:
+                # an unreadable stream is reported by the error of docker
+                failed.append(sys.exc_info())
+
+        result, error = get_executor().read_stdout(
+            cmd, read, timeout=constants.IMAGE_TRANSFER_TIMEOUT)
+        if error:
+            msg = "Image: %s \n %s" % (image, error)
+            raise introexceptions.ImageNotPresent(msg)
+        if failed:
+            error_type, error, traceback = failed[0]
+            raise error_type, error, traceback
+        return result
 
     def find_image_name_from_tar(self, tar_path, tmpdir=None):
         """
         Find image name given tar formatted image
         Returns: Image repository data as found from tarfile
-
-
         """
         # TODO: Check for scenario in which multiple keys are present
         # in repository metadat dict
-        if tmpdir:
-            temp_dir = tempfile.mkdtemp(dir=tmpdir)
-        else:
-            temp_dir = tempfile.mkdtemp()
-
-        log.debug("Extracting tarfile in %s", temp_dir)
-
-        try:
-            self.extract_tarpath(tar_path, temp_dir)
-            repositories = os.path.join(temp_dir, "repositories")
-            with open(repositories) as fin:
-                metadata = json.load(fin)
-            return metadata
-        except:
-            msg = "tar/gz file: %s" % tar_path
-            raise introexceptions.InvalidTarFileImage(msg)
-        finally:
-            # remove the temp dir created as tempfile does not remove it
-            rmtree(temp_dir, ignore_errors=True)
+        log.debug("Reading image metadata from tarfile %s", tar_path)
+        return ImageArchive(tar_path).repositories()
 
     def get_all_image_long_ids(self):
         """
         This finds the all the container images long IDs
         """
-        cmd = [self.docker_bin, "images", "-a", "-q", "--no-trunc"]
         try:
-            out, error = self.command(cmd)
-            if error:
-                log.warning(error)
-                raise Exception(error)
+            return self.state.image_ids()
         except Exception as e:
             msg = "Could not find any images on system command failed."
             log.warning(msg)
             log.warning(e)
             return []
-        else:
-            return list(set(out.strip().split()))
 
     def get_all_images_ids_for_repository(self, repo_name):
         """
@@ -375,23 +690,520 @@ class DockerUtils(object):
         """
         # Remove the latest tag if present
         if repo_name.endswith(":latest"):
-            repo_name = repo_name[:repo_name.find("latest")]
+            repo_name = repo_name[:-len(":latest")]
 
         log.debug("Finding all the tags ids for repository: %s", repo_name)
-        cmd = [self.docker_bin, "images", "--quiet",  "--no-trunc", repo_name]
-        ids = []
-        log.debug(str(cmd))
         try:
-            out, error = self.command(cmd)
+            return self.state.image_ids_of_repository(repo_name)
         except Exception as e:
             msg = "Could not get the repository tags and their ids"
             log.warning(msg)
             log.warning(str(e))
-            return ids
+            return []
+
+
+def demultiplex(data):
+    """
+    Payload of output of a container without tty, sent by docker in
+    frames of an 8 byte header, naming the stream and the payload size,
+    followed by the payload. Output of a container with tty is sent as it
+    is.
+    """
+    payload = []
+    offset = 0
+    while offset < len(data):
+        header = data[offset:offset + 8]
+        if len(header) < 8 or header[0] not in "\x00\x01\x02" or \
+                header[1:4] != "\x00\x00\x00":
+            return data
+        size = struct.unpack(">I", header[4:])[0]
+        payload.append(data[offset + 8:offset + 8 + size])
+        offset += 8 + size
+    return "".join(payload)
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    """
+    HTTP connection over a unix socket
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, "localhost")
+        self.socket_path = socket_path
+        self.socket_timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.socket_timeout is not None:
+            sock.settimeout(self.socket_timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+    def set_timeout(self, timeout):
+        """
+        Seconds a request may wait for the daemon, None waits forever
+        """
+        self.socket_timeout = timeout
+        if self.sock is not None:
+            self.sock.settimeout(timeout)
+
+
+class DockerAPIClient(object):
+
+    """
+    Client of Docker Engine API over the unix socket, keeping a pool of
+    keep-alive connections
+    """
+
+    def __init__(self, socket_path=constants.DOCKER_SOCKET,
+                 pool_size=DOCKER_API_POOL_SIZE):
+        self.socket_path = socket_path
+        self.pool = Queue(maxsize=pool_size)
+
+    def _get_connection(self):
+        """
+        Take an idle connection from pool or open a new one
+        """
+        try:
+            return self.pool.get_nowait()
+        except Empty:
+            return UnixHTTPConnection(self.socket_path)
+
+    def _put_connection(self, conn):
+        """
+        Return connection to pool, close it if pool is full
+        """
+        try:
+            self.pool.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    def _url(self, path, params=None):
+        """
+        URL of API path with query parameters
+        """
+        if params:
+            return "%s?%s" % (path, urlencode(params))
+        return path
+
+    def request(self, method, path, params=None, body=None, headers=None,
+                timeout=constants.DOCKER_COMMAND_TIMEOUT):
+        """
+        Send request and return (status, response data). A connection
+        closed by daemon while idle in pool is retried once on a new one,
+        a daemon not answering within timeout seconds is not.
+        """
+        url = self._url(path, params)
+        headers = headers or {}
+        for attempt in (1, 2):
+            conn = self._get_connection()
+            conn.set_timeout(timeout)
+            try:
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except socket.timeout:
+                conn.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if attempt == 2 or hasattr(body, "read"):
+                    raise
+                continue
+            if response.will_close:
+                conn.close()
+            else:
+                self._put_connection(conn)
+            return response.status, data
+
+    def stream_request(self, method, path, stream, params=None,
+                       headers=None):
+        """
+        Send request with body read from stream in chunked transfer
+        encoding, so that body length need not be known, and return
+        (status, response data)
+        """
+        conn = self._get_connection()
+        conn.set_timeout(constants.IMAGE_TRANSFER_TIMEOUT)
+        try:
+            conn.putrequest(method, self._url(path, params))
+            for header, value in (headers or {}).iteritems():
+                conn.putheader(header, value)
+            conn.putheader("Transfer-Encoding", "chunked")
+            conn.endheaders()
+            for chunk in iter(lambda: stream.read(1 << 16), ""):
+                conn.send("%x\r\n%s\r\n" % (len(chunk), chunk))
+            conn.send("0\r\n\r\n")
+            response = conn.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
         else:
-            if error:
-                msg = "Could not get the repository tags and their ids"
-                log.warning(msg)
-                log.warning(error)
-                return ids
-            return list(set(out.strip().split("\n")))
+            self._put_connection(conn)
+        return response.status, data
+
+    def json_request(self, method, path, params=None, body=None,
+                     timeout=constants.DOCKER_COMMAND_TIMEOUT):
+        """
+        Send request with JSON body, return (status, decoded JSON response)
+        """
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        status, data = self.request(method, path, params, body, headers,
+                                    timeout)
+        try:
+            return status, json.loads(data) if data else None
+        except ValueError:
+            return status, data
+
+
+class DockerAPIUtils(DockerUtils):
+
+    """
+    Utility via Docker Engine API, same interface as DockerUtils.
+    Operations not covered by the API client (pull, nsenter) still use
+    Docker CLT.
+    """
+
+    def __init__(self, socket_path=constants.DOCKER_SOCKET):
+        DockerUtils.__init__(self)
+        self.api = DockerAPIClient(socket_path)
+
+    def _quote(self, name):
+        """
+        Quote image or container name for API path
+        """
+        return quote(name, safe="")
+
+    def is_docker_running(self):
+        """
+        Check if Docker service running
+        """
+        try:
+            status, _ = self.api.request("GET", "/_ping")
+        except (httplib.HTTPException, socket.error):
+            return False
+        return status == 200
+
+    def query_docker_version(self):
+        """
+        Ask Docker version, formatted as `docker --version` does
+        """
+        _, version = self.api.json_request("GET", "/version")
+        return "Docker version %s, build %s\n" % (version.get("Version", ""),
+                                                  version.get("GitCommit", ""))
+
+    def list_image_records(self):
+        """
+        List local images as records with Id, RepoTags and RepoDigests
+        """
+        _, images = self.api.json_request("GET", "/images/json", {"all": 1})
+        for image in images or []:
+            image["RepoTags"] = [repo_tag for repo_tag in
+                                 image.get("RepoTags") or []
+                                 if repo_tag != "<none>:<none>"]
+            image["RepoDigests"] = [repo_digest for repo_digest in
+                                    image.get("RepoDigests") or []
+                                    if repo_digest != "<none>@<none>"]
+        return images or []
+
+    def list_container_records(self):
+        """
+        List all containers as records with Id, Names and Running
+        """
+        _, containers = self.api.json_request("GET", "/containers/json",
+                                              {"all": 1})
+        for container in containers or []:
+            container["Names"] = [name.lstrip("/") for name in
+                                  container.get("Names") or []]
+            container["Running"] = container.get("State") == "running" or \
+                (container.get("Status") or "").startswith("Up")
+        return containers or []
+
+    def tag_image(self, image, tag):
+        """
+        Tag image
+        """
+        repo, _, tag_name = tag.rpartition(":")
+        if not repo or "/" in tag_name:
+            repo, tag_name = tag, "latest"
+        self.api.request("POST", "/images/%s/tag" % self._quote(image),
+                         {"repo": repo, "tag": tag_name})
+        self.state.invalidate_images()
+
+    def query_image_inspection(self, image):
+        """
+        Run inspect on image and return output
+        """
+        status, data = self.api.json_request(
+            "GET", "/images/%s/json" % self._quote(image))
+        if status == 404:
+            raise introexceptions.ImageNotPresent(image)
+        return data
+
+    def query_image_inspections(self, images):
+        """
+        Inspect all given images over pooled connections and return the
+        inspections of those present
+        """
+        inspections = []
+        for image in images:
+            status, data = self.api.json_request(
+                "GET", "/images/%s/json" % self._quote(image))
+            if status == 200:
+                inspections.append(data)
+        return inspections
+
+    def query_image_history(self, image):
+        """
+        Ids of the layers of given image, layers pulled from a registry
+        have no id locally
+        """
+        status, history = self.api.json_request(
+            "GET", "/images/%s/history" % self._quote(image))
+        if status != 200:
+            return []
+        return [layer["Id"] for layer in history or []
+                if layer.get("Id") and layer["Id"] != "<missing>"]
+
+    def _remove_image(self, cmd):
+        """
+        Remove given image, cmd is the equivalent docker rmi command
+        """
+        image = cmd[-1]
+        params = {"force": 1} if "-f" in cmd else None
+        try:
+            status, _ = self.api.request(
+                "DELETE", "/images/%s" % self._quote(image), params)
+        except (httplib.HTTPException, socket.error):
+            status = None
+        self.state.invalidate_images()
+        if status != 200:
+            log.warning("Can not remove image: %s", image)
+            return False
+        log.debug("Image: %s is removed.", image)
+        return True
+
+    def parse_run_params(self, params):
+        """
+        Translate `docker run` parameters into container create config
+        """
+        config = {"Env": [], "HostConfig": {"Binds": []}}
+        name = None
+        options = {"-v": "volume", "--volume": "volume",
+                   "-e": "env", "--env": "env",
+                   "-u": "user", "--user": "user",
+                   "--entrypoint": "entrypoint", "--name": "name"}
+        args = list(params)
+        if args and args[0] == "run":
+            args.pop(0)
+        while args and args[0] in options:
+            option, value = options[args.pop(0)], args.pop(0)
+            if option == "volume":
+                config["HostConfig"]["Binds"].append(value)
+            elif option == "env":
+                config["Env"].append(value)
+            elif option == "user":
+                config["User"] = value
+            elif option == "entrypoint":
+                config["Entrypoint"] = [value]
+            elif option == "name":
+                name = value
+        config["Image"] = args.pop(0)
+        if args:
+            config["Cmd"] = args
+        return name, config
+
+    def _create_and_start(self, params):
+        """
+        Create container with given `docker run` parameters and start it,
+        returns its quoted id
+        """
+        name, config = self.parse_run_params(params)
+        query = {"name": name} if name else None
+        status, created = self.api.json_request(
+            "POST", "/containers/create", query, config)
+        self.state.invalidate_containers()
+        if status != 201:
+            msg = "Params used: %s\n" % params
+            msg += "Error:%s" % created
+            raise introexceptions.CannotCreateContainer(msg)
+        container = self._quote(created["Id"])
+        status, error = self.api.request(
+            "POST", "/containers/%s/start" % container)
+        if status not in (204, 304):
+            msg = "Params used: %s\n" % params
+            msg += "Error:%s" % error
+            raise introexceptions.CannotCreateContainer(msg)
+        return container
+
+    def create_container(self, params):
+        """
+        Create container, run it and wait for it to finish,
+        like `docker run` with given parameters
+        """
+        container = self._create_and_start(params)
+        _, result = self.api.json_request(
+            "POST", "/containers/%s/wait" % container,
+            timeout=constants.CONTAINER_RUN_TIMEOUT)
+        status_code = (result or {}).get("StatusCode")
+        if status_code != 0:
+            msg = "Params used: %s\n" % params
+            msg += "Exit code:%s\n" % status_code
+            msg += "Logs:%s" % self.container_logs(container)
+            raise introexceptions.CannotCreateContainer(msg)
+
+    def container_logs(self, container):
+        """
+        Output of given container, stdout and stderr interleaved as
+        `docker logs` prints them
+        """
+        status, data = self.api.request(
+            "GET", "/containers/%s/logs" % container,
+            {"stdout": 1, "stderr": 1})
+        if status != 200:
+            return ""
+        return demultiplex(data)
+
+    def start_container(self, params):
+        """
+        Create container and leave it running in background, like
+        `docker run -d` with given parameters
+        """
+        self._create_and_start(params)
+
+    def exec_in_container(self, container, cmd, env=None, user=None):
+        """
+        Run cmd in running container and wait for it to finish, like
+        `docker exec`
+        """
+        config = {"Cmd": cmd,
+                  "Env": ["%s=%s" % (key, value)
+                          for key, value in sorted((env or {}).items())],
+                  "AttachStdout": True,
+                  "AttachStderr": True}
+        if user:
+            config["User"] = user
+        status, created = self.api.json_request(
+            "POST", "/containers/%s/exec" % self._quote(container),
+            body=config)
+        if status != 201:
+            msg = "Command used: %s\n" % cmd
+            msg += "Error:%s" % created
+            raise introexceptions.CannotExecInContainer(msg)
+        exec_id = self._quote(created["Id"])
+        # output is streamed until cmd exits
+        status, output = self.api.json_request(
+            "POST", "/exec/%s/start" % exec_id,
+            body={"Detach": False, "Tty": False},
+            timeout=constants.CONTAINER_RUN_TIMEOUT)
+        if status not in (200, 101):
+            msg = "Command used: %s\n" % cmd
+            msg += "Error:%s" % output
+            raise introexceptions.CannotExecInContainer(msg)
+        _, result = self.api.json_request("GET", "/exec/%s/json" % exec_id)
+        # no exit code means cmd was not run or is still running
+        exit_code = (result or {}).get("ExitCode")
+        if exit_code != 0:
+            msg = "Command used: %s\n" % cmd
+            msg += "Exit code:%s" % exit_code
+            raise introexceptions.CannotExecInContainer(msg)
+
+    def _remove_container(self, cmd):
+        """
+        Remove a container, cmd is the equivalent docker rm command
+        Returns True if container removal is successful,
+        else False.
+        """
+        container = cmd[-1]
+        params = {"force": 1} if "-f" in cmd else None
+        try:
+            status, _ = self.api.request(
+                "DELETE", "/containers/%s" % self._quote(container), params)
+        except (httplib.HTTPException, socket.error):
+            log.warning("Can not remove container.")
+            return False
+        self.state.invalidate_containers()
+        if status == 204 or not self.is_container_present(container):
+            log.debug("Container: %s is removed.", container)
+            return True
+        log.debug("Container: %s is not removed.", container)
+        return False
+
+    def inspect_container(self, container):
+        """
+        Run inspect on container
+        """
+        status, data = self.api.json_request(
+            "GET", "/containers/%s/json" % self._quote(container))
+        if status != 200:
+            return {}
+        return data
+
+    def load_image_stream(self, stream):
+        """
+        Load an image from tar stream read from given file object
+        """
+        status, error = self.api.stream_request(
+            "POST", "/images/load", stream,
+            headers={"Content-Type": "application/x-tar"})
+        if status != 200:
+            raise Exception(error)
+
+    def save_image_stream(self, image, consume):
+        """
+        Stream image archive from daemon into consume called with a file
+        object to read it from. Returns what consume returns.
+        """
+        conn = UnixHTTPConnection(self.api.socket_path,
+                                  constants.IMAGE_TRANSFER_TIMEOUT)
+        try:
+            conn.request("GET", "/images/%s/get" % self._quote(image))
+            response = conn.getresponse()
+            if response.status != 200:
+                msg = "Image: %s \n %s" % (image, response.read())
+                raise introexceptions.ImageNotPresent(msg)
+            result = consume(response)
+            for _ in iter(lambda: response.read(1 << 16), ""):
+                pass
+            return result
+        finally:
+            conn.close()
+
+
+BACKEND_CLASSES = {
+    "cli": DockerUtils,
+    "api": DockerAPIUtils,
+}
+
+_docker_backend = "cli"
+_docker_utils = {}
+_docker_utils_lock = Lock()
+
+
+def set_docker_backend(backend):
+    """
+    Select the backend used by get_docker_utils, "cli" or "api"
+    """
+    global _docker_backend
+    if backend not in BACKEND_CLASSES:
+        raise ValueError("Unknown docker backend: %s" % backend)
+    _docker_backend = backend
+
+
+def get_docker_utils():
+    """
+    Return the DockerUtils of selected backend. It is shared, so that
+    connections to the daemon are reused across callers.
+    """
+    with _docker_utils_lock:
+        if _docker_backend not in _docker_utils:
+            _docker_utils[_docker_backend] = \
+                BACKEND_CLASSES[_docker_backend]()
+        return _docker_utils[_docker_backend]
@@ -0,0 +1,495 @@
+import os
+import glob
+import stat
+import json
+import time
+from multiprocessing.pool import ThreadPool
+from struct import unpack, calcsize
+
+from package_tests import PackageTests
+
+# container specific
+SHARED_DIR_PARENT = "/var/tmp/container_introspection/"
+
+# parse results of previous probes, copied in and out by the test runner
+ELF_PARSE_CACHE = "elf_parse_cache.json"
+# parse results of ELF files only are kept, the least recently used ones
+# above this number are dropped
+ELF_PARSE_CACHE_MAX_ENTRIES = 100000
+
+# files classified by a worker at once and number of workers
+ELF_BATCH_SIZE = 256
+ELF_THREADS = 8
+
+ELF_MAGIC = "\x7fELF"
+ELF_HEADER_SIZE = 64
+
+ELF_CLASSES = {1: "ELF32", 2: "ELF64"}
+ELF_BYTE_ORDERS = {1: "<", 2: ">"}
+ELF_ENDIANNESS = {1: "little", 2: "big"}
+
+ET_REL, ET_EXEC, ET_DYN, ET_CORE = 1, 2, 3, 4
+PT_LOAD, PT_DYNAMIC, PT_INTERP = 1, 2, 3
+
+DT_NULL, DT_NEEDED, DT_STRTAB, DT_STRSZ = 0, 1, 5, 10
+DT_SONAME, DT_RPATH, DT_RUNPATH = 14, 15, 29
+DT_FLAGS_1 = 0x6ffffffb
+DF_1_PIE = 0x08000000
+
+LD_SO_CONF = "/etc/ld.so.conf"
+# trusted directories searched by the dynamic linker after ld.so.conf
+DEFAULT_LIB_DIRS = {1: ["/lib", "/usr/lib"],
+                    2: ["/lib64", "/usr/lib64", "/lib", "/usr/lib"]}
+
+ELF_MACHINES = {
+    2: "SPARC",
+    3: "x86",
+    8: "MIPS",
+    20: "PowerPC",
+    21: "PowerPC64",
+    22: "S390",
+    40: "ARM",
+    43: "SPARCV9",
+    50: "IA-64",
+    62: "x86-64",
+    183: "AArch64",
+    243: "RISC-V",
+}
+
+# struct formats of ELF header fields following e_ident and of program
+# header entries, for ELF32 and ELF64 respectively
+ELF_HEADER_FORMATS = {1: "HHIIIIIHHHHHH", 2: "HHIQQQIHHHHHH"}
+ELF_PHDR_FORMATS = {1: "IIIIIIII", 2: "IIQQQQQQ"}
+ELF_DYN_FORMATS = {1: "iI", 2: "qQ"}
+
+
+def pread(fd, size, offset):
+    """
+    Read size bytes at offset of given file descriptor
+    """
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+class ELFTests(object):
+    """
+    Classify ELF binaries and libraries present in container
+    """
+    def __init__(self, parse_cache_file=None, package_tests=None):
+        # package tests share their scan of binaries directories
+        self.package_tests = package_tests or PackageTests()
+        self.parse_cache_file = parse_cache_file
+        self.parse_cache = self.load_parse_cache(parse_cache_file)
+        # entries used by this probe are marked with its start time
+        self.started = int(time.time())
+
+    def load_parse_cache(self, cache_file):
+        """
+        Load parse results of earlier probes, keyed by file path
+        """
+        if not cache_file or not os.path.isfile(cache_file):
+            return {}
+        try:
+            with open(cache_file) as fin:
+                cache = json.load(fin)
+        except ValueError:
+            return {}
+        # caches of earlier versions kept files which are not ELF too
+        return dict((path, entry) for path, entry in cache.iteritems()
+                    if entry.get("elf"))
+
+    def save_parse_cache(self, max_entries=ELF_PARSE_CACHE_MAX_ENTRIES):
+        """
+        Save parse results for the next probes, the most recently used
+        max_entries of them
+        """
+        if not self.parse_cache_file:
+            return
+        entries = sorted(self.parse_cache.iteritems(),
+                         key=lambda item: item[1].get("used", 0),
+                         reverse=True)
+        with open(self.parse_cache_file, "wb") as fout:
+            json.dump(dict(entries[:max_entries]), fout)
+
+    def candidate_files(self):
+        """
+        Files in binaries and libraries directories to be classified
+        """
+        return self.package_tests.get_all_binaries_libs()
+
+    def read_elf_header(self, fd):
+        """
+        Read the ELF header of given file descriptor, returns None if it
+        is not an ELF file. Only the magic bytes are read of other files.
+        """
+        if pread(fd, len(ELF_MAGIC), 0) != ELF_MAGIC:
+            return None
+        header = ELF_MAGIC + pread(fd, ELF_HEADER_SIZE - len(ELF_MAGIC),
+                                   len(ELF_MAGIC))
+        elf_class, data = ord(header[4]), ord(header[5])
+        if elf_class not in ELF_CLASSES or data not in ELF_BYTE_ORDERS:
+            return None
+        fmt = ELF_BYTE_ORDERS[data] + ELF_HEADER_FORMATS[elf_class]
+        if len(header) < 16 + calcsize(fmt):
+            return None
+        fields = unpack(fmt, header[16:16 + calcsize(fmt)])
+        return {"class": elf_class,
+                "data": data,
+                "type": fields[0],
+                "machine": fields[1],
+                "phoff": fields[4],
+                "phentsize": fields[8],
+                "phnum": fields[9],
+                }
+
+    def program_headers(self, fd, header):
+        """
+        Read the program headers of an ELF file,
+        returns a list of (p_type, p_offset, p_vaddr, p_filesz)
+        """
+        fmt = ELF_BYTE_ORDERS[header["data"]] + \
+            ELF_PHDR_FORMATS[header["class"]]
+        size = calcsize(fmt)
+        if header["phentsize"] < size:
+            return []
+        table = pread(fd, header["phentsize"] * header["phnum"],
+                      header["phoff"])
+        phdrs = []
+        for n in range(len(table) // header["phentsize"]):
+            start = n * header["phentsize"]
+            entry = unpack(fmt, table[start:start + size])
+            if header["class"] == 1:
+                # p_type, p_offset, p_vaddr, p_paddr, p_filesz, ...
+                phdrs.append((entry[0], entry[1], entry[2], entry[4]))
+            else:
+                # p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, ...
+                phdrs.append((entry[0], entry[2], entry[3], entry[5]))
+        return phdrs
+
+    def interpreter(self, fd, phdrs):
+        """
+        Program interpreter of an ELF file, empty if it has none
+        """
+        for p_type, p_offset, _, p_filesz in phdrs:
+            if p_type == PT_INTERP:
+                return pread(fd, p_filesz, p_offset).rstrip("\0")
+        return ""
+
+    def vaddr_to_offset(self, vaddr, phdrs):
+        """
+        Map a virtual address to its offset in file via PT_LOAD segments
+        """
+        for p_type, p_offset, p_vaddr, p_filesz in phdrs:
+            if p_type == PT_LOAD and p_vaddr <= vaddr < p_vaddr + p_filesz:
+                return vaddr - p_vaddr + p_offset
+        return None
+
+    def dynamic_section(self, fd, header, phdrs):
+        """
+        Parse DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH and DT_FLAGS_1
+        from the dynamic section of an ELF file
+        """
+        dynamic = {"needed": [], "soname": "", "rpath": [], "runpath": [],
+                   "flags_1": 0}
+        segments = [phdr for phdr in phdrs if phdr[0] == PT_DYNAMIC]
+        if not segments:
+            return dynamic
+        _, offset, _, filesz = segments[0]
+        fmt = ELF_BYTE_ORDERS[header["data"]] + \
+            ELF_DYN_FORMATS[header["class"]]
+        size = calcsize(fmt)
+        data = pread(fd, filesz, offset)
+        entries = []
+        for n in range(len(data) // size):
+            tag, value = unpack(fmt, data[n * size:(n + 1) * size])
+            if tag == DT_NULL:
+                break
+            entries.append((tag, value))
+
+        tags = dict(entries)
+        if DT_FLAGS_1 in tags:
+            dynamic["flags_1"] = tags[DT_FLAGS_1]
+        stroff = None
+        if DT_STRTAB in tags:
+            stroff = self.vaddr_to_offset(tags[DT_STRTAB], phdrs)
+        if stroff is None or not tags.get(DT_STRSZ):
+            return dynamic
+        strings = pread(fd, tags[DT_STRSZ], stroff)
+
+        def string_at(index):
+            end = strings.find("\0", index)
+            return strings[index:end] if end >= 0 else strings[index:]
+
+        for tag, value in entries:
+            if tag == DT_NEEDED:
+                dynamic["needed"].append(string_at(value))
+            elif tag == DT_SONAME:
+                dynamic["soname"] = string_at(value)
+            elif tag == DT_RPATH:
+                dynamic["rpath"].extend(string_at(value).split(":"))
+            elif tag == DT_RUNPATH:
+                dynamic["runpath"].extend(string_at(value).split(":"))
+        return dynamic
+
+    def kind_of_elf(self, elf_type, interpreter, dynamic):
+        """
+        Kind of ELF file as per its type, program headers and dynamic section
+        """
+        if elf_type == ET_EXEC:
+            if interpreter or dynamic["needed"]:
+                return "dynamic_executable"
+            return "static_executable"
+        if elf_type == ET_DYN:
+            # shared libraries like libc have an interpreter too
+            if dynamic["flags_1"] & DF_1_PIE:
+                return "pie_executable"
+            if interpreter and not dynamic["soname"]:
+                return "pie_executable"
+            return "shared_object"
+        if elf_type == ET_REL:
+            return "relocatable"
+        if elf_type == ET_CORE:
+            return "core"
+        return "unknown"
+
+    def parse_file(self, filepath):
+        """
+        Parse given regular file, returns None if it is not an ELF file
+        """
+        try:
+            fd = os.open(filepath, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            header = self.read_elf_header(fd)
+            if not header:
+                return None
+            phdrs = self.program_headers(fd, header)
+            interpreter = self.interpreter(fd, phdrs)
+            dynamic = self.dynamic_section(fd, header, phdrs)
+        except Exception:
+            return None
+        finally:
+            os.close(fd)
+
+        return {"class": ELF_CLASSES[header["class"]],
+                "endianness": ELF_ENDIANNESS[header["data"]],
+                "machine": ELF_MACHINES.get(header["machine"],
+                                            str(header["machine"])),
+                "type": self.kind_of_elf(header["type"], interpreter,
+                                         dynamic),
+                "interpreter": interpreter,
+                "needed": dynamic["needed"],
+                "soname": dynamic["soname"],
+                "rpath": dynamic["rpath"],
+                "runpath": dynamic["runpath"],
+                }
+
+    def classify_file(self, filepath):
+        """
+        Classify given file, returns None if it is not an ELF file.
+        Results are cached by (size, mtime, inode) of the file path.
+        """
+        try:
+            st = os.lstat(filepath)
+        except OSError:
+            return None
+        # do not open fifos, devices or follow symlinks
+        if not stat.S_ISREG(st.st_mode) or st.st_size < len(ELF_MAGIC):
+            return None
+        key = [st.st_size, st.st_mtime, st.st_ino]
+        cached = self.parse_cache.get(filepath)
+        if cached and cached["key"] == key:
+            cached["used"] = self.started
+            return cached["elf"]
+        elf = self.parse_file(filepath)
+        # other files are told apart by their first bytes alone
+        if elf is not None:
+            self.parse_cache[filepath] = {"key": key, "elf": elf,
+                                          "used": self.started}
+        return elf
+
+    def classify_batch(self, filepaths):
+        """
+        Classify a batch of files, returns a list of (path, classification)
+        for the ELF files in it
+        """
+        result = []
+        for filepath in filepaths:
+            elf = self.classify_file(filepath)
+            if elf:
+                result.append((filepath, elf))
+        return result
+
+    def classify_files(self, filepaths):
+        """
+        Classify given files in batches across a pool of workers
+        """
+        batches = [filepaths[n:n + ELF_BATCH_SIZE]
+                   for n in range(0, len(filepaths), ELF_BATCH_SIZE)]
+        elf_files = {}
+        pool = ThreadPool(ELF_THREADS)
+        try:
+            for result in pool.imap_unordered(self.classify_batch, batches):
+                elf_files.update(result)
+        finally:
+            pool.close()
+            pool.join()
+        return elf_files
+
+    def summary(self, elf_files):
+        """
+        Count the ELF files of each type
+        """
+        summary = {}
+        for elf in elf_files.values():
+            summary[elf["type"]] = summary.get(elf["type"], 0) + 1
+        return summary
+
+    def ld_so_conf_dirs(self, conf=LD_SO_CONF, seen=None):
+        """
+        Library directories configured in ld.so.conf and its includes
+        """
+        seen = seen if seen is not None else set()
+        if conf in seen:
+            return []
+        seen.add(conf)
+        dirs = []
+        try:
+            lines = open(conf).read().splitlines()
+        except IOError:
+            return dirs
+        for line in lines:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            if line.startswith("include"):
+                pattern = line.split(None, 1)[1] if " " in line else ""
+                if pattern and not os.path.isabs(pattern):
+                    pattern = os.path.join(os.path.dirname(conf), pattern)
+                for included in sorted(glob.glob(pattern)):
+                    dirs.extend(self.ld_so_conf_dirs(included, seen))
+            else:
+                dirs.append(line)
+        return dirs
+
+    def expand_search_dir(self, directory, filepath, elf):
+        """
+        Expand dynamic string tokens in an RPATH/RUNPATH entry
+        """
+        lib = "lib64" if elf["class"] == "ELF64" else "lib"
+        origin = os.path.dirname(filepath)
+        for token, value in (("${ORIGIN}", origin), ("$ORIGIN", origin),
+                             ("${LIB}", lib), ("$LIB", lib)):
+            directory = directory.replace(token, value)
+        return directory
+
+    def search_dirs(self, filepath, elf, system_dirs):
+        """
+        Directories searched for the needed libraries of given ELF file,
+        in the order the dynamic linker uses
+        """
+        dirs = []
+        if elf["rpath"] and not elf["runpath"]:
+            dirs.extend(elf["rpath"])
+        dirs.extend(os.environ.get("LD_LIBRARY_PATH", "").split(":"))
+        dirs.extend(elf["runpath"])
+        dirs = [self.expand_search_dir(d, filepath, elf) for d in dirs if d]
+        return dirs + system_dirs[elf["class"]]
+
+    def resolve_soname(self, soname, filepath, elf, system_dirs):
+        """
+        Resolve a needed soname of given ELF file to the real path of the
+        library the dynamic linker would load, None if it is missing
+        """
+        if "/" in soname:
+            candidates = [soname]
+        else:
+            candidates = [os.path.join(d, soname)
+                          for d in self.search_dirs(filepath, elf,
+                                                    system_dirs)]
+        for candidate in candidates:
+            if not os.path.exists(candidate):
+                continue
+            library = os.path.realpath(candidate)
+            provider = self.classify_file(library)
+            if provider and provider["class"] == elf["class"] and \
+                    provider["machine"] == elf["machine"]:
+                return library
+        return None
+
+    def resolution_graph(self, elf_files):
+        """
+        Resolve needed sonames of all ELF files and report missing sonames,
+        sonames with more than one provider and ad-hoc libraries that
+        packaged binaries link to
+        """
+        conf_dirs = self.ld_so_conf_dirs()
+        system_dirs = dict((ELF_CLASSES[c], conf_dirs + DEFAULT_LIB_DIRS[c])
+                           for c in ELF_CLASSES)
+
+        graph, missing, providers, adhoc_linked = {}, {}, {}, {}
+        for filepath, elf in sorted(elf_files.items()):
+            if elf["soname"]:
+                providers.setdefault(
+                    (elf["soname"], elf["class"], elf["machine"]),
+                    set()).add(os.path.realpath(filepath))
+
+        owned_files = self.package_tests.rpmdb.owned_files()
+        real_dirs = {}
+        for filepath, elf in sorted(elf_files.items()):
+            if not elf["needed"]:
+                continue
+            graph[filepath] = {}
+            packaged = self.package_tests.is_owned_by_package(
+                filepath, owned_files, real_dirs)
+            for soname in elf["needed"]:
+                library = self.resolve_soname(soname, filepath, elf,
+                                              system_dirs)
+                graph[filepath][soname] = library
+                if library is None:
+                    missing.setdefault(soname, []).append(filepath)
+                elif packaged and not self.package_tests.is_owned_by_package(
+                        library, owned_files, real_dirs):
+                    adhoc_linked.setdefault(library, []).append(filepath)
+
+        duplicates = {}
+        for (soname, _, _), paths in providers.items():
+            if len(paths) > 1:
+                duplicates.setdefault(soname, []).extend(sorted(paths))
+        return {"graph": graph,
+                "missing_sonames": missing,
+                "duplicate_providers": duplicates,
+                "adhoc_libraries_linked": adhoc_linked,
+                }
+
+    def run(self):
+        """
+        Run tests and gather all test data JSON format
+        """
+        elf_files = self.classify_files(self.candidate_files())
+        return {"ELF_files": elf_files,
+                "ELF_summary": self.summary(elf_files),
+                "ELF_library_resolution": self.resolution_graph(elf_files),
+                }
+
+    def export(self, data, shared_dir=SHARED_DIR_PARENT):
+        """
+        Export the report in shared dir and save the parse cache
+        """
+        self.save_parse_cache()
+
+        data_file_path = os.path.join(
+            shared_dir,
+            "%s.json" % self.__class__.__name__)
+
+        with open(data_file_path, "wb") as fin:
+            json.dump(data, fin)
+
+
+if __name__ == "__main__":
+    elf_tests = ELFTests(
+        parse_cache_file=os.path.join(SHARED_DIR_PARENT, ELF_PARSE_CACHE))
+    elf_tests.export(elf_tests.run())
@@ -0,0 +1,333 @@
+import logging
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from subprocess import Popen, PIPE
+from threading import Lock, Thread, Timer, local
+
+log = logging.getLogger("executor")
+
+# stats of most recent commands kept for instrumentation
+STATS_LIMIT = 1000
+# group of commands run outside of any Executor.group
+DEFAULT_GROUP = "default"
+
+
+class CommandError(Exception):
+    """
+    Command did not run to completion, output produced so far is kept
+    """
+    def __init__(self, cmd, out, error):
+        Exception.__init__(self, "Command: %s" % " ".join(cmd))
+        self.cmd = cmd
+        self.out = out
+        self.error = error
+
+
+class CommandTimeout(CommandError):
+    """
+    Command killed after running longer than its timeout
+    """
+    pass
+
+
+class CommandCancelled(CommandError):
+    """
+    Command killed or not started because its group was cancelled
+    """
+    pass
+
+
+class Executor(object):
+    """
+    Run commands without blocking on full pipes: stdout and stderr are read
+    concurrently while the command runs, optionally line by line into
+    callbacks. Commands may be given a timeout. Every command belongs to
+    the group its thread runs in, see group(), and all commands of a group
+    are killed by cancel(). Wall time, exit code and bytes read of every
+    command are recorded.
+    """
+    def __init__(self, stats_limit=STATS_LIMIT):
+        self.lock = Lock()
+        self.local = local()
+        # Popen -> (group, record) of commands not finished yet
+        self.running = {}
+        # cancelled groups, None once all groups are cancelled
+        self.cancelled = set()
+        self.stats = deque(maxlen=stats_limit)
+        self.totals = {"commands": 0, "wall_time": 0.0,
+                       "stdout_bytes": 0, "stderr_bytes": 0,
+                       "failed": 0, "timed_out": 0, "cancelled": 0}
+
+    def current_group(self):
+        """
+        Group of commands started by calling thread
+        """
+        return getattr(self.local, "group", DEFAULT_GROUP)
+
+    @contextmanager
+    def group(self, name):
+        """
+        Run commands started by calling thread within the block in group
+        of given name
+        """
+        previous = self.current_group()
+        self.local.group = name
+        try:
+            yield
+        finally:
+            self.local.group = previous
+
+    def cancel(self, group=None):
+        """
+        Kill running commands of given group, or of all groups if group is
+        None. Commands the group starts later are cancelled right away,
+        until the group is reset.
+        """
+        with self.lock:
+            self.cancelled.add(group)
+            killed = [(p, record) for p, (name, record) in
+                      self.running.iteritems()
+                      if group is None or name == group]
+            for p, record in killed:
+                record["cancelled"] = True
+        log.debug("Cancelling %d commands of group %s.", len(killed),
+                  "all" if group is None else group)
+        for p, _ in killed:
+            self._kill(p)
+
+    def reset(self, group=None):
+        """
+        Let given group run commands again after cancel(), all groups if
+        group is None
+        """
+        with self.lock:
+            if group is None:
+                self.cancelled.clear()
+            else:
+                self.cancelled.discard(group)
+
+    def _start(self, cmd, stdin, record):
+        """
+        Start command, registered as running in group of calling thread
+        until _finish
+        """
+        group = self.current_group()
+        with self.lock:
+            if None in self.cancelled or group in self.cancelled:
+                raise CommandCancelled(cmd, "", "")
+            # descriptors of pipes opened by other threads must not be
+            # inherited, a command holding a write end never sees EOF
+            p = Popen(cmd, stdin=PIPE if stdin is not None else None,
+                      stdout=PIPE, stderr=PIPE, close_fds=True)
+            self.running[p] = (group, record)
+        return p
+
+    def _kill(self, p, record=None):
+        """
+        Kill command if it is still running
+        """
+        if record is not None:
+            record["timed_out"] = True
+        try:
+            p.kill()
+        except OSError:
+            pass
+
+    def _read_lines(self, pipe, record, key, callback, collected):
+        """
+        Read pipe to its end, passing lines to callback if given and
+        collecting them otherwise
+        """
+        for line in iter(pipe.readline, ""):
+            record[key] += len(line)
+            if callback is not None:
+                callback(line)
+            else:
+                collected.append(line)
+        pipe.close()
+
+    def _reader(self, pipe, record, key, callback, collected):
+        reader = Thread(target=self._read_lines,
+                        args=(pipe, record, key, callback, collected))
+        reader.daemon = True
+        reader.start()
+        return reader
+
+    def _write_stdin(self, p, stdin):
+        """
+        Feed stdin to command, a string or a file object read in chunks.
+        A file object is read to its end even if the command exits early,
+        so that a writer at the other end of a pipe is never blocked.
+        """
+        try:
+            if hasattr(stdin, "read"):
+                for chunk in iter(lambda: stdin.read(1 << 16), ""):
+                    p.stdin.write(chunk)
+            else:
+                p.stdin.write(stdin)
+        except IOError:
+            # command exited without reading all of its input
+            if hasattr(stdin, "read"):
+                for _ in iter(lambda: stdin.read(1 << 16), ""):
+                    pass
+        finally:
+            try:
+                p.stdin.close()
+            except IOError:
+                pass
+
+    def _finish(self, p, cmd, record, started):
+        """
+        Reap command and record its stats
+        """
+        record["returncode"] = p.wait()
+        record["wall_time"] = time.time() - started
+        with self.lock:
+            self.running.pop(p, None)
+            self.stats.append(record)
+            self.totals["commands"] += 1
+            self.totals["wall_time"] += record["wall_time"]
+            self.totals["stdout_bytes"] += record["stdout_bytes"]
+            self.totals["stderr_bytes"] += record["stderr_bytes"]
+            if record["returncode"] != 0:
+                self.totals["failed"] += 1
+            if record["timed_out"]:
+                self.totals["timed_out"] += 1
+            if record["cancelled"]:
+                self.totals["cancelled"] += 1
+        log.debug("Command: %s exited %s in %.3fs, %d/%d bytes", cmd,
+                  record["returncode"], record["wall_time"],
+                  record["stdout_bytes"], record["stderr_bytes"])
+
+    def _new_record(self, cmd):
+        return {"cmd": cmd, "returncode": None, "wall_time": None,
+                "stdout_bytes": 0, "stderr_bytes": 0, "timed_out": False,
+                "cancelled": False}
+
+    def _raise_if_killed(self, cmd, record, out, error):
+        if record["cancelled"]:
+            raise CommandCancelled(cmd, out, error)
+        if record["timed_out"]:
+            raise CommandTimeout(cmd, out, error)
+
+    def run(self, cmd, timeout=None, stdin=None, on_stdout=None,
+            on_stderr=None):
+        """
+        Run command and return its (stdout, stderr). Lines of a stream
+        given a callback are passed to it as they are read instead of
+        being returned. Raises CommandTimeout if command runs longer than
+        timeout seconds and CommandCancelled if its group is cancelled.
+        """
+        record = self._new_record(cmd)
+        started = time.time()
+        p = self._start(cmd, stdin, record)
+        out, error = [], []
+        readers = [self._reader(p.stdout, record, "stdout_bytes",
+                                on_stdout, out),
+                   self._reader(p.stderr, record, "stderr_bytes",
+                                on_stderr, error)]
+        timer = None
+        if timeout is not None:
+            timer = Timer(timeout, self._kill, [p, record])
+            timer.daemon = True
+            timer.start()
+        try:
+            if stdin is not None:
+                self._write_stdin(p, stdin)
+            for reader in readers:
+                reader.join()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self._finish(p, cmd, record, started)
+        out, error = "".join(out), "".join(error)
+        self._raise_if_killed(cmd, record, out, error)
+        return (out, error)
+
+    def stream(self, cmd, timeout=None, on_stderr=None):
+        """
+        Run command and yield its stdout lines as they are produced,
+        stderr is read concurrently so the command never blocks on it.
+        Closing the generator early kills the command.
+        """
+        record = self._new_record(cmd)
+        started = time.time()
+        p = self._start(cmd, None, record)
+        error = []
+        reader = self._reader(p.stderr, record, "stderr_bytes",
+                              on_stderr, error)
+        timer = None
+        if timeout is not None:
+            timer = Timer(timeout, self._kill, [p, record])
+            timer.daemon = True
+            timer.start()
+        finished = False
+        try:
+            for line in iter(p.stdout.readline, ""):
+                record["stdout_bytes"] += len(line)
+                yield line
+            finished = True
+        finally:
+            if not finished:
+                self._kill(p)
+            p.stdout.close()
+            reader.join()
+            if timer is not None:
+                timer.cancel()
+            self._finish(p, cmd, record, started)
+        self._raise_if_killed(cmd, record, "", "".join(error))
+
+    def read_stdout(self, cmd, consume, timeout=None):
+        """
+        Run command and call consume with its stdout as a file object, for
+        output too large to be collected, like an image archive. stdout is
+        read to its end whatever consume does, so that the command never
+        blocks on it. Returns (result of consume, stderr).
+        """
+        record = self._new_record(cmd)
+        started = time.time()
+        p = self._start(cmd, None, record)
+        error = []
+        reader = self._reader(p.stderr, record, "stderr_bytes", None, error)
+        timer = None
+        if timeout is not None:
+            timer = Timer(timeout, self._kill, [p, record])
+            timer.daemon = True
+            timer.start()
+        try:
+            result = consume(p.stdout)
+            for chunk in iter(lambda: p.stdout.read(1 << 16), ""):
+                pass
+        finally:
+            p.stdout.close()
+            reader.join()
+            if timer is not None:
+                timer.cancel()
+            self._finish(p, cmd, record, started)
+        error = "".join(error)
+        self._raise_if_killed(cmd, record, "", error)
+        return result, error
+
+    def summary(self):
+        """
+        Totals of all commands run
+        """
+        with self.lock:
+            return dict(self.totals)
+
+
+_executor = None
+_executor_lock = Lock()
+
+
+def get_executor():
+    """
+    Return the executor shared by all callers of a process
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = Executor()
+        return _executor
@@ -0,0 +1,301 @@
+import bz2
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tarfile
+
+from threading import Thread
+
+try:
+    from lzma import LZMAFile
+except ImportError:
+    try:
+        # backport for python versions older than 3.3
+        from backports.lzma import LZMAFile
+    except ImportError:
+        LZMAFile = None
+
+import introexceptions
+
+log = logging.getLogger("image_archive")
+
+# metadata members of `docker save` archives, legacy and docker-archive
+# layouts, and of OCI image layouts
+REPOSITORIES = "repositories"
+MANIFEST = "manifest.json"
+OCI_INDEX = "index.json"
+OCI_LAYOUT = "oci-layout"
+METADATA_MEMBERS = [REPOSITORIES, MANIFEST, OCI_INDEX, OCI_LAYOUT]
+
+# annotations naming an image in OCI index
+OCI_REF_NAME = "org.opencontainers.image.ref.name"
+CONTAINERD_IMAGE_NAME = "io.containerd.image.name"
+
+# layer members digested while ingesting, legacy layout and OCI blobs
+LEGACY_LAYER = "layer.tar"
+OCI_BLOBS_DIR = "blobs/"
+
+GZIP_MAGIC = "\x1f\x8b"
+BZIP2_MAGIC = "BZh"
+XZ_MAGIC = "\xfd7zXZ\x00"
+
+CHUNK_SIZE = 1 << 16
+
+
+class TeeReader(object):
+    """
+    File object reading from source and writing every byte read to sink
+    """
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if data:
+            self.sink.write(data)
+        return data
+
+    def drain(self):
+        """
+        Read rest of source, so sink gets all of it
+        """
+        for _ in iter(lambda: self.read(CHUNK_SIZE), ""):
+            pass
+
+    def close(self):
+        self.sink.close()
+
+
+class ImageArchive(object):
+    """
+    Image metadata read from an image archive without extracting it. Member
+    headers are read in order until the metadata is found, for uncompressed
+    archives the member data in between is seeked over.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def member_name(self, member):
+        """
+        Name of member relative to archive root
+        """
+        return os.path.normpath(member.name).lstrip("/")
+
+    def metadata_complete(self, metadata):
+        """
+        Check if there is no need to read further members, docker writes
+        both manifest.json and repositories, after the layers
+        """
+        return metadata[MANIFEST] is not None and \
+            metadata[REPOSITORIES] is not None
+
+    def is_layer(self, name, member):
+        """
+        Check if member is a layer
+        """
+        return member.isfile() and (
+            os.path.basename(name) == LEGACY_LAYER or
+            name.startswith(OCI_BLOBS_DIR))
+
+    def member_digest(self, tar, member):
+        """
+        sha256 digest of member data
+        """
+        digest = hashlib.sha256()
+        fin = tar.extractfile(member)
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), ""):
+            digest.update(chunk)
+        return "sha256:%s" % digest.hexdigest()
+
+    def read_tar_metadata(self, tar, stop_early=True, layer_digests=None):
+        """
+        Read metadata members of given open tarfile, which may be
+        a stream. Returns the metadata members found, keyed by name.
+        Digests of layers are added to layer_digests, if given.
+        """
+        metadata = dict((name, None) for name in METADATA_MEMBERS)
+        for member in tar:
+            name = self.member_name(member)
+            if layer_digests is not None and self.is_layer(name, member):
+                layer_digests[name] = self.member_digest(tar, member)
+                continue
+            if name not in metadata or not member.isfile():
+                continue
+            data = tar.extractfile(member).read()
+            if name == OCI_LAYOUT:
+                metadata[name] = data
+            else:
+                metadata[name] = json.loads(data)
+            if stop_early and self.metadata_complete(metadata):
+                break
+        return metadata
+
+    def read_metadata(self):
+        """
+        Read metadata members of archive
+        """
+        try:
+            tar = tarfile.open(self.path, "r:*")
+        except (tarfile.TarError, IOError) as e:
+            msg = "tar/gz file: %s \n %s" % (self.path, e)
+            raise introexceptions.InvalidTarFileImage(msg)
+        try:
+            metadata = self.read_tar_metadata(tar)
+            if metadata[MANIFEST] is None and metadata[OCI_INDEX]:
+                metadata[MANIFEST] = self.oci_manifest(tar,
+                                                       metadata[OCI_INDEX])
+            return metadata
+        except (tarfile.TarError, ValueError) as e:
+            msg = "tar/gz file: %s \n %s" % (self.path, e)
+            raise introexceptions.InvalidTarFileImage(msg)
+        finally:
+            tar.close()
+
+    def open_decompressed(self):
+        """
+        Open archive for reading its tar stream, decompressing it on the fly
+        """
+        with open(self.path, "rb") as fin:
+            magic = fin.read(len(XZ_MAGIC))
+        if magic.startswith(GZIP_MAGIC):
+            return gzip.GzipFile(self.path, "rb")
+        if magic.startswith(BZIP2_MAGIC):
+            return bz2.BZ2File(self.path, "rb")
+        if magic.startswith(XZ_MAGIC):
+            if LZMAFile is None:
+                msg = "tar/xz file: %s needs lzma module " \
+                      "(backports.lzma on python 2)" % self.path
+                raise introexceptions.InvalidTarFileImage(msg)
+            return LZMAFile(self.path, "rb")
+        return open(self.path, "rb")
+
+    def ingest(self, load):
+        """
+        Read archive once, decompressing it once: the tar stream is passed
+        to load, which is called with a file object to read it from, while
+        metadata and layer digests are read from the same bytes. Returns
+        metadata with digests of layers, in manifest order, under
+        "layer_digests".
+        """
+        try:
+            source = self.open_decompressed()
+        except IOError as e:
+            msg = "tar/gz file: %s \n %s" % (self.path, e)
+            raise introexceptions.InvalidTarFileImage(msg)
+        read_end, write_end = os.pipe()
+        loaded = {}
+        loader = Thread(target=self._load, args=(load, read_end, loaded))
+        loader.daemon = True
+        loader.start()
+        tee = TeeReader(source, os.fdopen(write_end, "wb"))
+        layer_digests = {}
+        try:
+            tar = tarfile.open(fileobj=tee, mode="r|")
+            metadata = self.read_tar_metadata(tar, stop_early=False,
+                                              layer_digests=layer_digests)
+            tee.drain()
+        except (tarfile.TarError, IOError, EOFError, ValueError) as e:
+            msg = "tar/gz file: %s \n %s" % (self.path, e)
+            raise introexceptions.InvalidTarFileImage(msg)
+        finally:
+            tee.close()
+            loader.join()
+            source.close()
+        if "error" in loaded:
+            raise loaded["error"]
+        if metadata[MANIFEST] is None and metadata[OCI_INDEX]:
+            metadata[MANIFEST] = self.oci_manifest(tar, metadata[OCI_INDEX],
+                                                   seekable=False)
+        metadata["layer_digests"] = [
+            layer_digests.get(layer)
+            for entry in metadata[MANIFEST] or []
+            for layer in entry.get("Layers") or []]
+        return metadata
+
+    def _load(self, load, read_end, loaded):
+        """
+        Call load on read end of pipe, read the pipe to its end whatever
+        load does so that the archive reader never blocks
+        """
+        with os.fdopen(read_end, "rb") as stream:
+            try:
+                loaded["result"] = load(stream)
+            except Exception as e:
+                loaded["error"] = e
+            for _ in iter(lambda: stream.read(CHUNK_SIZE), ""):
+                pass
+
+    def oci_image_names(self, descriptor):
+        """
+        Names of image of given OCI index descriptor
+        """
+        annotations = descriptor.get("annotations") or {}
+        name = annotations.get(CONTAINERD_IMAGE_NAME)
+        if name:
+            return [name]
+        ref = annotations.get(OCI_REF_NAME)
+        if ref and (":" in ref or "/" in ref):
+            return [ref]
+        return []
+
+    def blob_path(self, digest):
+        """
+        Path of blob of given digest in OCI image layout
+        """
+        algorithm, _, hexdigest = digest.partition(":")
+        return "blobs/%s/%s" % (algorithm, hexdigest)
+
+    def oci_manifest(self, tar, index, seekable=True):
+        """
+        Entries in `docker save` manifest.json format made from OCI index
+        and the image manifests it refers to. Layers are listed only if the
+        archive can be seeked back to the manifest blobs.
+        """
+        members = {}
+        if seekable:
+            members = dict((self.member_name(member), member)
+                           for member in tar.getmembers())
+        manifest = []
+        for descriptor in index.get("manifests") or []:
+            entry = {"Config": None,
+                     "RepoTags": self.oci_image_names(descriptor),
+                     "Layers": []}
+            blob = members.get(self.blob_path(descriptor["digest"]))
+            if blob is not None:
+                image_manifest = json.load(tar.extractfile(blob))
+                entry["Config"] = self.blob_path(
+                    image_manifest["config"]["digest"])
+                entry["Layers"] = [self.blob_path(layer["digest"])
+                                   for layer in image_manifest["layers"]]
+            manifest.append(entry)
+        return manifest
+
+    def repositories_of_metadata(self, metadata):
+        """
+        Repositories of image in legacy `repositories` format,
+        {name: {tag: id}}, made from manifest when the archive has none
+        """
+        if metadata[REPOSITORIES]:
+            return metadata[REPOSITORIES]
+        repositories = {}
+        for entry in metadata[MANIFEST] or []:
+            config = entry.get("Config") or ""
+            image_id = os.path.basename(config).replace(".json", "")
+            for repo_tag in entry.get("RepoTags") or []:
+                name, _, tag = repo_tag.rpartition(":")
+                if not name or "/" in tag:
+                    name, tag = repo_tag, "latest"
+                repositories.setdefault(name, {})[tag] = image_id
+        if not repositories:
+            msg = "tar/gz file: %s has no image name" % self.path
+            raise introexceptions.InvalidTarFileImage(msg)
+        return repositories
+
+    def repositories(self):
+        """
+        Repositories of image in archive, {name: {tag: id}}
+        """
+        return self.repositories_of_metadata(self.read_metadata())
@@ -1,20 +1,20 @@
 import json
 
-from dockerutils import DockerUtils
+from inspection_cache import InspectionCache
 
 
 class InspectImage(object):
     """
     Inspect test for image
     """
-    def __init__(self):
-        self.docker = DockerUtils()
+    def __init__(self, cache=None):
+        self.cache = cache or InspectionCache()
 
     def inspect_image(self, image):
         """
         Inspect given image
         """
-        return self.docker.inspect_image(image)
+        return self.cache.inspect_image(image)
 
     @staticmethod
     def inspect_image_report_text(json_data):
@@ -58,14 +58,14 @@ class InspectContainer(object):
     """
     Inspect test for container
     """
-    def __init__(self):
-        self.docker = DockerUtils()
+    def __init__(self, cache=None):
+        self.cache = cache or InspectionCache()
 
     def inspect_container(self, container):
         """
         Inspect given container
         """
-        return self.docker.inspect_container(container)
+        return self.cache.inspect_container(container)
 
     @staticmethod
     def inspect_container_report_text(json_data):
@@ -0,0 +1,179 @@
+import errno
+import json
+import logging
+import os
+import stat
+import tempfile
+
+import constants
+
+from dockerutils import get_docker_utils
+
+log = logging.getLogger("inspection_cache")
+
+# fields of an image inspection which change while its id does not, they
+# are not stored but taken from the local image listing when handed out
+MUTABLE_FIELDS = ["RepoTags", "RepoDigests", "Metadata"]
+
+
+class InspectionCache(object):
+    """
+    Inspections of images and containers shared by the tests of a run.
+    Image inspections are immutable per image id, but for their tags and
+    digests, and are kept at host across runs without those, least
+    recently used ones are evicted above max_entries.
+    Container inspections are kept only for the run.
+    """
+    def __init__(self, cache_dir=constants.INSPECTION_CACHE_DIR,
+                 max_entries=constants.INSPECTION_CACHE_MAX_ENTRIES):
+        self.docker = get_docker_utils()
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.containers = {}
+
+    def path_of(self, image_id):
+        """
+        Path of stored inspection of given image id
+        """
+        return os.path.join(self.cache_dir,
+                            "%s.json" % image_id.replace("sha256:", ""))
+
+    def image_id_of(self, image):
+        """
+        Id of given image name or id from local image listing, None if it
+        is not listed
+        """
+        record = self.docker.state.find_image(image)
+        if record is None:
+            return None
+        return record["Id"]
+
+    def current(self, inspection):
+        """
+        Copy of image inspection with tags and digests of the image as it
+        is listed now
+        """
+        image_id = inspection.get("Id", inspection.get("id"))
+        record = self.docker.state.find_image(image_id) if image_id else None
+        record = record or {}
+        current = dict((key, value) for key, value in inspection.iteritems()
+                       if key not in MUTABLE_FIELDS)
+        current["RepoTags"] = list(record.get("RepoTags", []))
+        current["RepoDigests"] = list(record.get("RepoDigests", []))
+        return current
+
+    def load(self, image_id):
+        """
+        Stored inspection of given image id, None if there is none
+        """
+        path = self.path_of(image_id)
+        try:
+            with open(path) as fin:
+                inspection = json.load(fin)
+            # mark as recently used for eviction
+            os.utime(path, None)
+        except ValueError:
+            return None
+        except (IOError, OSError) as e:
+            # there is none, or a concurrent test run evicted it
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return self.docker.remember_inspection(inspection)
+
+    def store(self, inspection):
+        """
+        Store inspection of an image at host
+        """
+        image_id = inspection.get("Id", inspection.get("id"))
+        if not image_id:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        inspection = dict((key, value) for key, value in
+                          inspection.iteritems() if key not in MUTABLE_FIELDS)
+        # concurrent test runs may store the same base layers
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fout:
+            json.dump(inspection, fout)
+        os.rename(tmp, self.path_of(image_id))
+
+    def lookup(self, image_id):
+        """
+        Inspection of given image id kept in memory or at host, None if
+        it was not inspected yet
+        """
+        if image_id in self.docker.image_inspections:
+            return self.docker.image_inspections[image_id]
+        return self.load(image_id)
+
+    def inspect_image(self, image):
+        """
+        Inspection of given image name or id, inspected only if its id
+        was never inspected
+        """
+        image_id = self.image_id_of(image)
+        inspection = self.lookup(image_id) if image_id else None
+        if inspection is None:
+            inspection = self.docker.inspect_image(image)
+            self.store(inspection)
+            self.evict()
+        return self.current(inspection)
+
+    def inspect_images(self, image_ids):
+        """
+        Inspections of given image ids, those never inspected are
+        inspected at once. Ids of images not present are left out.
+        """
+        found = dict((image_id, self.lookup(image_id))
+                     for image_id in image_ids)
+        missing = [image_id for image_id in image_ids
+                   if found[image_id] is None]
+        if missing:
+            for inspection in self.docker.inspect_images(missing):
+                self.store(inspection)
+                found[inspection.get("Id", inspection.get("id"))] = \
+                    inspection
+            self.evict()
+        return [self.current(found[image_id]) for image_id in image_ids
+                if found.get(image_id) is not None]
+
+    def image_history(self, image_id):
+        """
+        Ids of the layers of given image id from top layer down
+        """
+        return self.docker.image_history(image_id)
+
+    def inspect_container(self, container):
+        """
+        Inspection of given container, inspected once per run
+        """
+        if container not in self.containers:
+            self.containers[container] = self.docker.inspect_container(
+                container)
+        return self.containers[container]
+
+    def evict(self):
+        """
+        Remove least recently used stored inspections above max_entries
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.stat(path)[stat.ST_MTIME], path))
+            except OSError as e:
+                # evicted by a concurrent test run
+                if e.errno != errno.ENOENT:
+                    raise
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
@@ -86,6 +86,10 @@ class CannotCreateContainer(IntroExceptions):
     pass
 
 
+class CannotExecInContainer(IntroExceptions):
+    pass
+
+
 class ImageNotPresent(IntroExceptions):
     pass
 
@@ -0,0 +1,178 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+
+from threading import Lock
+
+import constants
+
+log = logging.getLogger("layer_cache")
+
+STATS_FILE = "stats.json"
+
+
+def chain_ids(diff_ids):
+    """
+    Chain IDs of layers of given diff IDs, from base layer up. The chain ID
+    of a layer identifies it along with all layers below it.
+    """
+    chain = []
+    for diff_id in diff_ids:
+        if not chain:
+            chain.append(diff_id)
+        else:
+            digest = hashlib.sha256("%s %s" % (chain[-1], diff_id))
+            chain.append("sha256:%s" % digest.hexdigest())
+    return chain
+
+
+class LayerCache(object):
+    """
+    Analysis results of layer chains kept at host, keyed by chain ID and
+    the configuration they were made with, so that images sharing layers
+    and configuration reuse them. Least recently used results are
+    evicted above max_bytes. Lookups are counted across runs.
+    """
+    def __init__(self, cache_dir=constants.LAYER_CACHE_DIR,
+                 max_bytes=constants.LAYER_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.counts = {"hits": 0, "partial_hits": 0, "misses": 0}
+        # a cache may be shared by concurrent test runs
+        self.lock = Lock()
+
+    def path_of(self, key, config=None):
+        """
+        Path of cached result of given chain ID and configuration
+        """
+        name = key.replace("sha256:", "")
+        if config is not None:
+            digest = hashlib.sha256(json.dumps(config, sort_keys=True))
+            name = "%s-%s" % (name, digest.hexdigest()[:16])
+        return os.path.join(self.cache_dir, "%s.json" % name)
+
+    def get(self, key, config=None):
+        """
+        Cached result of given chain ID, None if there is none or it was
+        made with another configuration
+        """
+        path = self.path_of(key, config)
+        try:
+            with open(path) as fin:
+                result = json.load(fin)
+            # mark as recently used for eviction
+            os.utime(path, None)
+        except ValueError:
+            return None
+        except (IOError, OSError) as e:
+            # there is none, or a concurrent test run evicted it
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        if result.get("config") != config:
+            return None
+        return result
+
+    def nearest(self, keys, config=None):
+        """
+        Cached result of the topmost of given chain IDs, ordered from base
+        layer up. Returns (index, result), (None, None) if none is cached.
+        """
+        for n in range(len(keys) - 1, -1, -1):
+            result = self.get(keys[n], config)
+            if result is not None:
+                return n, result
+        return None, None
+
+    def put(self, key, result, config=None):
+        """
+        Cache result of given chain ID
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        result = dict(result, chain_id=key, config=config)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fout:
+            json.dump(result, fout)
+        os.rename(tmp, self.path_of(key, config))
+        with self.lock:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used results above max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json") or name == STATS_FILE:
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError as e:
+                # evicted by a concurrent test run
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            entries.append((st[stat.ST_MTIME], st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            total -= size
+
+    def record(self, kind):
+        """
+        Count a lookup, kind is one of "hits", "partial_hits", "misses"
+        """
+        with self.lock:
+            self.counts[kind] += 1
+
+    def stats(self):
+        """
+        Lookup counts and hit ratios of this run and of all runs, the
+        latter are saved in cache dir
+        """
+        with self.lock:
+            path = os.path.join(self.cache_dir, STATS_FILE)
+            totals = {"hits": 0, "partial_hits": 0, "misses": 0}
+            if os.path.isfile(path):
+                try:
+                    with open(path) as fin:
+                        totals.update(json.load(fin))
+                except ValueError:
+                    pass
+            run = self.counts
+            for kind, count in run.items():
+                totals[kind] += count
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # concurrent test runs write their totals too, the last one
+            # is kept whole
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as fout:
+                json.dump(totals, fout)
+            os.rename(tmp, path)
+            self.counts = dict((kind, 0) for kind in run)
+        return {"run": self.hit_ratios(run),
+                "total": self.hit_ratios(totals)}
+
+    def hit_ratios(self, counts):
+        """
+        Counts along with ratio of full and partial hits to all lookups
+        """
+        lookups = sum(counts.values())
+        ratios = dict(counts)
+        ratios["hit_ratio"] = \
+            float(counts["hits"]) / lookups if lookups else 0.0
+        ratios["partial_hit_ratio"] = \
+            float(counts["partial_hits"]) / lookups if lookups else 0.0
+        return ratios
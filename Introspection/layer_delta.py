@@ -0,0 +1,280 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+
+import constants
+
+from inspection_cache import InspectionCache
+from layer_cache import LayerCache, chain_ids
+from metadata import Metadata
+
+log = logging.getLogger("layer_delta")
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+# overlay marks a directory replacing the one of lower layers with an
+# xattr, "user." when docker runs rootless
+OPAQUE_XATTRS = ["trusted.overlay.opaque", "user.overlay.opaque"]
+# image config results depend on: binaries directories are found from
+# these variables, files the probes can read depend on the user
+IMAGE_CONFIG_ENV = ["PATH", "LD_LIBRARY_PATH"]
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except OSError:
+    libc = None
+
+
+def lgetxattr(path, name):
+    """
+    Value of extended attribute of path, symlinks not followed, None if
+    path has no such attribute
+    """
+    if libc is None:
+        return None
+    value = ctypes.create_string_buffer(64)
+    size = libc.lgetxattr(path, name, value, len(value))
+    if size < 0:
+        return None
+    return value.raw[:size]
+
+
+class LayerDelta(object):
+    """
+    Incremental introspection of layered images. Results of introspected
+    images are cached at host by layer chain: an image whose layer chain is
+    cached reuses its reports, an image deriving from a cached chain is
+    verified only for the packages changed in its upper layers.
+    """
+    def __init__(self, cache=None, config=None, inspections=None,
+                 user=None):
+        self.inspections = inspections or InspectionCache()
+        self.metadata = Metadata(self.inspections)
+        self.cache = cache or LayerCache()
+        # probe configuration cached results are valid for
+        self.config = config
+        # user the probes run as instead of the user of the image, if any
+        self.user = user
+
+    def config_of(self, image):
+        """
+        Configuration results of given image are cached with: the probe
+        configuration and the image config the probes depend on
+        """
+        config = self.inspections.inspect_image(image).get("Config") or {}
+        env = dict(var.split("=", 1) for var in config.get("Env") or []
+                   if "=" in var)
+        return {"probes": self.config,
+                "env": dict((name, env.get(name))
+                            for name in IMAGE_CONFIG_ENV),
+                "user": self.user or config.get("User") or ""}
+
+    def layer_chain(self, image):
+        """
+        Layers of given image from base layer up, as dicts of the "key"
+        their results are cached by and a function returning their
+        "upper_dir". Layers are keyed by chain ID, or by image ID on
+        docker versions not reporting the RootFS of images.
+        """
+        inspection = self.inspections.inspect_image(image)
+        diff_ids = (inspection.get("RootFS") or {}).get("Layers")
+        if diff_ids:
+            driver = (inspection.get("GraphDriver") or {}).get("Name")
+            return [{"key": chain_id,
+                     "upper_dir": lambda c=chain_id:
+                     self.upper_dir_of_chain(c, driver)}
+                    for chain_id in chain_ids(diff_ids)]
+        return [{"key": layer_id,
+                 "upper_dir": lambda l=layer_id: self.upper_dir_of_layer(l)}
+                for layer_id in reversed(self.layer_ids(image))]
+
+    def layer_ids(self, image):
+        """
+        Ids of layers of given image, from top layer to base image
+        """
+        all_layers = self.metadata.find_all_layers(image)
+        return [all_layers[n]["Id"] for n in sorted(all_layers.keys())]
+
+    def upper_dir_of_chain(self, chain_id, driver):
+        """
+        Directory holding the files added or changed by the top layer of
+        given chain ID, None if the storage driver does not expose it
+        """
+        if driver not in ("overlay", "overlay2"):
+            return None
+        cache_id = os.path.join(constants.DOCKER_ROOT, "image", driver,
+                                "layerdb", "sha256",
+                                chain_id.replace("sha256:", ""), "cache-id")
+        try:
+            with open(cache_id) as fin:
+                upper_dir = os.path.join(constants.DOCKER_ROOT, driver,
+                                         fin.read().strip(), "diff")
+        except IOError:
+            return None
+        if os.path.isdir(upper_dir):
+            return upper_dir
+        return None
+
+    def upper_dir_of_layer(self, layer_id):
+        """
+        Directory holding the files added or changed by given layer,
+        None if the storage driver does not expose it
+        """
+        graph_driver = self.inspections.inspect_image(layer_id).get(
+            "GraphDriver", {})
+        if graph_driver.get("Name") not in ("overlay", "overlay2"):
+            return None
+        upper_dir = (graph_driver.get("Data") or {}).get("UpperDir")
+        if upper_dir and os.path.isdir(upper_dir):
+            return upper_dir
+        return None
+
+    def is_opaque(self, path):
+        """
+        Check if directory at given path replaces the directory of lower
+        layers
+        """
+        return any(lgetxattr(path, name) == "y" for name in OPAQUE_XATTRS)
+
+    def changed_files_of_layer(self, upper_dir):
+        """
+        Paths added, changed or deleted by a layer, as seen in the image,
+        and directories replacing those of lower layers: everything below
+        them in lower layers is deleted
+        """
+        changed, opaque_dirs = [], []
+        for dirpath, dirnames, filenames in os.walk(upper_dir):
+            relative_dir = os.path.relpath(dirpath, upper_dir)
+            if relative_dir == ".":
+                image_dir = "/"
+            else:
+                image_dir = "/" + relative_dir
+                if self.is_opaque(dirpath):
+                    opaque_dirs.append(image_dir)
+            for name in dirnames + filenames:
+                if name == OPAQUE_WHITEOUT:
+                    opaque_dirs.append(image_dir)
+                    continue
+                if name.startswith(WHITEOUT_PREFIX):
+                    name = name[len(WHITEOUT_PREFIX):]
+                changed.append(os.path.join(image_dir, name))
+        changed.extend(opaque_dirs)
+        return changed, opaque_dirs
+
+    def find_delta(self, chain, config):
+        """
+        Find nearest layer below the top of given layer chain cached with
+        given configuration and the files changed in layers above it.
+        Returns None if there is no such layer or the changed files can
+        not be found.
+        """
+        keys = [layer["key"] for layer in chain[:-1]]
+        n, stored = self.cache.nearest(keys, config)
+        if stored is None:
+            return None
+        changed, opaque_dirs = [], []
+        for upper_layer in chain[n + 1:]:
+            upper_dir = upper_layer["upper_dir"]()
+            if upper_dir is None:
+                log.debug("No upper dir for layer %s, verifying all "
+                          "packages.", upper_layer["key"])
+                return None
+            changed_files, opaque = self.changed_files_of_layer(upper_dir)
+            changed.extend(changed_files)
+            opaque_dirs.extend(opaque)
+        return {"parent_image": keys[n],
+                "changed_files": sorted(set(changed)),
+                "opaque_dirs": sorted(set(opaque_dirs)),
+                "parent_packages": stored["packages"],
+                "parent_issues": stored["issues"],
+                }
+
+    def restore(self, image, test_dir):
+        """
+        Write the cached reports of given image in test dir, if its layer
+        chain is cached
+        """
+        top = self.layer_chain(image)[-1]["key"]
+        stored = self.cache.get(top, self.config_of(image))
+        if stored is None:
+            return False
+        for name, data in stored["reports"].items():
+            with open(os.path.join(test_dir, name), "wb") as fout:
+                fout.write(data)
+        self.cache.record("hits")
+        log.info("Reusing cached results of layer %s.", top)
+        return True
+
+    def prepare(self, image, test_dir):
+        """
+        Write the verify delta of given image in test dir, if any
+        """
+        delta = self.find_delta(self.layer_chain(image),
+                                self.config_of(image))
+        if delta is None:
+            self.cache.record("misses")
+            return False
+        self.cache.record("partial_hits")
+        log.info("Verifying packages changed since layer %s.",
+                 delta["parent_image"])
+        with open(os.path.join(test_dir, constants.VERIFY_DELTA), "wb") \
+                as fout:
+            json.dump(delta, fout)
+        return True
+
+    def read_issues(self, test_dir):
+        """
+        Read the verify issues reported in test dir
+        """
+        report = os.path.join(test_dir, constants.RPM_VERIFY_REPORT)
+        if os.path.isfile(report):
+            with open(report) as fin:
+                return json.load(fin)["rpmVa_issues"]
+        report = os.path.join(test_dir, constants.RPM_VERIFY_REPORT_LINES)
+        if os.path.isfile(report):
+            with open(report) as fin:
+                return [json.loads(line) for line in fin if line.strip()]
+        return None
+
+    def read_packages(self, test_dir):
+        """
+        Read the installed packages reported in test dir
+        """
+        report = os.path.join(test_dir, constants.PACKAGE_REPORT)
+        if not os.path.isfile(report):
+            return None
+        with open(report) as fin:
+            return sorted(json.load(fin)["Installed_Packages"].keys())
+
+    def read_reports(self, test_dir):
+        """
+        Read the probe reports in test dir as they are
+        """
+        reports = {}
+        for name in constants.PROBE_REPORTS:
+            report = os.path.join(test_dir, name)
+            if os.path.isfile(report):
+                with open(report) as fin:
+                    reports[name] = fin.read()
+        return reports
+
+    def store(self, image, test_dir):
+        """
+        Cache results of given image for images sharing or deriving from
+        its layers and remove the verify delta from test dir
+        """
+        delta = os.path.join(test_dir, constants.VERIFY_DELTA)
+        if os.path.isfile(delta):
+            os.unlink(delta)
+        issues = self.read_issues(test_dir)
+        packages = self.read_packages(test_dir)
+        if issues is None or packages is None:
+            return False
+        top = self.layer_chain(image)[-1]["key"]
+        self.cache.put(top, {"packages": packages,
+                             "issues": issues,
+                             "reports": self.read_reports(test_dir)},
+                       self.config_of(image))
+        return True
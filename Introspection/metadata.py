@@ -2,14 +2,19 @@ import json
 
 from utils import docker_version
 from inspect_tests import InspectImage
+from base_image_index import BaseImageIndex
+from inspection_cache import InspectionCache
 
 
 class Metadata(object):
     """
     Collect metadata about the image under test and test run
     """
-    def __init__(self):
-        self.inspect_image = InspectImage()
+    def __init__(self, cache=None, base_images=None):
+        self.cache = cache or InspectionCache()
+        self.inspect_image = InspectImage(self.cache)
+        # index of named images, loaded when first needed
+        self.base_images = base_images
         # later set by another method
         self.number_of_layers = 1
 
@@ -77,14 +82,24 @@ class Metadata(object):
                 "Comments": self.image_comment(inspection),
                 }
 
+    def layer_inspections(self, inspection):
+        """
+        Inspections of the layers below given image inspection, found in
+        its history and inspected at once, keyed by id
+        """
+        layer_ids = self.cache.image_history(self.image_id(inspection))
+        return dict((self.image_id(layer), layer)
+                    for layer in self.cache.inspect_images(layer_ids))
+
     def find_all_layers(self, layered_image):
         """
         Find all layers of given image
         and return the metadata of each layer
         """
+        inspection = self._image_inspection(image=layered_image)
+        layers = self.layer_inspections(inspection)
         data, counter, base = {}, 0, False
         while not base:
-            inspection = self._image_inspection(image=layered_image)
             counter += 1
             data[counter] = self.collect_meta_of_layer(inspection)
             parent_id = self.parent_image_id(inspection)
@@ -92,8 +107,10 @@ class Metadata(object):
                 base = True
                 continue
             else:
-                # now trace back for parent detail
-                layered_image = parent_id
+                # now trace back for parent detail, parents missing
+                # from history are inspected one by one
+                inspection = layers.get(parent_id) or \
+                    self._image_inspection(image=parent_id)
 
         self.number_of_layers = counter
         return data
@@ -112,6 +129,15 @@ class Metadata(object):
         layer_nos = all_layers.keys()
         return all_layers[min(layer_nos)]
 
+    def known_base_image(self, image):
+        """
+        Find the nearest named image the given image derives from
+        """
+        if self.base_images is None:
+            self.base_images = BaseImageIndex(self.cache)
+        self.base_images.update()
+        return self.base_images.lookup(self._image_inspection(image))
+
     def _run(self, image):
         """
         Run the image metadata test and return data in JSON format
@@ -122,6 +148,7 @@ class Metadata(object):
                 "top_layer": self.top_layer_of_layered_image(all_layers),
                 "base_image": self.base_image_of_layered_image(all_layers),
                 "all_layers": all_layers,
+                "known_base_image": self.known_base_image(image),
                 "DockerVersion_of_test_run_host":
                 self.docker_version_of_test_run_host(),
                 }
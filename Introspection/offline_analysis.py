@@ -0,0 +1,647 @@
+import hashlib
+import json
+import logging
+import os
+import stat
+import tarfile
+import tempfile
+
+from cStringIO import StringIO
+from shutil import copyfileobj, rmtree
+
+import constants
+import introexceptions
+
+from dockerutils import get_docker_utils
+from image_archive import ImageArchive, MANIFEST, OCI_INDEX, LEGACY_LAYER, \
+    OCI_BLOBS_DIR
+from package_tests import BINARIES_DIRECTORIES
+from rpm_verify_tests import RPMVerifyTest, NativeVerifier, DIGEST_ALGOS
+from rpmdb_utils import RPMDBUtils
+
+log = logging.getLogger("offline_analysis")
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+# rpmdb locations, older and usrmerged distributions
+RPMDB_DIRS = ["/var/lib/rpm", "/usr/lib/sysimage/rpm"]
+PASSWD = "/etc/passwd"
+GROUP = "/etc/group"
+
+# archive members other than layers kept in memory, like image config
+SMALL_MEMBER_SIZE = 1024 * 1024
+MAX_SYMLINK_DEPTH = 40
+CHUNK_SIZE = 1 << 16
+# probes whose reports are produced without container
+OFFLINE_PROBES = ["package_tests", "rpm_verify_tests"]
+
+TAR_FILE_TYPES = {tarfile.REGTYPE: stat.S_IFREG,
+                  tarfile.AREGTYPE: stat.S_IFREG,
+                  tarfile.CONTTYPE: stat.S_IFREG,
+                  tarfile.LNKTYPE: stat.S_IFREG,
+                  tarfile.DIRTYPE: stat.S_IFDIR,
+                  tarfile.SYMTYPE: stat.S_IFLNK,
+                  tarfile.CHRTYPE: stat.S_IFCHR,
+                  tarfile.BLKTYPE: stat.S_IFBLK,
+                  tarfile.FIFOTYPE: stat.S_IFIFO,
+                  }
+
+
+def image_path(name):
+    """
+    Path in image of given layer member name
+    """
+    path = os.path.normpath("/" + name)
+    # normpath keeps a leading "//"
+    return "/" + path.lstrip("/")
+
+
+class VFSStat(object):
+    """
+    Attributes of a file in image, as lstat reports them, along with
+    symlink target, digests and captured content
+    """
+    __slots__ = ["st_mode", "st_size", "st_uid", "st_gid", "st_mtime",
+                 "st_rdev", "linkname", "hardlink_to", "digests", "content"]
+
+    def __init__(self, tarinfo):
+        self.st_mode = TAR_FILE_TYPES.get(tarinfo.type, stat.S_IFREG) | \
+            (tarinfo.mode & 0o7777)
+        self.st_size = tarinfo.size if tarinfo.isreg() else 0
+        self.st_uid = tarinfo.uid
+        self.st_gid = tarinfo.gid
+        self.st_mtime = tarinfo.mtime
+        self.st_rdev = 0
+        if tarinfo.ischr() or tarinfo.isblk():
+            self.st_rdev = os.makedev(tarinfo.devmajor, tarinfo.devminor)
+        self.linkname = tarinfo.linkname if tarinfo.issym() else None
+        self.hardlink_to = image_path(tarinfo.linkname) \
+            if tarinfo.islnk() else None
+        self.digests = {}
+        self.content = None
+
+    def link_to(self, target):
+        """
+        Take data of hardlink target
+        """
+        self.st_mode = target.st_mode
+        self.st_size = target.st_size
+        self.digests = target.digests
+        self.content = target.content
+
+
+class LayerIndex(object):
+    """
+    Entries and whiteouts of a single layer, read from its tar stream
+    """
+    def __init__(self, capture_dir):
+        self.capture_dir = capture_dir
+        # in tar order, so hardlinks follow their targets
+        self.entries = []
+        self.whiteouts = []
+        self.opaque_dirs = []
+
+    def is_captured(self, path):
+        """
+        Check if content of given path is needed after reading the layers
+        """
+        if path in (PASSWD, GROUP):
+            return True
+        return any(path.startswith(rpmdb_dir + "/")
+                   for rpmdb_dir in RPMDB_DIRS)
+
+    def read_content(self, tar, member, path, entry):
+        """
+        Keep content of regular file if it is captured
+        """
+        if not self.is_captured(path):
+            return
+        entry.content = os.path.join(self.capture_dir, path.lstrip("/"))
+        if not os.path.isdir(os.path.dirname(entry.content)):
+            os.makedirs(os.path.dirname(entry.content))
+        with open(entry.content, "wb") as fout:
+            copyfileobj(tar.extractfile(member), fout, CHUNK_SIZE)
+
+    def read(self, tar):
+        """
+        Index members of given layer tarfile, read as a stream
+        """
+        for member in tar:
+            path = image_path(member.name)
+            dirname, basename = os.path.split(path)
+            if basename == OPAQUE_WHITEOUT:
+                self.opaque_dirs.append(dirname)
+                continue
+            if basename.startswith(WHITEOUT_PREFIX):
+                self.whiteouts.append(
+                    os.path.join(dirname, basename[len(WHITEOUT_PREFIX):]))
+                continue
+            entry = VFSStat(member)
+            if member.isreg():
+                self.read_content(tar, member, path, entry)
+            self.entries.append((path, entry))
+        return self
+
+
+class VirtualFS(object):
+    """
+    Filesystem of image made from its layer indexes, nothing is written to
+    disk except captured file contents
+    """
+    def __init__(self):
+        self.entries = {}
+        self.children = {}
+
+    def remove_tree(self, path, keep_top=False):
+        """
+        Remove path and everything below it, only what is below it with
+        keep_top
+        """
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            stack.extend(self.children.pop(current, ()))
+            if current != path or not keep_top:
+                self.entries.pop(current, None)
+                parent = self.children.get(os.path.dirname(current))
+                if parent is not None:
+                    parent.discard(current)
+
+    def add(self, path, entry):
+        """
+        Add or replace entry, a directory replaced by another type loses
+        its contents
+        """
+        previous = self.entries.get(path)
+        if previous is not None and stat.S_ISDIR(previous.st_mode) and \
+                not stat.S_ISDIR(entry.st_mode):
+            self.remove_tree(path, keep_top=True)
+        if entry.hardlink_to is not None:
+            target = self.entries.get(entry.hardlink_to)
+            if target is not None:
+                entry.link_to(target)
+        self.entries[path] = entry
+        # link path in its parents, layers need not have entries of
+        # the directories they add files in
+        while path != "/":
+            parent = os.path.dirname(path)
+            siblings = self.children.setdefault(parent, set())
+            if path in siblings:
+                break
+            siblings.add(path)
+            path = parent
+
+    def apply(self, layer):
+        """
+        Apply layer on top of the layers applied so far, whiteouts of a
+        layer hide files of lower layers only
+        """
+        for directory in layer.opaque_dirs:
+            self.remove_tree(directory, keep_top=True)
+        for path in layer.whiteouts:
+            self.remove_tree(path)
+        for path, entry in layer.entries:
+            self.add(path, entry)
+
+    def realpath(self, path, depth=0):
+        """
+        Resolve symlinks in every component of given path
+        """
+        resolved = "/"
+        for name in path.strip("/").split("/"):
+            if not name or name == ".":
+                continue
+            if name == "..":
+                resolved = os.path.dirname(resolved)
+                continue
+            current = os.path.join(resolved, name)
+            entry = self.entries.get(current)
+            if entry is None or entry.linkname is None:
+                resolved = current
+                continue
+            if depth >= MAX_SYMLINK_DEPTH:
+                return current
+            target = entry.linkname
+            if not target.startswith("/"):
+                target = os.path.join(resolved, target)
+            resolved = self.realpath(target, depth + 1)
+        return resolved
+
+    def lstat(self, path):
+        """
+        Entry of given path, symlinks resolved in its directories only
+        """
+        dirname, basename = os.path.split(path)
+        return self.entries.get(os.path.join(self.realpath(dirname),
+                                             basename))
+
+    def is_directory(self, path):
+        """
+        Whether given path resolves to a directory, symlinks followed
+        """
+        path = self.realpath(path)
+        entry = self.entries.get(path)
+        if entry is None:
+            # directories without entry hold files of a layer only
+            return path in self.children
+        return stat.S_ISDIR(entry.st_mode)
+
+    def files_below(self, directory):
+        """
+        All paths below given directory which are not directories. As in
+        the walk of binaries directories in a container, symlinks to
+        directories are neither followed nor listed.
+        """
+        files = []
+        stack = [directory]
+        while stack:
+            for path in self.children.get(stack.pop(), ()):
+                entry = self.entries.get(path)
+                if entry is None or stat.S_ISDIR(entry.st_mode):
+                    stack.append(path)
+                elif entry.linkname is None or not self.is_directory(path):
+                    files.append(path)
+        return files
+
+    def read_file(self, path):
+        """
+        Captured content of given file, None if it is not captured
+        """
+        entry = self.lstat(self.realpath(path))
+        if entry is None or entry.content is None:
+            return None
+        with open(entry.content) as fin:
+            return fin.read()
+
+    def extract_directory(self, directory, destination):
+        """
+        Copy captured contents of files in directory to destination
+        """
+        directory = self.realpath(directory)
+        count = 0
+        for path in self.files_below(directory):
+            entry = self.entries[path]
+            if entry.content is None:
+                continue
+            target = os.path.join(destination,
+                                  os.path.relpath(path, directory))
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            with open(entry.content, "rb") as fin:
+                with open(target, "wb") as fout:
+                    copyfileobj(fin, fout)
+            count += 1
+        return count
+
+
+class OfflineVerifier(NativeVerifier):
+    """
+    NativeVerifier reading files from the virtual filesystem of image
+    """
+    def __init__(self, vfs, rpmdb, mode="fast", digest_paths=None):
+        NativeVerifier.__init__(self, rpmdb, mode, digest_paths)
+        self.vfs = vfs
+        self.user_names = self.names_of_ids(vfs.read_file(PASSWD))
+        self.group_names = self.names_of_ids(vfs.read_file(GROUP))
+
+    def names_of_ids(self, data):
+        """
+        Map ids to names from passwd or group file content
+        """
+        names = {}
+        for line in (data or "").splitlines():
+            fields = line.split(":")
+            if len(fields) > 2 and fields[2].isdigit():
+                names.setdefault(int(fields[2]), fields[0])
+        return names
+
+    def lstat(self, filepath):
+        return self.vfs.lstat(filepath)
+
+    def readlink(self, filepath):
+        entry = self.vfs.lstat(filepath)
+        if entry is None:
+            return None
+        return entry.linkname
+
+    def file_digest(self, filepath, algo):
+        entry = self.vfs.lstat(filepath)
+        if entry is None:
+            return None
+        return entry.digests.get(DIGEST_ALGOS.get(algo, "md5"))
+
+    def user_name(self, uid):
+        return self.user_names.get(uid)
+
+    def group_name(self, gid):
+        return self.group_names.get(gid)
+
+
+class OfflineAnalysis(object):
+    """
+    Analyse an image from its `docker save` archive without running it,
+    or from the archive streamed by `docker save` of a local image. Layers
+    are read as streams in a single pass over the archive and applied into
+    a virtual filesystem, rpmdb is read from the files captured from it.
+    In "full" verify mode the archive is read a second time to digest the
+    files left in image, with the algorithms its packages use only.
+    Produces the reports of the in-container probes given, all of them by
+    default.
+    """
+    def __init__(self, archive_path=None, verify_mode="fast",
+                 digest_paths=None, workers=1, image=None, probes=None):
+        self.archive = ImageArchive(archive_path)
+        if probes is None:
+            probes = OFFLINE_PROBES
+        for name in probes:
+            if name not in OFFLINE_PROBES:
+                log.info("Probe %s is not run without container.", name)
+        self.probes = [name for name in OFFLINE_PROBES if name in probes]
+        self.image = image
+        # archive or image, named in errors
+        self.source = archive_path or image
+        if verify_mode not in ("fast", "full"):
+            log.info("rpm -V can not run without container, verifying "
+                     "in fast mode.")
+            verify_mode = "fast"
+        self.verify_mode = verify_mode
+        self.digest_paths = digest_paths
+        self.workers = workers
+        self.work_dir = None
+
+    def is_layer(self, name, member):
+        return member.isfile() and (
+            os.path.basename(name) == LEGACY_LAYER or
+            name.startswith(OCI_BLOBS_DIR))
+
+    def open_layer(self, fileobj):
+        """
+        Tar stream of layer read from given file object, it may be
+        compressed. None if it is not a tar stream, like OCI blobs of
+        manifests and configs.
+        """
+        try:
+            return tarfile.open(fileobj=fileobj, mode="r|*")
+        except tarfile.ReadError:
+            return None
+
+    def read_layer(self, fileobj, name):
+        """
+        Index a layer read from given file object, None if it is not
+        a layer
+        """
+        capture_dir = os.path.join(self.work_dir, "layers",
+                                   name.replace("/", "_"))
+        layer_tar = self.open_layer(fileobj)
+        if layer_tar is None:
+            return None
+        return LayerIndex(capture_dir).read(layer_tar)
+
+    def read_source(self, consume):
+        """
+        Call consume with the tar stream of archive, decompressed, or of
+        `docker save` of image. Returns what consume returns.
+        """
+        if self.image is not None:
+            return get_docker_utils().save_image_stream(self.image, consume)
+        source = self.archive.open_decompressed()
+        try:
+            return consume(source)
+        finally:
+            source.close()
+
+    def read_archive(self):
+        """
+        Read archive once, indexing its layers in whatever order they come.
+        Returns the layer indexes and the small members, like manifests and
+        image config, keyed by member name.
+        """
+        return self.read_source(self.read_members)
+
+    def read_members(self, source):
+        """
+        Index layers and keep small members of given tar stream
+        """
+        layers, members = {}, {}
+        try:
+            tar = tarfile.open(fileobj=source, mode="r|")
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = self.archive.member_name(member)
+                if member.size <= SMALL_MEMBER_SIZE:
+                    members[name] = tar.extractfile(member).read()
+                    fileobj = StringIO(members[name])
+                else:
+                    fileobj = tar.extractfile(member)
+                if self.is_layer(name, member):
+                    layer = self.read_layer(fileobj, name)
+                    if layer is not None:
+                        layers[name] = layer
+        except (tarfile.TarError, IOError, EOFError) as e:
+            msg = "tar/gz file: %s \n %s" % (self.source, e)
+            raise introexceptions.InvalidTarFileImage(msg)
+        return layers, members
+
+    def digest_algos(self, rpmdb):
+        """
+        Names of digest algorithms files of installed packages are
+        recorded with
+        """
+        return sorted(set(DIGEST_ALGOS.get(algo, "md5")
+                          for algo in rpmdb.file_digest_algos()))
+
+    def digest_files(self, vfs, layers, algos):
+        """
+        Digest regular files left in image with given algorithms, reading
+        the archive again. Files replaced or removed by upper layers are
+        not digested.
+        """
+        # hardlinks share the digests of their target
+        wanted = set(id(entry.digests) for entry in vfs.entries.itervalues()
+                     if stat.S_ISREG(entry.st_mode))
+        self.read_source(
+            lambda source: self.digest_members(source, layers, wanted, algos))
+
+    def digest_members(self, source, layers, wanted, algos):
+        """
+        Digest wanted files of the indexed layers of given tar stream
+        """
+        try:
+            tar = tarfile.open(fileobj=source, mode="r|")
+            for member in tar:
+                name = self.archive.member_name(member)
+                if not member.isfile() or name not in layers:
+                    continue
+                layer_tar = self.open_layer(tar.extractfile(member))
+                entries = dict(layers[name].entries)
+                for layer_member in layer_tar:
+                    if not layer_member.isreg():
+                        continue
+                    entry = entries.get(image_path(layer_member.name))
+                    if entry is None or id(entry.digests) not in wanted:
+                        continue
+                    digests = [hashlib.new(algo) for algo in algos]
+                    fin = layer_tar.extractfile(layer_member)
+                    for chunk in iter(lambda: fin.read(CHUNK_SIZE), ""):
+                        for digest in digests:
+                            digest.update(chunk)
+                    entry.digests.update(
+                        (algo, digest.hexdigest())
+                        for algo, digest in zip(algos, digests))
+        except (tarfile.TarError, IOError, EOFError) as e:
+            msg = "tar/gz file: %s \n %s" % (self.source, e)
+            raise introexceptions.InvalidTarFileImage(msg)
+
+    def image_manifest(self, members):
+        """
+        Config and layers of image, from manifest.json or OCI index
+        """
+        if MANIFEST in members:
+            manifest = json.loads(members[MANIFEST])
+        elif OCI_INDEX in members:
+            index = json.loads(members[OCI_INDEX])
+            manifest = []
+            for descriptor in index.get("manifests") or []:
+                blob = members.get(
+                    self.archive.blob_path(descriptor["digest"]))
+                if blob is None:
+                    continue
+                image_manifest = json.loads(blob)
+                manifest.append({
+                    "Config": self.archive.blob_path(
+                        image_manifest["config"]["digest"]),
+                    "Layers": [self.archive.blob_path(layer["digest"])
+                               for layer in image_manifest["layers"]],
+                    })
+        else:
+            manifest = []
+        if not manifest:
+            msg = "tar/gz file: %s has no image manifest" % self.source
+            raise introexceptions.InvalidTarFileImage(msg)
+        if len(manifest) > 1:
+            log.warning("Archive has %d images, analysing the first one.",
+                        len(manifest))
+        return manifest[0]
+
+    def image_env(self, config):
+        """
+        Environment of image from its config
+        """
+        env = {}
+        container_config = config.get("config") or \
+            config.get("container_config") or {}
+        for item in container_config.get("Env") or []:
+            key, _, value = item.partition("=")
+            env[key] = value
+        return env
+
+    def build_vfs(self):
+        """
+        Read archive and apply its layers from base layer up. Returns the
+        virtual filesystem, environment of image and layer indexes.
+        """
+        layers, members = self.read_archive()
+        manifest = self.image_manifest(members)
+        vfs = VirtualFS()
+        for name in manifest["Layers"]:
+            if layers.get(name) is None:
+                msg = "tar/gz file: %s has no layer %s" % \
+                    (self.source, name)
+                raise introexceptions.InvalidTarFileImage(msg)
+            vfs.apply(layers[name])
+        config = {}
+        if manifest.get("Config") in members:
+            config = json.loads(members[manifest["Config"]])
+        return vfs, self.image_env(config), layers
+
+    def extract_rpmdb(self, vfs):
+        """
+        Copy rpmdb of image out of the virtual filesystem, returns its path
+        """
+        dbpath = os.path.join(self.work_dir, "rpmdb")
+        for rpmdb_dir in reversed(RPMDB_DIRS):
+            if vfs.extract_directory(rpmdb_dir, dbpath):
+                return dbpath
+        msg = "No rpmdb found in image archive: %s" % self.source
+        raise introexceptions.InvalidTarFileImage(msg)
+
+    def binaries_directories(self, env):
+        """
+        Directories of binaries and libraries, with PATH and
+        LD_LIBRARY_PATH of image
+        """
+        dirs = list(BINARIES_DIRECTORIES)
+        dirs.extend(env.get("PATH", "").split(":"))
+        dirs.extend(env.get("LD_LIBRARY_PATH", "").split(":"))
+        return set(d for d in dirs if d)
+
+    def find_adhoc_files(self, vfs, rpmdb, env):
+        """
+        Files in binaries directories of image not owned by any package
+        """
+        roots = sorted(set(vfs.realpath(d)
+                           for d in self.binaries_directories(env)))
+        walk_roots = []
+        for root in roots:
+            if not any(root.startswith(parent.rstrip("/") + "/")
+                       for parent in walk_roots):
+                walk_roots.append(root)
+        owned_files = rpmdb.owned_files()
+        adhoc = []
+        for root in walk_roots:
+            for path in vfs.files_below(root):
+                dirname, basename = os.path.split(path)
+                if path in owned_files or os.path.join(
+                        vfs.realpath(dirname), basename) in owned_files:
+                    continue
+                adhoc.append(path)
+        return sorted(adhoc)
+
+    def export(self, data, path):
+        with open(path, "wb") as fout:
+            json.dump(data, fout)
+
+    def run(self, output_dir, json_lines=False):
+        """
+        Analyse image and write PackageTests.json and AdhocFiles.json of
+        package_tests, RPMVerifyTest.json (or .jsonl) of rpm_verify_tests
+        in output_dir, for the probes selected
+        """
+        if not self.probes:
+            log.info("No probe to run without container.")
+            return output_dir
+        self.work_dir = tempfile.mkdtemp(prefix="introspection_offline_")
+        try:
+            vfs, env, layers = self.build_vfs()
+            rpmdb = RPMDBUtils(dbpath=self.extract_rpmdb(vfs))
+            if "package_tests" in self.probes:
+                self.export({"Installed_Packages":
+                             rpmdb.installed_packages_data()},
+                            os.path.join(output_dir,
+                                         constants.PACKAGE_REPORT))
+                self.export({"Adhoc_files":
+                             self.find_adhoc_files(vfs, rpmdb, env)},
+                            os.path.join(output_dir, constants.ADHOC_REPORT))
+            if "rpm_verify_tests" in self.probes:
+                if self.verify_mode == "full":
+                    self.digest_files(vfs, layers, self.digest_algos(rpmdb))
+                verifier = OfflineVerifier(vfs, rpmdb, self.verify_mode,
+                                           self.digest_paths)
+                verify_test = RPMVerifyTest(workers=self.workers,
+                                            mode=self.verify_mode,
+                                            digest_paths=self.digest_paths,
+                                            rpmdb=rpmdb,
+                                            native_verifier=verifier)
+                if json_lines:
+                    report = constants.RPM_VERIFY_REPORT_LINES
+                else:
+                    report = constants.RPM_VERIFY_REPORT
+                verify_test.run(output_file=os.path.join(output_dir, report),
+                                json_lines=json_lines)
+        finally:
+            rmtree(self.work_dir, ignore_errors=True)
+            self.work_dir = None
+        return output_dir
+
@@ -1,75 +1,65 @@
 import os
 import stat
-import rpm
 import json
-from subprocess import Popen, PIPE
-from struct import unpack
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # backport for python versions older than 3.5
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from rpmdb_utils import RPMDBUtils
 
 # container specific
 SHARED_DIR_PARENT = "/var/tmp/container_introspection/"
 
+# threads scanning the binaries directories
+WALKER_THREADS = 8
+
+ADHOC_REPORT = "AdhocFiles.json"
+
+# standard paths of binaries and libraries of a linux system
+BINARIES_DIRECTORIES = ["/bin",
+                        "/usr/bin",
+                        "/usr/local/bin",
+                        "/sbin",
+                        "/usr/sbin",
+                        "/usr/local/sbin",
+                        "/lib",
+                        "/lib64",
+                        "/usr/lib",
+                        "/usr/lib64",
+                        "/usr/local/lib",
+                        "/usr/local/lib64",
+                        "/usr/libexec",
+                        "/usr/local/libexec",
+                        "/opt",
+                        "/usr/opt",
+                        "/usr/local/opt",
+                        ]
+
 
 class PackageTests(object):
     """
     Package tests for container
     """
-    def __init__(self):
+    def __init__(self, rpmdb=None):
         self.bin_dirs = self.binaries_directories()
-
-    def split_rpm_nvra(self, name):
-        """
-        split_rpm_nvra: splits the given rpm NVRA into a dictionary of fields
-        like; name, version, release, epoch, and architecture.
-        """
-        if not name:
-            return None
-
-        rfields = {}
-
-        n = name.rfind(".")
-        rfields["ARCH"] = name[n + 1:]
-        name = name[:n]         # strip off "i386/i686/x86_64/.src" part
-
-        n = name.rfind("-")
-        rfields["RELEASE"] = name[n + 1:]
-        name = name[:n]         # strip off rpm release
-
-        n = name.rfind("-")
-        rfields["VERSION"] = name[n + 1:]
-        name = name[:n]         # strip off rpm version
-
-        epoch = None
-        n = name.find(":")
-        if (n >= 0):
-            epoch = name[:n]
-        rfields["EPOCH"] = epoch
-
-        rfields["NAME"] = name[n + 1:]
-
-        return rfields
+        self.rpmdb = rpmdb or RPMDBUtils()
+        # files in binaries directories, scanned once for all tests
+        self._binaries_libs = None
+        self._binaries_libs_lock = Lock()
 
     def binaries_directories(self):
         """
         Return all directories path where binaries present
         """
-        dirs = ["/bin",
-                "/usr/bin",
-                "/usr/local/bin",
-                "/sbin",
-                "/usr/sbin",
-                "/usr/local/sbin",
-                "/lib",
-                "/lib64",
-                "/usr/lib",
-                "/usr/lib64",
-                "/usr/local/lib",
-                "/usr/local/lib64",
-                "/usr/libexec",
-                "/usr/local/libexec",
-                "/opt",
-                "/usr/opt",
-                "/usr/local/opt",
-                ]
+        dirs = list(BINARIES_DIRECTORIES)
 
         # extend with the paths in the PATH variable
         dirs.extend(os.environ["PATH"].split(":"))
@@ -78,137 +68,170 @@ class PackageTests(object):
             dirs.extend(os.environ["LD_LIBRARY_PATH"].split(":"))
         return list(set(dirs))
 
-    def get_binaries_inside_directory(self, directory):
-        """
-        Get all binaries present inside given directory,
-        find all binaries present in subdirectories as well.
-        """
-        files = []
-        for dirpath, dirname, filenames in os.walk(directory, topdown=False):
-            for fn in filenames:
-                files.append(os.path.join(dirpath, fn))
-        return files
-
-    def get_installed_packages(self):
-        """
-        Get all installed packages in system
-        """
-        ts = rpm.TransactionSet()
-        mi = ts.dbMatch()
-        return [hdr[rpm.RPMTAG_NVRA] for hdr in mi]
-
-    def get_installed_files(self, pkg):
-        """
-        Get all installed files by given installed rpm
-        """
-        rpm_name = self.split_rpm_nvra(pkg)["NAME"]
-        ts = rpm.TransactionSet()
-        for hdr in ts.dbMatch("name", rpm_name):
-            return hdr[rpm.RPMTAG_FILENAMES]
-
-    def get_signature_of_give_package(self, pkg):
-        """
-        Get GPG key of given installed pkg
-        """
-        cmd = ["/bin/rpm", "-q", "--qf", "%{SIGPGP:pgpsig}", pkg]
-        return Popen(cmd, stdout=PIPE).stdout.read().strip()
-
-    def match_bin_with_pkg(self, binary):
-        """
-        Match given binary to its RPM package
-        """
-        cmd = ["/bin/rpm", "-qf", binary]
-        pkgs = Popen(cmd, stdout=PIPE).stdout.read().strip()
-        if " " in pkgs:
-            return None
-        else:
-            return pkgs.split("\n")
-
-    def get_meta_of_pkg(self, pkg):
-        """
-        Get metadata of given installed package.
-        Metadata captured: SIGPGP, VENDOR, PACKAGER, BUILDHOST
-        """
-        qf = "%{SIGPGP:pgpsig}|%{VENDOR}|%{PACKAGER}|%{BUILDHOST}"
-        cmd = ["/bin/rpm", "-q", "--qf", qf, pkg]
-        return Popen(cmd, stdout=PIPE).stdout.read().split("|")
-
-    def requires_of_installed_pkg(self, pkg):
-        """
-        Obtain requires of installed_package
-        """
-        cmd = ["/bin/rpm", "-q", "--requires", pkg]
-        out = Popen(cmd, stdout=PIPE).stdout.read()
-        return list(set(out.split("\n")[:-1]))
-
     def get_all_binaries_libs(self):
         """
         Run the list of all libraries and binaries in standard
-        path of a linux system along with paths added LD_LIBRARY_PATH
-        """
-        bins = []
-        for directory in self.bin_dirs:
-            bins += self.get_binaries_inside_directory(directory)
-        return bins
+        path of a linux system along with paths added LD_LIBRARY_PATH.
+        Directories are scanned once, concurrent callers share the scan.
+        """
+        with self._binaries_libs_lock:
+            if self._binaries_libs is None:
+                self._binaries_libs = self.scan_binaries_libs()
+        return self._binaries_libs
+
+    def scan_binaries_libs(self):
+        """
+        Scan binaries directories for all files in them. Files are listed
+        under their resolved root, a file of a symlinked root is listed
+        once under the root's target, not under the symlink.
+        """
+        roots = self.walk_roots()
+        seen = set()
+        frontier = []
+        for root in roots:
+            try:
+                st = os.stat(root)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                frontier.append(root)
 
-    def find_adhoc_bins_libs(self, installed_packages=[]):
+        bins = []
+        pool = ThreadPool(WALKER_THREADS)
+        try:
+            # scan one level of directories at a time across the pool,
+            # subdirectories already seen by inode are not scanned again
+            while frontier:
+                next_frontier = []
+                for files, subdirs in pool.imap_unordered(
+                        self.scan_directory, frontier):
+                    bins.extend(files)
+                    for subdir, inode in subdirs:
+                        if inode not in seen:
+                            seen.add(inode)
+                            next_frontier.append(subdir)
+                frontier = next_frontier
+        finally:
+            pool.close()
+            pool.join()
+        return sorted(bins)
+
+    def walk_roots(self):
+        """
+        Resolve binaries directories to real paths and drop those nested in
+        another one, so that no tree is walked twice. A root which is a
+        symlink to a directory (like /lib64 on usrmerge systems) is walked
+        as its target.
+        """
+        roots = sorted(set(os.path.realpath(directory)
+                           for directory in self.bin_dirs if directory))
+        walk_roots = []
+        for root in roots:
+            if any(root.startswith(parent.rstrip("/") + "/")
+                   for parent in walk_roots):
+                continue
+            walk_roots.append(root)
+        return walk_roots
+
+    def scan_directory(self, directory):
+        """
+        List a single directory, returns the files in it and the
+        subdirectories to descend into along with their (st_dev, st_ino).
+        Like os.walk below its top directory, symlinks to directories
+        are not descended into, and unlike os.walk they are not listed
+        at all.
+        """
+        files, subdirs = [], []
+        try:
+            if scandir is not None:
+                entries = [(entry.path, entry) for entry in scandir(directory)]
+            else:
+                entries = [(os.path.join(directory, name), None)
+                           for name in os.listdir(directory)]
+        except OSError:
+            return files, subdirs
+
+        for path, entry in entries:
+            try:
+                if entry is not None:
+                    is_dir = entry.is_dir()
+                else:
+                    is_dir = os.path.isdir(path)
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(path)
+                continue
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISLNK(st.st_mode):
+                subdirs.append((path, (st.st_dev, st.st_ino)))
+        return files, subdirs
+
+    def is_owned_by_package(self, filepath, owned_files, real_dirs):
+        """
+        Check if given file is owned by any installed package. Files found
+        through a symlinked directory (like /lib64 on usrmerge systems) are
+        looked up by their resolved directory as well.
+        """
+        if filepath in owned_files:
+            return True
+        dirname, basename = os.path.split(filepath)
+        if dirname not in real_dirs:
+            real_dirs[dirname] = os.path.realpath(dirname)
+        real_dir = real_dirs[dirname]
+        if real_dir == dirname:
+            return False
+        return os.path.join(real_dir, basename) in owned_files
+
+    def find_adhoc_bins_libs(self):
         """
         Diffs the libraries and binaries present in standard path
         along with paths in the LD_LIBRARY_PATH to the installed files
         via RPMs and returns the files which are not installed in system
         via RPM packages
         """
-        bins = self.get_all_binaries_libs()
-        if not installed_packages:
-            installed_packages = self.get_installed_packages()
-        for package in installed_packages:
-            # removes the files from all `bins` variable which are
-            # installed by RPM
-            print len(bins)
-            bins = list(set(bins) - set(self.get_installed_files(package)))
-
-        return [b for b in bins if not self.match_bin_with_pkg(b)]
+        owned_files = self.rpmdb.owned_files()
+        real_dirs = {}
+        return [b for b in set(self.get_all_binaries_libs())
+                if not self.is_owned_by_package(b, owned_files, real_dirs)]
 
     def run(self):
         """
         Run tests and gather all test data JSON format
         """
-        installed_packages = self.get_installed_packages()
-        installed_packages_data = {}
-        for package in installed_packages:
-            metadata = self.get_meta_of_pkg(package)
-            info = {"SIGNATURE": metadata[0],
-                    "VENDOR": metadata[1],
-                    "PACKAGER": metadata[2],
-                    "BUILD_HOST": metadata[3],
-                    "REQUIRES": self.requires_of_installed_pkg(package)
-                    }
-            installed_packages_data[package] = info
+        # metadata and requires of all packages are read in the same
+        # pass over rpmdb headers, no `rpm -q` process per package
+        installed_packages_data = self.rpmdb.installed_packages_data()
 
         return {"Installed_Packages": installed_packages_data,
-                "Adhoc_bins_libs": self.find_adhoc_bins_libs(
-                    installed_packages)
+                "Adhoc_bins_libs": self.find_adhoc_bins_libs()
                 }
 
+    def export(self, data, shared_dir=SHARED_DIR_PARENT):
+        """
+        Export the adhoc files and the package reports in shared dir
+        """
+        bins_data_file_path = os.path.join(shared_dir, ADHOC_REPORT)
 
-if __name__ == "__main__":
-    pkg_tests = PackageTests()
-    data = pkg_tests.run()
+        pkg_data_file_path = os.path.join(
+            shared_dir,
+            "%s.json" % self.__class__.__name__)
 
-    bins_data_file_path = os.path.join(
-        SHARED_DIR_PARENT,
-        "AdhocFiles.json")
+        with open(bins_data_file_path, "wb") as fin:
+            json.dump(
+                    {
+                        "Adhoc_files": data.pop("Adhoc_bins_libs", [])
+                    },
+                    fin)
 
-    pkg_data_file_path = os.path.join(
-        SHARED_DIR_PARENT,
-        "%s.json" % pkg_tests.__class__.__name__)
+        with open(pkg_data_file_path, "wb") as fin:
+            json.dump(data, fin)
 
-    with open(bins_data_file_path, "wb") as fin:
-        json.dump(
-                {
-                    "Adhoc_files": data.pop("Adhoc_bins_libs", [])
-                },
-                fin)
 
-    with open(pkg_data_file_path, "wb") as fin:
-        json.dump(data, fin)
+if __name__ == "__main__":
+    pkg_tests = PackageTests()
+    pkg_tests.export(pkg_tests.run())
@@ -0,0 +1,96 @@
+import os
+import sys
+import traceback
+
+import rpm_verify_tests
+
+from elf_tests import ELFTests, ELF_PARSE_CACHE
+from package_tests import PackageTests
+from rpmdb_utils import RPMDBUtils
+from test_registry import CONTAINER, PROBES_ENV, TestRegistry, \
+    declare_container_probes
+
+# container specific
+SHARED_DIR_PARENT = "/var/tmp/container_introspection/"
+
+
+class ProbeAgent(object):
+    """
+    Run the selected probes in one interpreter inside container. The
+    rpmdb headers are read once and the binaries directories are scanned
+    once, shared by the probes running concurrently. Reports are written
+    once all probes are done.
+    """
+    def __init__(self, shared_dir=SHARED_DIR_PARENT, probes=None):
+        self.shared_dir = shared_dir
+        self.rpmdb = RPMDBUtils()
+        self.package_tests = PackageTests(rpmdb=self.rpmdb)
+        self.elf_tests = ELFTests(
+            parse_cache_file=os.path.join(shared_dir, ELF_PARSE_CACHE),
+            package_tests=self.package_tests)
+        self.registry = self.probe_registry()
+        if probes is None:
+            probes = self.registry.names(CONTAINER)
+        self.probes = probes
+        self.data = {}
+
+    def probe_registry(self):
+        """
+        Registry of probes and of the inputs they share
+        """
+        registry = TestRegistry()
+        registry.add_resource("rpmdb", self.rpmdb.owned_files)
+        registry.add_resource("file_inventory",
+                              self.package_tests.get_all_binaries_libs)
+        declare_container_probes(registry, {
+            "package_tests": self.keep("package_tests",
+                                       self.package_tests.run),
+            "elf_tests": self.keep("elf_tests", self.elf_tests.run),
+            # writes its report itself, JSON Lines while issues are found
+            "rpm_verify_tests": lambda: rpm_verify_tests.run_from_environment(
+                self.rpmdb, self.shared_dir),
+        })
+        return registry
+
+    def keep(self, name, func):
+        """
+        Function keeping result of func to be exported once all probes
+        are done
+        """
+        def run():
+            self.data[name] = func()
+        return run
+
+    def run(self):
+        """
+        Run the probes, export their reports and return the status of
+        every probe and shared input
+        """
+        scheduler = self.registry.scheduler(self.probes, CONTAINER)
+        try:
+            scheduler.run()
+        except Exception:
+            sys.stderr.write(traceback.format_exc())
+        if "package_tests" in self.data:
+            self.package_tests.export(self.data["package_tests"],
+                                      self.shared_dir)
+        if "elf_tests" in self.data:
+            self.elf_tests.export(self.data["elf_tests"], self.shared_dir)
+        return scheduler.results
+
+
+if __name__ == "__main__":
+    names = [name for name in os.environ.get(PROBES_ENV, "").split(",")
+             if name]
+    # probes selected by a test runner of another version may be unknown
+    registry = TestRegistry()
+    declare_container_probes(registry)
+    known = registry.names(CONTAINER)
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        sys.stderr.write("Unknown probes are not run: %s\n" %
+                         ", ".join(unknown))
+    probes = [name for name in names if name in known] if names else None
+    results = ProbeAgent(probes=probes).run()
+    sys.exit(1 if unknown or any(result["status"] != "passed"
+                                 for result in results.values()) else 0)
@@ -1,108 +1,558 @@
 import os
+import grp
 import json
+import hashlib
+import pwd
 import re
+import stat
 
-from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+from threading import Event, Thread
+
+from executor import get_executor
+from rpmdb_utils import RPMDBUtils
 
 # container specific
 CERT_DIR_PARENT = "/var/tmp/container_introspection/"
 
+# number of concurrent rpm -V workers, verify mode and files to always
+# compare digests of (separated by ":"), set by the test runner
+VERIFY_WORKERS_ENV = "INTROSPECTION_VERIFY_WORKERS"
+VERIFY_MODE_ENV = "INTROSPECTION_VERIFY_MODE"
+VERIFY_DIGEST_PATHS_ENV = "INTROSPECTION_VERIFY_DIGEST_PATHS"
+# verify results of the parent image and files changed in the layers above
+# it, written by the test runner for incremental verification
+VERIFY_DELTA = "verify_delta.json"
+
+# "json" writes one report, "jsonl" writes issues as JSON Lines while
+# they are found
+VERIFY_OUTPUT_ENV = "INTROSPECTION_VERIFY_OUTPUT"
+
+# "rpm" runs rpm -V, "fast" and "full" verify in process from rpmdb headers
+VERIFY_MODES = ["rpm", "fast", "full"]
+# shards per worker, so that a shard of big packages does not hold the run
+SHARDS_PER_WORKER = 4
+# seconds rpm -V of all packages, or of one shard, is given
+RPM_VERIFY_TIMEOUT = 2 * 60 * 60
+
+RPMVA_LINE = re.compile(r'^([0-9A-Za-z.]+)\s+([c]{0,1})\s+(\W.*)$')
+
+# verify flags, file flags and file states as defined by rpm
+RPMVERIFY_FILEDIGEST = 1 << 0
+RPMVERIFY_FILESIZE = 1 << 1
+RPMVERIFY_LINKTO = 1 << 2
+RPMVERIFY_USER = 1 << 3
+RPMVERIFY_GROUP = 1 << 4
+RPMVERIFY_MTIME = 1 << 5
+RPMVERIFY_MODE = 1 << 6
+RPMVERIFY_RDEV = 1 << 7
+RPMVERIFY_CAPS = 1 << 8
+RPMVERIFY_READLINKFAIL = 1 << 28
+RPMVERIFY_READFAIL = 1 << 29
+
+RPMFILE_CONFIG = 1 << 0
+RPMFILE_MISSINGOK = 1 << 3
+RPMFILE_GHOST = 1 << 6
+
+RPMFILE_STATE_REPLACED = 1
+RPMFILE_STATE_NOTINSTALLED = 2
+RPMFILE_STATE_NETSHARED = 3
+RPMFILE_STATE_WRONGCOLOR = 4
+
+DIGEST_ALGOS = {1: "md5", 2: "sha1", 8: "sha256", 9: "sha384",
+                10: "sha512", 11: "sha224"}
+
+# order and characters of rpm -V result string, capabilities are not checked
+VERIFY_RESULT_CHARS = [(RPMVERIFY_FILESIZE, "S"),
+                       (RPMVERIFY_MODE, "M"),
+                       (RPMVERIFY_FILEDIGEST, "5"),
+                       (RPMVERIFY_RDEV, "D"),
+                       (RPMVERIFY_LINKTO, "L"),
+                       (RPMVERIFY_USER, "U"),
+                       (RPMVERIFY_GROUP, "G"),
+                       (RPMVERIFY_MTIME, "T"),
+                       (RPMVERIFY_CAPS, "P"),
+                       ]
+
+
+class NativeVerifier(object):
+    """
+    Verify installed files against the attributes recorded in rpmdb headers
+    without running `rpm -V`. In "fast" mode only metadata is compared, in
+    "full" mode digests are also compared for files whose metadata differs
+    and for files in digest_paths.
+    """
+    def __init__(self, rpmdb, mode="fast", digest_paths=None):
+        self.rpmdb = rpmdb
+        self.mode = mode
+        self.digest_paths = set(digest_paths or [])
+        self._user_names = {}
+        self._group_names = {}
+
+    def lstat(self, filepath):
+        """
+        lstat given file, None if it is missing
+        """
+        try:
+            return os.lstat(filepath)
+        except OSError:
+            return None
+
+    def readlink(self, filepath):
+        """
+        Target of given symlink, None if it can not be read
+        """
+        try:
+            return os.readlink(filepath)
+        except OSError:
+            return None
+
+    def file_digest(self, filepath, algo):
+        """
+        Hex digest of given file with rpm digest algorithm,
+        None if it can not be read
+        """
+        try:
+            digest = hashlib.new(DIGEST_ALGOS.get(algo, "md5"))
+            with open(filepath, "rb") as fin:
+                for chunk in iter(lambda: fin.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        except (IOError, OSError):
+            return None
+        return digest.hexdigest()
+
+    def user_name(self, uid):
+        """
+        Name of given user id
+        """
+        if uid not in self._user_names:
+            try:
+                self._user_names[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self._user_names[uid] = None
+        return self._user_names[uid]
+
+    def group_name(self, gid):
+        """
+        Name of given group id
+        """
+        if gid not in self._group_names:
+            try:
+                self._group_names[gid] = grp.getgrgid(gid).gr_name
+            except KeyError:
+                self._group_names[gid] = None
+        return self._group_names[gid]
+
+    def verify_flags(self, attrs, st):
+        """
+        Checks applicable to the file, the way rpm narrows them down by file
+        state and type
+        """
+        flags = attrs["verify_flags"] & ~RPMVERIFY_CAPS
+        if attrs["state"] == RPMFILE_STATE_REPLACED:
+            return 0
+        if attrs["state"] == RPMFILE_STATE_WRONGCOLOR:
+            flags &= ~(RPMVERIFY_FILEDIGEST | RPMVERIFY_FILESIZE |
+                       RPMVERIFY_MTIME | RPMVERIFY_RDEV)
+        if stat.S_ISDIR(st.st_mode):
+            flags &= ~(RPMVERIFY_FILEDIGEST | RPMVERIFY_FILESIZE |
+                       RPMVERIFY_MTIME | RPMVERIFY_LINKTO)
+        elif stat.S_ISLNK(st.st_mode):
+            flags &= ~(RPMVERIFY_FILEDIGEST | RPMVERIFY_FILESIZE |
+                       RPMVERIFY_MTIME | RPMVERIFY_MODE)
+        elif stat.S_ISFIFO(st.st_mode) or stat.S_ISCHR(st.st_mode) or \
+                stat.S_ISBLK(st.st_mode):
+            flags &= ~(RPMVERIFY_FILEDIGEST | RPMVERIFY_FILESIZE |
+                       RPMVERIFY_MTIME | RPMVERIFY_LINKTO)
+        else:
+            flags &= ~(RPMVERIFY_LINKTO | RPMVERIFY_RDEV)
+        return flags
+
+    def verify_file(self, attrs):
+        """
+        Verify a file, returns the rpm -V result string, "missing", or None
+        if the file is fine or not to be verified
+        """
+        if attrs["state"] in (RPMFILE_STATE_NOTINSTALLED,
+                              RPMFILE_STATE_NETSHARED):
+            return None
+        if attrs["flags"] & RPMFILE_GHOST:
+            return None
+        st = self.lstat(attrs["filename"])
+        if st is None:
+            if attrs["flags"] & RPMFILE_MISSINGOK:
+                return None
+            return "missing"
+
+        flags = self.verify_flags(attrs, st)
+        result = 0
+        if flags & RPMVERIFY_FILESIZE and st.st_size != attrs["size"]:
+            result |= RPMVERIFY_FILESIZE
+        if flags & RPMVERIFY_MODE and \
+                (st.st_mode & 0xffff) != attrs["mode"]:
+            result |= RPMVERIFY_MODE
+        if flags & RPMVERIFY_RDEV:
+            is_dev = stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode)
+            was_dev = stat.S_ISCHR(attrs["mode"]) or \
+                stat.S_ISBLK(attrs["mode"])
+            if is_dev != was_dev or \
+                    (is_dev and (st.st_rdev & 0xffff) != attrs["rdev"]):
+                result |= RPMVERIFY_RDEV
+        if flags & RPMVERIFY_LINKTO:
+            target = self.readlink(attrs["filename"])
+            if target is None:
+                result |= RPMVERIFY_READLINKFAIL
+            elif target != attrs["linkto"]:
+                result |= RPMVERIFY_LINKTO
+        if flags & RPMVERIFY_USER and \
+                self.user_name(st.st_uid) != attrs["user"]:
+            result |= RPMVERIFY_USER
+        if flags & RPMVERIFY_GROUP and \
+                self.group_name(st.st_gid) != attrs["group"]:
+            result |= RPMVERIFY_GROUP
+        if flags & RPMVERIFY_MTIME and int(st.st_mtime) != attrs["mtime"]:
+            result |= RPMVERIFY_MTIME
+        if flags & RPMVERIFY_FILEDIGEST and attrs["digest"] and \
+                self.needs_digest(attrs["filename"], result):
+            digest = self.file_digest(attrs["filename"],
+                                      attrs["digest_algo"])
+            if digest is None:
+                result |= RPMVERIFY_READFAIL
+            elif digest != attrs["digest"]:
+                result |= RPMVERIFY_FILEDIGEST
+
+        if not result:
+            return None
+        return self.result_string(result)
+
+    def needs_digest(self, filepath, result):
+        """
+        Check if digest of file is to be compared in current mode
+        """
+        if self.mode != "full":
+            return False
+        return bool(result) or filepath in self.digest_paths
+
+    def result_string(self, result):
+        """
+        Format verify result the way rpm -V prints it, like S.5....T.
+        """
+        chars = []
+        for flag, char in VERIFY_RESULT_CHARS:
+            if flag == RPMVERIFY_FILEDIGEST and result & RPMVERIFY_READFAIL:
+                chars.append("?")
+            elif flag == RPMVERIFY_LINKTO and \
+                    result & RPMVERIFY_READLINKFAIL:
+                chars.append("?")
+            elif result & flag:
+                chars.append(char)
+            else:
+                chars.append(".")
+        return "".join(chars)
+
+    def verify_packages(self, packages):
+        """
+        Verify files of given packages, returns a list of
+        (issue, filename, package) for files which are not config files
+        """
+        issues = []
+        for nvra in packages:
+            hdr = self.rpmdb.header_of_package(nvra)
+            if hdr is None:
+                continue
+            for attrs in self.rpmdb.file_attributes_of_header(hdr):
+                # the config files are not reported
+                if attrs["flags"] & RPMFILE_CONFIG:
+                    continue
+                issue = self.verify_file(attrs)
+                if issue:
+                    issues.append((issue, attrs["filename"], nvra))
+        return issues
+
 
 class RPMVerifyTest(object):
     """
     Verify installed RPMs
     """
-    def get_command(self):
+    def __init__(self, workers=1, mode="rpm", digest_paths=None,
+                 delta=None, rpmdb=None, native_verifier=None):
+        self.rpmdb = rpmdb or RPMDBUtils()
+        self.workers = max(1, workers)
+        self.mode = mode
+        self.delta = delta
+        # packages to verify, None for all
+        self.packages = None
+        # verifier of fast and full modes, one reading files of an image
+        # without container is given by offline analysis
+        self.native_verifier = native_verifier or \
+            NativeVerifier(self.rpmdb, mode, digest_paths)
+        self._meta_of_rpm = {}
+
+    def get_command(self, packages=None):
         """
-        Command to run the rpm verify test
+        Command to run the rpm verify test, for all or given packages
         """
+        if packages:
+            return ["/bin/rpm", "-V"] + packages
         return ["/bin/rpm", "-Va"]
 
-    def run_command(self, cmd):
+    def packages_to_verify(self):
+        """
+        Packages to verify, None for all. With a verify delta only packages
+        installed or updated since the parent image and packages owning
+        files changed in the layers above it are verified. Every file below
+        a directory replaced by an upper layer counts as changed.
+        """
+        if self.delta is None:
+            return None
+        installed = set(self.rpmdb.installed_packages())
+        packages = installed - set(self.delta["parent_packages"])
+        owned_files = self.rpmdb.owned_files()
+        for filepath in self.delta["changed_files"]:
+            if filepath in owned_files:
+                packages.add(owned_files[filepath])
+        below_opaque_dirs = self.below_opaque_dirs()
+        if below_opaque_dirs:
+            for filepath, nvra in owned_files.iteritems():
+                if below_opaque_dirs(filepath):
+                    packages.add(nvra)
+        return sorted(packages)
+
+    def below_opaque_dirs(self):
         """
-        Run command for rpm verify test
+        Function checking if a path is below a directory replaced by an
+        upper layer, None if there is no such directory
         """
-        out, error = Popen(cmd, stdout=PIPE, stderr=PIPE).communicate()
-        return (out, error)
+        prefixes = tuple(directory.rstrip("/") + "/"
+                         for directory in self.delta.get("opaque_dirs", []))
+        if not prefixes:
+            return None
+        return lambda filepath: filepath.startswith(prefixes)
+
+    def parent_issues(self):
+        """
+        Issues of the parent image which still hold: of packages installed
+        and not verified again, for files not changed since
+        """
+        if self.delta is None:
+            return []
+        installed = set(self.rpmdb.installed_packages())
+        changed_files = set(self.delta["changed_files"])
+        below_opaque_dirs = self.below_opaque_dirs() or (lambda path: False)
+        verified = set(self.packages or [])
+        return [issue for issue in self.delta["parent_issues"]
+                if issue["filename"] not in changed_files and
+                not below_opaque_dirs(issue["filename"]) and
+                issue["rpm"]["RPM"] not in verified and
+                (not issue["rpm"]["RPM"] or
+                 issue["rpm"]["RPM"] in installed)]
+
+    def package_shards(self):
+        """
+        Split packages to verify in sorted, contiguous shards
+        """
+        if self.packages is not None:
+            packages = self.packages
+        else:
+            packages = sorted(self.rpmdb.installed_packages())
+        count = min(len(packages), self.workers * SHARDS_PER_WORKER)
+        if not count:
+            return []
+        size = (len(packages) + count - 1) // count
+        return [packages[n:n + size] for n in range(0, len(packages), size)]
+
+    def verify_shard(self, packages, lines, stopped):
+        """
+        Verify given shard of packages, putting its output lines in queue
+        lines as they are produced, then None or the error it failed with.
+        Stops early once stopped is set.
+        """
+        try:
+            for line in self.stream_command(self.get_command(packages)):
+                if stopped.is_set():
+                    break
+                lines.put(line)
+        except Exception as e:
+            lines.put(e)
+            return
+        lines.put(None)
+
+    def stream_command(self, cmd):
+        """
+        Run command and yield its output lines as they are produced
+        """
+        return get_executor().stream(cmd, timeout=RPM_VERIFY_TIMEOUT)
+
+    def verify_output_lines(self):
+        """
+        Yield rpm verify output lines, with one worker as rpm -Va produces
+        them, with more workers verify shards of packages concurrently and
+        yield their output in shard order so that the result does not
+        depend on scheduling. Lines of the earliest shard not done are
+        yielded as they are produced, later shards are held until then.
+        """
+        if self.workers == 1:
+            if self.packages == []:
+                return
+            for line in self.stream_command(
+                    self.get_command(self.packages)):
+                yield line
+            return
+        pool = ThreadPool(self.workers)
+        stopped = Event()
+        # shards start in order, the shard read from is always running
+        queues = []
+        for shard in self.package_shards():
+            queues.append(Queue())
+            pool.apply_async(self.verify_shard, (shard, queues[-1], stopped))
+        try:
+            for lines in queues:
+                for line in iter(lines.get, None):
+                    if isinstance(line, Exception):
+                        raise line
+                    yield line
+        finally:
+            stopped.set()
+            pool.close()
+            pool.join()
+
+    def prefetch_rpmdb(self):
+        """
+        Read rpmdb headers and index owned files in a thread, so that owners
+        are ready by the time rpm -V reports its first issues
+        """
+        if self.workers > 1:
+            # shards are made from the headers before rpm -V starts
+            self.rpmdb.headers()
+        thread = Thread(target=self.rpmdb.owned_files)
+        thread.daemon = True
+        thread.start()
+        return thread
 
     def get_meta_of_rpm(self, rpm):
         """
         Get metadata of given installed package.
         Metadata captured: SIGPGP, VENDOR, PACKAGER, BUILDHOST
         """
-        qf = "%{SIGPGP:pgpsig}|%{VENDOR}|%{PACKAGER}|%{BUILDHOST}"
-        cmd = ["/bin/rpm", "-q", "--qf", qf, rpm]
-        out, _ = self.run_command(cmd)
-        out = out.split("|")
-        return {"RPM": rpm,
-                "SIGNATURE": out[0],
-                "VENDOR": out[1],
-                "PACKAGER": out[2],
-                "BUILDHOST": out[3]
-                }
+        if rpm not in self._meta_of_rpm:
+            hdr = self.rpmdb.header_of_package(rpm)
+            if hdr is not None:
+                out = self.rpmdb.meta_of_header(hdr)
+            else:
+                out = ["", "", "", ""]
+            self._meta_of_rpm[rpm] = {"RPM": rpm,
+                                      "SIGNATURE": out[0],
+                                      "VENDOR": out[1],
+                                      "PACKAGER": out[2],
+                                      "BUILDHOST": out[3]
+                                      }
+        return self._meta_of_rpm[rpm]
 
     def source_rpm_of_file(self, filepath):
         """
         Find source RPM of given filepath
         """
-        cmd = ["/bin/rpm", "-qf", filepath]
-        out, _ = self.run_command(cmd)
-        if " " in out:
-            return ""
-        else:
-            return out.split("\n")[0]
+        return self.rpmdb.owned_files().get(filepath, "")
 
-    def process_cmd_output_data(self, data):
+    def parse_cmd_output_line(self, line):
         """
-        Process the command output data
+        Parse a line of rpm -V output, returns (issue, filename) or None
+        for warnings, errors and config files
         """
-        lines = data.split("\n")[:-1]
-        result = []
-        for line in lines:
-            line = line.strip()
-            if line.startswith("error:"):
-                continue
-            match = re.search(r'^([0-9A-Za-z.]+)\s+([c]{0,1})\s+(\W.*)$', line)
+        line = line.strip()
+        if line.startswith("error:"):
+            return None
+        match = RPMVA_LINE.search(line)
 
-            # filter the lines with warnings or errors
-            if not match:
-                continue
+        # filter the lines with warnings or errors
+        if not match:
+            return None
+
+        # filter the config files
+        if match.groups()[1] == 'c':
+            return None
+        return match.groups()[0], match.groups()[2]
 
-            # filter the config files
-            if match.groups()[1] == 'c':
+    def issue_entry(self, issue, filepath, rpm):
+        """
+        Entry of rpmVa_issues for an issue of a file owned by rpm
+        """
+        # do not include the config files in the result
+        return {"issue": issue,
+                "config": False,
+                "filename": filepath,
+                "rpm": self.get_meta_of_rpm(rpm)}
+
+    def iter_cmd_output_issues(self, lines):
+        """
+        Parse rpm -V output lines as they come and yield their issues.
+        Owners come from one index of the rpmdb headers and metadata is
+        resolved once per owning package, not per file.
+        """
+        prefetch = self.prefetch_rpmdb()
+        for line in lines:
+            parsed = self.parse_cmd_output_line(line)
+            if not parsed:
                 continue
+            prefetch.join()
+            issue, filepath = parsed
+            yield self.issue_entry(issue, filepath,
+                                   self.source_rpm_of_file(filepath))
 
-            filepath = match.groups()[2]
-            rpm = self.source_rpm_of_file(filepath)
-            rpm_meta = self.get_meta_of_rpm(rpm)
-            # do not include the config files in the result
+    def process_cmd_output_data(self, data):
+        """
+        Process the command output data
+        """
+        return list(self.iter_cmd_output_issues(data.split("\n")[:-1]))
 
-            result.append({
-              "issue": match.groups()[0],
-              "config": match.groups()[1] == 'c',
-              "filename" : match.groups()[2],
-              "rpm": self.get_meta_of_rpm(rpm)})
-        return result
+    def iter_native_issues(self):
+        """
+        Verify all packages in process from rpmdb headers, on shards of
+        packages across the workers, and yield their issues
+        """
+        pool = ThreadPool(self.workers)
+        try:
+            for shard in pool.imap(self.native_verifier.verify_packages,
+                                   self.package_shards()):
+                for issue, filepath, nvra in shard:
+                    yield self.issue_entry(issue, filepath, nvra)
+        finally:
+            pool.close()
+            pool.join()
+
+    def iter_issues(self):
+        """
+        Yield the issues found by the RPM verify test
+        """
+        self.packages = self.packages_to_verify()
+        for issue in self.parent_issues():
+            yield issue
+        if self.mode in ("fast", "full"):
+            issues = self.iter_native_issues()
+        else:
+            # TODO: since this script is running inside container while we
+            # have the logging on host, we should find a better way to log
+            # rpm -V errors back. Also we should log the RPMs failing the
+            # rpm -V test
+            issues = self.iter_cmd_output_issues(self.verify_output_lines())
+        for issue in issues:
+            yield issue
 
     def _run(self):
         """
         Run the RPM verify test
         """
-        cmd = self.get_command()
-        out, error = self.run_command(cmd)
-        result = []
-        result = self.process_cmd_output_data(out)
-        # TODO: since this script is running inside container while we have the
-        # logging on host, we should find a better way to log this message back
-        # Also we should log the RPMs failing the rpm -V test
-        #print "Issue found while running rpm -Va test: "
-        #print error
-        return {"rpmVa_issues": result}
+        return {"rpmVa_issues": list(self.iter_issues())}
 
-    def run(self, output_file=None):
+    def run(self, output_file=None, json_lines=False):
         """
-        Run the RPM Verify test and export report if required
+        Run the RPM Verify test and export report if required. With
+        json_lines issues are written one per line as they are found,
+        without holding all of them in memory.
         """
+        if output_file and json_lines:
+            return self.export_report_lines(self.iter_issues(), output_file)
         result = self._run()
         if output_file:
             self.export_report(result, output_file)
@@ -114,10 +564,39 @@ class RPMVerifyTest(object):
         with open(output_file, "wb+") as fin:
             json.dump(data, fin)
 
+    def export_report_lines(self, issues, output_file):
+        """
+        Export issues as JSON Lines in output_file
+        """
+        with open(output_file, "wb+") as fout:
+            for issue in issues:
+                fout.write(json.dumps(issue) + "\n")
 
-if __name__ == "__main__":
-    rpmva_tests = RPMVerifyTest()
 
-    data_file_path = os.path.join(CERT_DIR_PARENT,
-                                  "%s.json" % rpmva_tests.__class__.__name__)
-    data = rpmva_tests.run(output_file=data_file_path)
+def run_from_environment(rpmdb=None, shared_dir=CERT_DIR_PARENT):
+    """
+    Run the RPM verify test configured by the test runner through the
+    environment and shared dir, and export its report
+    """
+    digest_paths = os.environ.get(VERIFY_DIGEST_PATHS_ENV, "")
+    delta = None
+    if os.path.isfile(os.path.join(shared_dir, VERIFY_DELTA)):
+        with open(os.path.join(shared_dir, VERIFY_DELTA)) as fin:
+            delta = json.load(fin)
+    rpmva_tests = RPMVerifyTest(
+        workers=int(os.environ.get(VERIFY_WORKERS_ENV, 1)),
+        mode=os.environ.get(VERIFY_MODE_ENV, "rpm"),
+        digest_paths=[path for path in digest_paths.split(":") if path],
+        delta=delta,
+        rpmdb=rpmdb)
+
+    output_format = os.environ.get(VERIFY_OUTPUT_ENV, "json")
+    data_file_path = os.path.join(shared_dir,
+                                  "%s.%s" % (rpmva_tests.__class__.__name__,
+                                             output_format))
+    return rpmva_tests.run(output_file=data_file_path,
+                           json_lines=output_format == "jsonl")
+
+
+if __name__ == "__main__":
+    run_from_environment()
@@ -0,0 +1,223 @@
+import rpm
+
+from threading import Lock
+
+# same query format `rpm -q --qf` was called with for package metadata
+META_QUERY_FORMAT = "%{SIGPGP:pgpsig}|%{VENDOR}|%{PACKAGER}|%{BUILDHOST}"
+
+# rpm macros are global to the process, the _dbpath set to read an rpmdb
+# of another root must not be seen by a read of any other rpmdb
+_macro_lock = Lock()
+
+
+class RPMDBUtils(object):
+    """
+    Read installed package headers from rpmdb in a single pass, shared by
+    tests running concurrently
+    """
+    def __init__(self, dbpath=None):
+        # rpmdb of another root, like one copied out of an image archive
+        self.dbpath = dbpath
+        self._headers = None
+        self._headers_by_nvra = None
+        self._owned_files = None
+        self.lock = Lock()
+
+    def headers(self):
+        """
+        Return headers of all installed packages, rpmdb is read only once
+        """
+        with self.lock:
+            if self._headers is None:
+                self._headers = self._read_headers()
+        return self._headers
+
+    def _read_headers(self):
+        """
+        Read headers of all installed packages from rpmdb at dbpath
+        """
+        with _macro_lock:
+            if self.dbpath:
+                rpm.addMacro("_dbpath", self.dbpath)
+            try:
+                ts = rpm.TransactionSet()
+                headers = [hdr for hdr in ts.dbMatch()]
+                ts.closeDB()
+            finally:
+                if self.dbpath:
+                    rpm.delMacro("_dbpath")
+        return headers
+
+    def header_of_package(self, nvra):
+        """
+        Return header of given installed package NVRA, None if not installed
+        """
+        if self._headers_by_nvra is None:
+            index = {}
+            for hdr in self.headers():
+                index.setdefault(self.nvra_of_header(hdr), hdr)
+            self._headers_by_nvra = index
+        return self._headers_by_nvra.get(nvra)
+
+    def nvra_of_header(self, hdr):
+        """
+        Return NVRA of given package header
+        """
+        return hdr[rpm.RPMTAG_NVRA]
+
+    def meta_of_header(self, hdr):
+        """
+        Get metadata of given package header.
+        Metadata captured: SIGPGP, VENDOR, PACKAGER, BUILDHOST
+        """
+        return hdr.sprintf(META_QUERY_FORMAT).split("|")
+
+    def format_require(self, name, flags, version):
+        """
+        Format a require the way `rpm -q --requires` prints it
+        """
+        sense = ""
+        if flags & rpm.RPMSENSE_LESS:
+            sense += "<"
+        if flags & rpm.RPMSENSE_GREATER:
+            sense += ">"
+        if flags & rpm.RPMSENSE_EQUAL:
+            sense += "="
+        if sense and version:
+            return "%s %s %s" % (name, sense, version)
+        return name
+
+    def requires_of_header(self, hdr):
+        """
+        Obtain requires of given package header
+        """
+        names = hdr[rpm.RPMTAG_REQUIRENAME] or []
+        flags = hdr[rpm.RPMTAG_REQUIREFLAGS] or []
+        versions = hdr[rpm.RPMTAG_REQUIREVERSION] or []
+        return list(set(self.format_require(n, f, v)
+                        for n, f, v in zip(names, flags, versions)))
+
+    def files_of_header(self, hdr):
+        """
+        Get all files (and directories) owned by given package header
+        """
+        return hdr[rpm.RPMTAG_FILENAMES] or []
+
+    def tag_of_header(self, hdr, tag, default=None):
+        """
+        Value of tag of given header, default if the tag is not known to
+        the installed rpm bindings or not present in header
+        """
+        if not hasattr(rpm, tag):
+            return default
+        value = hdr[getattr(rpm, tag)]
+        if value is None or value == []:
+            return default
+        return value
+
+    def file_attributes_of_header(self, hdr):
+        """
+        Attributes of every file of given package header as recorded at
+        install time, used to verify files without `rpm -V`
+        """
+        names = self.files_of_header(hdr)
+        count = len(names)
+        sizes = self.tag_of_header(hdr, "RPMTAG_LONGFILESIZES") or \
+            self.tag_of_header(hdr, "RPMTAG_FILESIZES", [0] * count)
+        modes = self.tag_of_header(hdr, "RPMTAG_FILEMODES", [0] * count)
+        mtimes = self.tag_of_header(hdr, "RPMTAG_FILEMTIMES", [0] * count)
+        rdevs = self.tag_of_header(hdr, "RPMTAG_FILERDEVS", [0] * count)
+        users = self.tag_of_header(hdr, "RPMTAG_FILEUSERNAME", [""] * count)
+        groups = self.tag_of_header(hdr, "RPMTAG_FILEGROUPNAME", [""] * count)
+        linktos = self.tag_of_header(hdr, "RPMTAG_FILELINKTOS", [""] * count)
+        digests = self.tag_of_header(hdr, "RPMTAG_FILEDIGESTS") or \
+            self.tag_of_header(hdr, "RPMTAG_FILEMD5S", [""] * count)
+        flags = self.tag_of_header(hdr, "RPMTAG_FILEFLAGS", [0] * count)
+        verify_flags = self.tag_of_header(hdr, "RPMTAG_FILEVERIFYFLAGS",
+                                          [-1] * count)
+        states = self.tag_of_header(hdr, "RPMTAG_FILESTATES", [0] * count)
+        # md5 unless the package says otherwise
+        digest_algo = self.tag_of_header(hdr, "RPMTAG_FILEDIGESTALGO", 1)
+        if isinstance(digest_algo, list):
+            digest_algo = digest_algo[0]
+
+        files = []
+        for n in range(count):
+            state = states[n]
+            if not isinstance(state, int):
+                state = ord(state)
+            # char tag holding signed values
+            if state > 127:
+                state -= 256
+            files.append({"filename": names[n],
+                          "size": sizes[n],
+                          # int16 tags may come back signed
+                          "mode": modes[n] & 0xffff,
+                          "mtime": mtimes[n],
+                          "rdev": rdevs[n] & 0xffff,
+                          "user": users[n],
+                          "group": groups[n],
+                          "linkto": linktos[n],
+                          "digest": digests[n],
+                          "digest_algo": digest_algo,
+                          "flags": flags[n],
+                          "verify_flags": verify_flags[n],
+                          "state": state,
+                          })
+        return files
+
+    def file_digest_algos(self):
+        """
+        RPMTAG_FILEDIGESTALGO values files of installed packages are
+        recorded with, md5 for packages not telling
+        """
+        algos = set()
+        for hdr in self.headers():
+            if not self.files_of_header(hdr):
+                continue
+            algo = self.tag_of_header(hdr, "RPMTAG_FILEDIGESTALGO", 1)
+            if isinstance(algo, list):
+                algo = algo[0]
+            algos.add(algo)
+        return algos
+
+    def owned_files(self):
+        """
+        Index of every path owned by any installed package, mapped to the
+        NVRA of its first owner in rpmdb order (as `rpm -qf` reports it).
+        Owned directories and files shared by multilib packages are
+        included as every header is indexed, not only one per name.
+        """
+        headers = self.headers()
+        with self.lock:
+            if self._owned_files is None:
+                index = {}
+                for hdr in headers:
+                    nvra = self.nvra_of_header(hdr)
+                    for filename in self.files_of_header(hdr):
+                        index.setdefault(filename, nvra)
+                self._owned_files = index
+        return self._owned_files
+
+    def installed_packages(self):
+        """
+        Get NVRA of all installed packages
+        """
+        return [self.nvra_of_header(hdr) for hdr in self.headers()]
+
+    def installed_packages_data(self):
+        """
+        Get metadata and requires of all installed packages,
+        keyed by package NVRA
+        """
+        data = {}
+        for hdr in self.headers():
+            metadata = self.meta_of_header(hdr)
+            data[self.nvra_of_header(hdr)] = {
+                "SIGNATURE": metadata[0],
+                "VENDOR": metadata[1],
+                "PACKAGER": metadata[2],
+                "BUILD_HOST": metadata[3],
+                "REQUIRES": self.requires_of_header(hdr),
+            }
+        return data
@@ -0,0 +1,160 @@
+import logging
+import sys
+import time
+
+from threading import Condition, Thread
+
+from executor import CommandCancelled, get_executor
+
+log = logging.getLogger("scheduler")
+
+# seconds the thread running the scheduler waits on phases at a time, a
+# blocked wait would keep Python 2 from running signal handlers
+WAIT_INTERVAL = 1
+
+
+class PhaseError(Exception):
+    """
+    Phase graph can not be run, it has an unknown requirement or a cycle
+    """
+    pass
+
+
+class PhaseScheduler(object):
+    """
+    Run phases of work as a dependency graph: every phase starts in a
+    thread of its own as soon as the phases it requires have completed,
+    so independent phases run concurrently. Phases requiring a failed phase
+    are skipped. Wall time and status of every phase are recorded.
+    Failures of phases added as not fatal are recorded, not raised.
+    Commands of the phases run in the executor group of the caller of
+    run(). With cancel_on_failure, the first failure of a fatal phase
+    cancels the commands of that group still running and phases not
+    started yet are not run.
+    """
+    def __init__(self, cancel_on_failure=False):
+        self.phases = {}
+        self.order = []
+        self.condition = Condition()
+        self.results = {}
+        self.errors = []
+        self.wall_time = None
+        self.cancel_on_failure = cancel_on_failure
+        self.group = None
+        self.cancelled = False
+
+    def add(self, name, func, requires=(), fatal=True):
+        """
+        Add phase of given name, running func once all phases named in
+        requires have completed
+        """
+        if name in self.phases:
+            raise PhaseError("Phase %s is added twice." % name)
+        self.phases[name] = {"func": func, "requires": list(requires),
+                             "fatal": fatal}
+        self.order.append(name)
+
+    def check(self):
+        """
+        Raise PhaseError if a requirement is unknown or phases require
+        each other in a cycle
+        """
+        for name in self.order:
+            for required in self.phases[name]["requires"]:
+                if required not in self.phases:
+                    raise PhaseError("Phase %s requires unknown phase %s."
+                                     % (name, required))
+        done = set()
+        pending = list(self.order)
+        while pending:
+            ready = [name for name in pending
+                     if set(self.phases[name]["requires"]) <= done]
+            if not ready:
+                raise PhaseError("Phases %s require each other."
+                                 % ", ".join(pending))
+            done.update(ready)
+            pending = [name for name in pending if name not in done]
+
+    def _run_phase(self, name):
+        started = time.time()
+        status, error = "passed", None
+        try:
+            with get_executor().group(self.group):
+                self.phases[name]["func"]()
+        except Exception as e:
+            if isinstance(e, CommandCancelled) and self.cancelled:
+                # killed after another phase failed
+                status = "cancelled"
+            else:
+                status, error = "failed", sys.exc_info()
+                log.exception("Phase %s failed.", name)
+        duration = time.time() - started
+        log.debug("Phase %s %s in %.3fs", name, status, duration)
+        cancel = False
+        with self.condition:
+            self.results[name] = {"status": status, "duration": duration}
+            if error is not None and self.phases[name]["fatal"]:
+                self.errors.append(error)
+                cancel = self.cancel_on_failure and not self.cancelled
+                self.cancelled = self.cancelled or cancel
+            self.condition.notify_all()
+        if cancel:
+            log.info("Phase %s failed, cancelling other phases.", name)
+            get_executor().cancel(self.group)
+
+    def _start_phases(self, threads):
+        """
+        Start every phase once the phases it requires are done, until all
+        phases are started or skipped
+        """
+        with self.condition:
+            pending = list(self.order)
+            while pending:
+                if self.cancelled:
+                    for name in pending:
+                        self.results[name] = {"status": "cancelled",
+                                              "duration": 0.0}
+                    break
+                progressed = False
+                for name in list(pending):
+                    requires = self.phases[name]["requires"]
+                    if any(required not in self.results
+                           for required in requires):
+                        continue
+                    pending.remove(name)
+                    progressed = True
+                    if any(self.results[required]["status"] != "passed"
+                           for required in requires):
+                        self.results[name] = {"status": "skipped",
+                                              "duration": 0.0}
+                        continue
+                    thread = Thread(target=self._run_phase, args=(name,))
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+                if pending and not progressed:
+                    self.condition.wait(WAIT_INTERVAL)
+
+    def run(self):
+        """
+        Run all phases and return their status and duration by name. The
+        first error of a failed fatal phase is raised once all phases are
+        done.
+        """
+        self.check()
+        started = time.time()
+        self.group = get_executor().current_group()
+        threads = []
+        try:
+            self._start_phases(threads)
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(WAIT_INTERVAL)
+        finally:
+            if self.cancelled:
+                get_executor().reset(self.group)
+        self.wall_time = time.time() - started
+        if self.errors:
+            error_type, error, traceback = self.errors[0]
+            raise error_type, error, traceback
+        return self.results
@@ -1,9 +1,19 @@
 import os
 import re
-import commands
 import json
 import logging
 
+from executor import get_executor
+
+# syslog is writable by any local user, only the alert id of a
+# setroubleshoot line is taken from it and it must be a UUID
+ALERT_PATTERN = re.compile(
+    r"^.*setroubleshoot:.*\bsealert\s+-l\s+"
+    r"([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-"
+    r"[0-9a-fA-F]{12})\s*$", re.MULTILINE)
+# seconds sealert is given to report an alert
+SEALERT_TIMEOUT = 60
+
 
 class SELinuxDenials(object):
     """
@@ -16,18 +26,19 @@ class SELinuxDenials(object):
         alerts = []
         output = ""
         try:
-            alerts = re.findall(r"^.*setroubleshoot:.*(sealert\s-l\s.*)",
-                                open("/var/log/messages", "r").read(),
-                                re.MULTILINE)
+            with open("/var/log/messages", "r") as fin:
+                alerts = ALERT_PATTERN.findall(fin.read())
         except IOError, e:
             output = "IOError while recording selinux denials: %s" \
                 % os.strerror(e.errno)
             return False, output
 
         result = []
-        for alert in alerts:
+        for alert_id in alerts:
             try:
-                result.append({"alert": commands.getoutput(alert)})
+                out, error = get_executor().run(["sealert", "-l", alert_id],
+                                                timeout=SEALERT_TIMEOUT)
+                result.append({"alert": out or error})
             except Exception, err:
                 # TODO: Log these errors properly
                 logging.error(err)
@@ -0,0 +1,144 @@
+from scheduler import PhaseScheduler
+
+HOST = "host"
+CONTAINER = "container"
+LOCATIONS = [HOST, CONTAINER]
+
+# names of container probes selected by the test runner, separated by ","
+PROBES_ENV = "INTROSPECTION_PROBES"
+
+
+class UnknownTestError(Exception):
+    """
+    Test selected by a name no test is registered with
+    """
+    pass
+
+
+class TestRegistry(object):
+    """
+    Tests by name, each declaring where it runs, the shared inputs and
+    tests it needs and the reports it produces. Shared inputs are
+    registered as resources, computed once if any scheduled test needs
+    them. Tests needing neither each other nor the same resource run
+    concurrently.
+    """
+    def __init__(self):
+        self.tests = {}
+        self.order = []
+        self.resources = {}
+
+    def add_resource(self, name, func):
+        """
+        Register a shared input computed by func
+        """
+        self.resources[name] = func
+
+    def add(self, name, func=None, location=HOST, needs=(), produces=(),
+            fatal=True):
+        """
+        Register a test. Tests of another location than the one scheduled
+        are declared without func. A test not fatal fails alone, the run
+        goes on.
+        """
+        self.tests[name] = {"name": name,
+                            "func": func,
+                            "location": location,
+                            "needs": list(needs),
+                            "produces": list(produces),
+                            "fatal": fatal,
+                            }
+        self.order.append(name)
+
+    def names(self, location=None):
+        """
+        Names of registered tests, of given location if any, in order of
+        registration
+        """
+        return [name for name in self.order
+                if location is None or self.tests[name]["location"] ==
+                location]
+
+    def select(self, only=None, skip=None):
+        """
+        Names of tests to run: all or only those given, without those to
+        skip. Raises UnknownTestError for names no test is registered with.
+        """
+        unknown = [name for name in (only or []) + (skip or [])
+                   if name not in self.tests]
+        if unknown:
+            raise UnknownTestError("Unknown tests: %s, known tests: %s" % (
+                ", ".join(unknown), ", ".join(self.order)))
+        return [name for name in self.order
+                if (not only or name in only) and name not in (skip or [])]
+
+    def describe(self, names):
+        """
+        Location, needs and reports of given tests, by name
+        """
+        return dict((name, dict((key, value) for key, value in
+                                self.tests[name].iteritems()
+                                if key != "func"))
+                    for name in names)
+
+    def scheduler(self, names, location, phases=(), cancel_on_failure=False):
+        """
+        Scheduler of given tests of given location, with resources they
+        need and extra phases given as (name, func). Needs on tests not
+        scheduled are dropped, they only order tests run together.
+        """
+        names = [name for name in names
+                 if self.tests[name]["location"] == location]
+        needed = set(need for name in names
+                     for need in self.tests[name]["needs"])
+        scheduler = PhaseScheduler(cancel_on_failure)
+        for name, func in phases:
+            scheduler.add(name, func)
+        for name in sorted(needed):
+            if name in self.resources:
+                scheduler.add(name, self.resources[name])
+        for name in names:
+            requires = [need for need in self.tests[name]["needs"]
+                        if need in scheduler.phases or need in names]
+            scheduler.add(name, self.tests[name]["func"], requires,
+                          self.tests[name]["fatal"])
+        return scheduler
+
+
+def declare_host_tests(registry, funcs=None):
+    """
+    Register the tests run at host, with the functions running them given
+    by name when declared by the test runner
+    """
+    funcs = funcs or {}
+    registry.add("image_inspection", funcs.get("image_inspection"), HOST,
+                 needs=["inspection"],
+                 produces=["InspectImage.json"])
+    registry.add("metadata", funcs.get("metadata"), HOST,
+                 needs=["inspection"],
+                 produces=["Metadata.json"])
+    # hosts without SELinux or its logs are introspected all the same
+    registry.add("selinux", funcs.get("selinux"), HOST,
+                 produces=["SELinuxTests.json"], fatal=False)
+    # reads the denials caused by the probes, if they run
+    registry.add("selinux_denials", funcs.get("selinux_denials"), HOST,
+                 needs=["container_probes"],
+                 produces=["SELinuxDenials.json"], fatal=False)
+
+
+def declare_container_probes(registry, funcs=None):
+    """
+    Register the probes run inside container, with the functions running
+    them given by name when declared inside container
+    """
+    funcs = funcs or {}
+    registry.add("package_tests", funcs.get("package_tests"), CONTAINER,
+                 needs=["rpmdb", "file_inventory"],
+                 produces=["PackageTests.json", "AdhocFiles.json"])
+    registry.add("elf_tests", funcs.get("elf_tests"), CONTAINER,
+                 needs=["rpmdb", "file_inventory"],
+                 produces=["ELFTests.json"])
+    registry.add("rpm_verify_tests", funcs.get("rpm_verify_tests"),
+                 CONTAINER,
+                 needs=["rpmdb"],
+                 produces=["RPMVerifyTest.json", "RPMVerifyTest.jsonl"])
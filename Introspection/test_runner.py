@@ -1,3 +1,5 @@
+import fcntl
+import json
 import logging
 import os
 import tempfile
@@ -5,14 +7,20 @@ import tempfile
 from random import choice
 from shutil import copy, rmtree
 from string import ascii_lowercase
+from threading import BoundedSemaphore
 from urlparse import urlparse
 
 import constants
 
 from utils import ImageUtils, ContainerUtils, is_docker_running,\
     create_tarball
+from executor import get_executor
 from inspect_tests import InspectImage, InspectContainer
+from inspection_cache import InspectionCache
+from layer_delta import LayerDelta
 from metadata import Metadata
+from test_registry import CONTAINER, HOST, PROBES_ENV, TestRegistry, \
+    declare_container_probes, declare_host_tests
 from selinux_tests import SELinuxTests
 from selinux_denials_tests import SELinuxDenials
 
@@ -46,12 +54,17 @@ class TestRunner(object):
         self.imageutils = ImageUtils()
         self.containerutils = ContainerUtils()
 
+        self._process_kwargs(**kwargs)
         self.selinux_checks = SELinuxTests()
         self.selinux_denials_test = SELinuxDenials()
-        self.image_inspection_test = InspectImage()
-        self.container_inspection_test = InspectContainer()
-        self.metadata = Metadata()
-        self._process_kwargs(**kwargs)
+        # inspections shared by the tests, image ones kept across runs
+        self.inspections = InspectionCache()
+        self.image_inspection_test = InspectImage(self.inspections)
+        self.container_inspection_test = InspectContainer(self.inspections)
+        self.metadata = Metadata(self.inspections, self.base_images)
+        # unknown test names are rejected before anything is run
+        self.registry = self.test_registry()
+        self.tests = self.registry.select(self.only, self.skip)
 
     def setup(self):
         """
@@ -71,6 +84,26 @@ class TestRunner(object):
         self.dockeruser = kwargs.get("user", None)
         self.output_dir = kwargs.get("output_dir", None)
         self.offline = kwargs.get("offline", None)
+        self.verify_workers = kwargs.get("verify_workers", 1)
+        self.verify_mode = kwargs.get("verify_mode", "rpm")
+        self.verify_digest_paths = kwargs.get("verify_digest_paths", [])
+        self.verify_json_lines = kwargs.get("verify_json_lines", False)
+        self.verify_incremental = kwargs.get("verify_incremental", False)
+        self.containerless = kwargs.get("containerless", False)
+        # names of tests to run only and to skip
+        self.only = kwargs.get("only", None)
+        self.skip = kwargs.get("skip", None)
+        self.layer_delta = None
+        self.restored = False
+        # caches and concurrency limits shared by the runs of a batch
+        self.layer_cache = kwargs.get("layer_cache", None)
+        self.base_images = kwargs.get("base_images", None)
+        self.container_slots = kwargs.get("container_slots") or \
+            BoundedSemaphore(1)
+        self.analysis_slots = kwargs.get("analysis_slots") or \
+            BoundedSemaphore(1)
+        # warm containers probes are run in by docker exec, if given
+        self.container_pool = kwargs.get("container_pool", None)
 
     def is_docker_daemon_running(self):
         """
@@ -135,6 +168,73 @@ class TestRunner(object):
         [copy(script, self.introspection_shared_dir_at_host())
          for script in self.test_scripts_source_path()]
 
+    def probe_cache_files(self):
+        """
+        Names of caches kept by probes across test runs
+        """
+        return constants.PROBE_CACHE_FILES
+
+    def copy_caches_in_test_dir(self):
+        """
+        Copy probe caches from earlier test runs in test dir at host
+        """
+        for name in self.probe_cache_files():
+            cache = os.path.join(constants.CACHE_DIR, name)
+            if os.path.isfile(cache):
+                copy(cache, self.introspection_shared_dir_at_host())
+
+    def save_caches_from_test_dir(self):
+        """
+        Merge probe caches updated by this test run into those at host, so
+        they are kept for next test runs and not reported as result
+        """
+        if not os.path.isdir(constants.CACHE_DIR):
+            os.makedirs(constants.CACHE_DIR)
+        for name in self.probe_cache_files():
+            cache = os.path.join(self.introspection_shared_dir_at_host(), name)
+            if os.path.isfile(cache):
+                self.merge_probe_cache(cache,
+                                       os.path.join(constants.CACHE_DIR, name))
+                os.unlink(cache)
+
+    def merge_probe_cache(self, source, destination,
+                          max_entries=constants.PROBE_CACHE_MAX_ENTRIES):
+        """
+        Merge entries of probe cache at source into the one at destination,
+        the most recently used entry of a path is kept, and the most
+        recently used max_entries in all. Concurrent test runs merge in
+        turn under a lock file, the cache is replaced as a whole.
+        """
+        try:
+            with open(source) as fin:
+                entries = json.load(fin)
+        except ValueError:
+            return
+        lock_file = open(destination + ".lock", "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            merged = {}
+            if os.path.isfile(destination):
+                try:
+                    with open(destination) as fin:
+                        merged = json.load(fin)
+                except ValueError:
+                    pass
+            for path, entry in entries.iteritems():
+                if entry.get("used", 0) >= \
+                        merged.get(path, {}).get("used", 0):
+                    merged[path] = entry
+            kept = sorted(merged.iteritems(),
+                          key=lambda item: item[1].get("used", 0),
+                          reverse=True)[:max_entries]
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(destination),
+                                       suffix=".tmp")
+            with os.fdopen(fd, "wb") as fout:
+                json.dump(dict(kept), fout)
+            os.rename(tmp, destination)
+        finally:
+            lock_file.close()
+
     def change_perm_for_test_dir(self, test_dir, perm):
         """
         Change permission to test_dir
@@ -157,6 +257,39 @@ class TestRunner(object):
         params.insert(2, user)
         return params
 
+    def probe_environment(self):
+        """
+        Environment variables configuring the probes inside container
+        """
+        return {constants.VERIFY_WORKERS_ENV: self.verify_workers,
+                constants.VERIFY_MODE_ENV: self.verify_mode,
+                constants.VERIFY_DIGEST_PATHS_ENV:
+                ":".join(self.verify_digest_paths or []),
+                constants.VERIFY_OUTPUT_ENV:
+                "jsonl" if self.verify_json_lines else "json",
+                PROBES_ENV: ",".join(self.container_tests()),
+                }
+
+    def probe_config(self):
+        """
+        Probe configuration results of image depend on, cached results are
+        reused only for the same configuration
+        """
+        env = self.probe_environment()
+        # number of workers changes how long probes run, not what they find
+        del env[constants.VERIFY_WORKERS_ENV]
+        return env
+
+    def _add_env_in_params(self, env, params):
+        """
+        Add environment variables in parameters
+        """
+        # assumes params start with "run"
+        for key, value in sorted(env.items()):
+            params.insert(1, "--env")
+            params.insert(2, "%s=%s" % (key, value))
+        return params
+
     # ------------------Image-test-utilities------------------
 
     def _get_params_for_image_tests(self, volumes, entrypoint):
@@ -167,6 +300,7 @@ class TestRunner(object):
         # "run", hence params should start with "run"
         params = ["run", "-v", volumes, "--entrypoint", entrypoint,
                   "--name", self.introspection_container, self.image]
+        self._add_env_in_params(self.probe_environment(), params)
         # if container needs to be run as user root
         if self.dockeruser:
             self._add_user_in_params(self.dockeruser, params)
@@ -207,46 +341,189 @@ class TestRunner(object):
             log.debug(msg)
             return self.pkg_report_path()
 
+    def run_pooled_image_tests(self):
+        """
+        Run image tests in warm container of image kept in container pool,
+        in a new container if the warm one is leased by another test run
+        """
+        image_id = self.inspections.inspect_image(self.image)["Id"]
+        container = self.container_pool.lease(self.image, image_id)
+        if container is None:
+            log.info("Warm container of image is busy, creating container.")
+            return self.run_image_tests()
+        log.info("Running tests in warm container %s.", container["name"])
+        try:
+            self.container_pool.run(container,
+                                    self.introspection_shared_dir_at_host(),
+                                    [self._test_kickstart_path_in_container()],
+                                    self.probe_environment(),
+                                    self.dockeruser)
+        finally:
+            self.container_pool.release(container)
+        log.debug("Successfully ran image tests in warm container.")
+        return self.pkg_report_path()
+
+    def run_offline_tests(self):
+        """
+        Run image tests without running the image, from its archive
+        streamed by `docker save`
+        """
+        # needs rpm bindings at host, runs with a container do not
+        from offline_analysis import OfflineAnalysis
+        log.info("Analysing image saved by docker, without container.")
+        OfflineAnalysis(image=self.image,
+                        verify_mode=self.verify_mode,
+                        digest_paths=self.verify_digest_paths,
+                        workers=self.verify_workers,
+                        probes=self.container_tests()).run(
+            self.introspection_shared_dir_at_host(),
+            json_lines=self.verify_json_lines)
+        log.debug("Successfully ran image tests without container.")
+        return self.pkg_report_path()
+
     # -------------------Test-run-utilities----------------------
 
+    def pull_image_if_missing(self):
+        """
+        Pull image under test unless it is present locally. The image is
+        inspected while the probes run, and possibly before, so it is not
+        left to `docker run` to pull it.
+        """
+        if not self.imageutils.is_image_present_locally(self.image):
+            log.info("Pulling image %s.", self.image)
+            self.imageutils.pull_image_from_registry(self.image)
+
     def pre_test_run_setup(self):
         """
         Run pre test run setup
         """
+        self.pull_image_if_missing()
         log.debug("Copying test script in shared directory at host.")
         self.copy_scripts_in_test_dir()
+        log.debug("Copying probe caches in shared directory at host.")
+        self.copy_caches_in_test_dir()
         log.debug("Changing permission of shared directory at host to 0777.")
         self.change_perm_for_test_dir(self.introspection_shared_dir_at_host(), 0777)
+        if self.verify_incremental:
+            self.layer_delta = LayerDelta(cache=self.layer_cache,
+                                          config=self.probe_config(),
+                                          inspections=self.inspections,
+                                          user=self.dockeruser)
+            with self.analysis_slots:
+                log.debug("Looking up cached results of image layers.")
+                self.restored = self.layer_delta.restore(
+                    self.image, self.introspection_shared_dir_at_host())
+                if not self.restored:
+                    log.debug("Finding packages changed since cached layer.")
+                    self.layer_delta.prepare(
+                        self.image, self.introspection_shared_dir_at_host())
+
+    def image_tests(self):
+        """
+        Run the probes on image, in a container or from its layers, unless
+        its results are cached
+        """
+        if self.restored:
+            log.info("Skipping image tests, results of image are cached.")
+        elif self.containerless:
+            with self.analysis_slots:
+                self.run_offline_tests()
+        else:
+            with self.container_slots:
+                if self.container_pool is not None:
+                    self.run_pooled_image_tests()
+                else:
+                    self.run_image_tests()
 
-    def _run(self):
+    def report_path(self, test):
         """
-        Run all tests with clean up utility
+        Path of report of given test in shared directory at host
         """
-        self.run_image_tests()
+        return os.path.join(self.introspection_shared_dir_at_host(),
+                            "%s.json" % test.__class__.__name__)
 
-        # image inspection test
+    def image_inspection_tests(self):
+        """
+        Inspect image under test
+        """
         msg = "Inspecting image under test.."
         print msg
-        inspect_image_report_path = os.path.join(
-            self.introspection_shared_dir_at_host(),
-            "%s.json" % self.image_inspection_test.__class__.__name__
-        )
         self.image_inspection_test.run(
             # image=self.cert_image,
             image=self.image,
-            export_file=inspect_image_report_path)
+            export_file=self.report_path(self.image_inspection_test))
 
-        # metadata tests
-        metadata_report_path = os.path.join(
-            self.introspection_shared_dir_at_host(),
-            "%s.json" % self.metadata.__class__.__name__
-        )
+    def metadata_tests(self):
+        """
+        Collect metadata of image under test
+        """
         msg = "Collecting metadata of image under test.."
         print msg
         self.metadata.run(
             # image=self.cert_image,
             image=self.image,
-            export_file=metadata_report_path)
+            export_file=self.report_path(self.metadata))
+
+    def selinux_tests(self):
+        """
+        Check SELinux status of host
+        """
+        self.selinux_checks.run(
+            export_file=self.report_path(self.selinux_checks))
+
+    def selinux_denials_tests(self):
+        """
+        Capture SELinux denials, after the probes had a chance to cause
+        them
+        """
+        self.selinux_denials_test.run(
+            export_file=self.report_path(self.selinux_denials_test))
+
+    def test_registry(self):
+        """
+        Registry of the tests of a run, at host and inside container
+        """
+        registry = TestRegistry()
+        registry.add_resource(
+            "inspection", lambda: self.inspections.inspect_image(self.image))
+        declare_host_tests(registry, {
+            "image_inspection": self.image_inspection_tests,
+            "metadata": self.metadata_tests,
+            "selinux": self.selinux_tests,
+            "selinux_denials": self.selinux_denials_tests,
+        })
+        declare_container_probes(registry)
+        return registry
+
+    def container_tests(self):
+        """
+        Names of selected tests run inside container
+        """
+        return [name for name in self.tests
+                if name in self.registry.names(CONTAINER)]
+
+    def _run(self):
+        """
+        Run all selected tests, each as soon as the tests and inputs it
+        needs are ready, and export their durations
+        """
+        phases = []
+        if self.container_tests():
+            phases.append(("container_probes", self.image_tests))
+        # a failed test fails the run, commands of other tests are killed
+        # instead of running to their end
+        scheduler = self.registry.scheduler(self.tests, HOST, phases,
+                                            cancel_on_failure=True)
+        try:
+            scheduler.run()
+        finally:
+            log.info("Test phases: %s, wall time %.3fs", scheduler.results,
+                     scheduler.wall_time or 0.0)
+            with open(os.path.join(self.introspection_shared_dir_at_host(),
+                                   constants.PHASE_REPORT), "wb") as fout:
+                json.dump({"tests": self.registry.describe(self.tests),
+                           "phases": scheduler.results,
+                           "wall_time": scheduler.wall_time}, fout)
 
     def clean_up(self, post_run=True, during_setup=False):
         """
@@ -313,14 +590,28 @@ class TestRunner(object):
         Remove test scripts from result directory if any
         """
         log.debug("Removing the test scripts from shared volume.")
+        # helper modules imported by the tests leave their compiled files
+        # behind in the shared volume
+        scripts = self.test_scripts()
+        compiled = [script + "c" for script in scripts
+                    if script.endswith(".py")]
         for item in os.listdir(self.introspection_shared_dir_at_host()):
-            if item in self.test_scripts():
+            if item in scripts or item in compiled:
                 os.unlink(os.path.join(self.introspection_shared_dir_at_host(), item))
 
     def _post_run(self):
         """
         Operations to be performed post test run
         """
+        self.save_caches_from_test_dir()
+        if self.layer_delta is not None:
+            if not self.restored:
+                log.debug("Caching results of image layers.")
+                self.layer_delta.store(self.image,
+                                       self.introspection_shared_dir_at_host())
+            log.info("Layer cache lookups: %s", self.layer_delta.cache.stats())
+        if self.container_pool is not None:
+            log.info("Container pool: %s", self.container_pool.stats())
         self.remove_test_scripts_from_result()
         result = self.introspection_shared_dir_at_host()
         print result
@@ -338,4 +629,5 @@ class TestRunner(object):
         self.pre_test_run_setup()
         self._run()
         self._post_run()
+        log.info("Commands run: %s", get_executor().summary())
         log.info("Completed container introspection.")
@@ -3,18 +3,17 @@ import time
 import logging
 import tarfile
 import base64
-from subprocess import Popen, PIPE
 
-from dockerutils import DockerUtils
-from constants import LOGFILE_PATH
+from dockerutils import get_docker_utils
+from executor import get_executor
+from constants import LOGFILE_PATH, IMAGE_ARCHIVE_EXTENSIONS
 
 
 def command(cmd):
     """
     Run command
     """
-    out, error = Popen(cmd, stdout=PIPE, stderr=PIPE).communicate()
-    return (out, error)
+    return get_executor().run(cmd)
 
 
 def configure_logging():
@@ -31,7 +30,7 @@ def is_docker_running():
     """
     Check if Docker daemon is running or not
     """
-    docker = DockerUtils()
+    docker = get_docker_utils()
     return docker.is_docker_running()
 
 
@@ -39,7 +38,7 @@ def docker_version():
     """
     Get the docker version
     """
-    docker = DockerUtils()
+    docker = get_docker_utils()
     return docker.docker_version()
 
 
@@ -87,7 +86,7 @@ class ImageUtils(object):
     """
 
     def __init__(self):
-        self.docker = DockerUtils()
+        self.docker = get_docker_utils()
 
     def is_image_present_locally(self, image):
         """
@@ -112,7 +111,7 @@ class ImageUtils(object):
         Check image is tar file image
         """
         # TODO: Better approach to find image type
-        if image.endswith(".tar"):
+        if image.endswith(IMAGE_ARCHIVE_EXTENSIONS):
             return True
         return False
 
@@ -121,7 +120,7 @@ class ImageUtils(object):
         Check if image is docker image
         """
         # TODO: Better approach to find image type
-        if not image.endswith(".tar"):
+        if not image.endswith(IMAGE_ARCHIVE_EXTENSIONS):
             return True
         return False
 
@@ -157,6 +156,12 @@ class ImageUtils(object):
         """
         return self.docker.load_image_from_tar(tar_image, tmpdir)
 
+    def save_image_stream(self, image, consume):
+        """
+        Stream image archive, as `docker save` writes it, into consume
+        """
+        return self.docker.save_image_stream(image, consume)
+
     def get_all_images_ids_for_repository(self, repository_name):
         """
         Get all the image:tag ids for given repository name
@@ -172,7 +177,7 @@ class ContainerUtils(object):
     """
 
     def __init__(self, container=None):
-        self.docker = DockerUtils()
+        self.docker = get_docker_utils()
 
     def create_container(self, params):
         """
@@ -2,5 +2,4 @@
 
 echo "Hello"
 
-python /var/tmp/container_introspection/package_tests.py
-python /var/tmp/container_introspection/rpm_verify_tests.py
+python /var/tmp/container_introspection/probe_agent.py
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+"""
+Time reading metadata and requires of installed packages, the way
+PackageTests.run did with two `rpm -q` processes per package against the
+single rpmdb header pass of RPMDBUtils, and count the processes each
+spawns. Run where rpm bindings are installed, on the host or inside a
+container:
+
+    python tests/benchmark_package_data.py [--packages N] [--dbpath DIR]
+
+Both ways are checked to report the same data for the packages compared.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+from optparse import OptionParser
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "Introspection"))
+
+from rpmdb_utils import META_QUERY_FORMAT, RPMDBUtils  # noqa: E402
+
+spawned = [0]
+_execute_child = subprocess.Popen._execute_child
+
+
+def counting_execute_child(self, *args, **kwargs):
+    spawned[0] += 1
+    return _execute_child(self, *args, **kwargs)
+
+
+subprocess.Popen._execute_child = counting_execute_child
+
+
+def per_package_data(packages, dbpath=None):
+    """
+    Metadata and requires of given packages by `rpm -q` of each package,
+    as PackageTests.run read them before the header pass
+    """
+    rpm = ["/bin/rpm"]
+    if dbpath:
+        rpm += ["--dbpath", dbpath]
+    data = {}
+    for package in packages:
+        metadata = subprocess.Popen(
+            rpm + ["-q", "--qf", META_QUERY_FORMAT, package],
+            stdout=subprocess.PIPE).communicate()[0].split("|")
+        requires = subprocess.Popen(
+            rpm + ["-q", "--requires", package],
+            stdout=subprocess.PIPE).communicate()[0]
+        data[package] = {"SIGNATURE": metadata[0],
+                         "VENDOR": metadata[1],
+                         "PACKAGER": metadata[2],
+                         "BUILD_HOST": metadata[3],
+                         "REQUIRES": list(set(requires.split("\n")[:-1])),
+                         }
+    return data
+
+
+def measure(func, *args):
+    """
+    Run func, returns its result, wall time and processes spawned
+    """
+    spawned[0] = 0
+    started = time.time()
+    result = func(*args)
+    return result, time.time() - started, spawned[0]
+
+
+def differences(header_data, rpm_data):
+    """
+    Packages whose data differs between both ways
+    """
+    differ = []
+    for package, expected in rpm_data.iteritems():
+        found = header_data.get(package)
+        if found is None or \
+                dict(found, REQUIRES=sorted(found["REQUIRES"])) != \
+                dict(expected, REQUIRES=sorted(expected["REQUIRES"])):
+            differ.append(package)
+    return sorted(differ)
+
+
+def main():
+    parser = OptionParser(usage="%prog [--packages N] [--dbpath DIR]")
+    parser.add_option("--packages", type="int", default=None,
+                      help="compare the first N packages only, `rpm -q` "
+                           "of all packages may take minutes")
+    parser.add_option("--dbpath", default=None,
+                      help="rpmdb directory to read instead of the "
+                           "system one")
+    options, _ = parser.parse_args()
+
+    rpmdb = RPMDBUtils(dbpath=options.dbpath)
+    header_data, header_time, header_spawns = measure(
+        rpmdb.installed_packages_data)
+    packages = sorted(header_data)[:options.packages]
+    rpm_data, rpm_time, rpm_spawns = measure(per_package_data, packages,
+                                             options.dbpath)
+
+    result = {"packages": len(header_data),
+              "compared": len(packages),
+              "header_pass": {"wall_time": round(header_time, 3),
+                              "processes": header_spawns},
+              "rpm_per_package": {"wall_time": round(rpm_time, 3),
+                                  "processes": rpm_spawns},
+              "differences": differences(header_data, rpm_data),
+              }
+    print json.dumps(result, indent=4, sort_keys=True)
+    return 1 if result["differences"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
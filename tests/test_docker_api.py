@@ -0,0 +1,266 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from cStringIO import StringIO
+from SocketServer import ThreadingMixIn, UnixStreamServer
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "Introspection"))
+
+import dockerutils  # noqa: E402
+import introexceptions  # noqa: E402
+
+
+class FakeDockerServer(ThreadingMixIn, UnixStreamServer):
+    """
+    Docker daemon stand-in on a unix socket, answering with canned
+    responses by (method, path) and recording the requests it got
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, responses):
+        UnixStreamServer.__init__(self, socket_path, FakeDockerHandler)
+        self.responses = responses
+        self.requests = []
+        self.connections = 0
+
+    def get_request(self):
+        self.connections += 1
+        return UnixStreamServer.get_request(self)
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                body.append(self.rfile.read(size))
+                self.rfile.readline()
+            return "".join(body)
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def respond(self):
+        path = self.path.split("?", 1)[0]
+        self.server.requests.append((self.command, self.path,
+                                     self.read_body()))
+        status, body, chunked = self.server.responses.get(
+            (self.command, path), (404, {"message": "no such path"}, False))
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for n in range(0, len(body), 7):
+                chunk = body[n:n + 7]
+                self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write("0\r\n\r\n")
+        else:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_DELETE = respond
+
+
+class FakeDockerTestCase(unittest.TestCase):
+    """
+    Docker API utils talking to a fake daemon serving responses
+    """
+    responses = {}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, "docker.sock")
+        self.server = FakeDockerServer(self.socket_path, self.responses)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        self.docker = dockerutils.DockerAPIUtils(self.socket_path)
+
+    def tearDown(self):
+        # handlers of keep-alive connections return once they are closed
+        while not self.docker.api.pool.empty():
+            self.docker.api.pool.get_nowait().close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+
+class DockerAPITest(FakeDockerTestCase):
+
+    responses = {
+        ("GET", "/images/json"): (200, [
+            {"Id": "sha256:aaa", "RepoTags": ["fedora:latest"],
+             "RepoDigests": ["fedora@sha256:ddd"]},
+            {"Id": "sha256:bbb", "RepoTags": ["<none>:<none>"],
+             "RepoDigests": ["<none>@<none>"]},
+        ], False),
+        ("POST", "/containers/create"): (201, {"Id": "c0ffee"}, False),
+        ("POST", "/containers/c0ffee/start"): (204, "", False),
+        ("POST", "/containers/c0ffee/wait"): (200, {"StatusCode": 0}, False),
+        ("GET", "/images/fedora/json"): (
+            200, {"Id": "sha256:aaa", "Config": {"Env": ["A=" + "x" * 100]}},
+            True),
+        ("POST", "/images/load"): (200, {"stream": "Loaded"}, False),
+        ("GET", "/images/fedora/get"): (200, "tar stream " * 50, True),
+    }
+
+    def test_json_request_decodes_response(self):
+        status, images = self.docker.api.json_request("GET", "/images/json",
+                                                      {"all": 1})
+        self.assertEqual(status, 200)
+        self.assertEqual(images[0]["Id"], "sha256:aaa")
+        self.assertEqual(self.server.requests[0][:2],
+                         ("GET", "/images/json?all=1"))
+
+    def test_list_image_records_drops_untagged(self):
+        records = self.docker.list_image_records()
+        self.assertEqual([record["RepoTags"] for record in records],
+                         [["fedora:latest"], []])
+        self.assertEqual([record["RepoDigests"] for record in records],
+                         [["fedora@sha256:ddd"], []])
+
+    def test_image_presence_by_exact_name(self):
+        self.assertTrue(self.docker.is_image_present("fedora"))
+        self.assertTrue(self.docker.is_image_present("fedora:latest"))
+        self.assertTrue(self.docker.is_image_present("fedora@sha256:ddd"))
+        self.assertTrue(self.docker.is_image_present("sha256:aaa"))
+        # only fedora:latest is present
+        self.assertFalse(self.docker.is_image_present("fedora:30"))
+        self.assertFalse(self.docker.is_image_present("fedora@sha256:eee"))
+
+    def test_connection_is_reused(self):
+        for _ in range(3):
+            self.docker.api.request("GET", "/images/json")
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_create_container_runs_and_waits(self):
+        self.docker.create_container(
+            ["run", "-v", "/tmp/x:/var/tmp/x:Z", "--env", "A=1",
+             "--entrypoint", "/bin/probe", "--name", "introspection_abc",
+             "fedora"])
+        methods_paths = [request[:2] for request in self.server.requests]
+        self.assertEqual(methods_paths, [
+            ("POST", "/containers/create?name=introspection_abc"),
+            ("POST", "/containers/c0ffee/start"),
+            ("POST", "/containers/c0ffee/wait"),
+        ])
+        config = json.loads(self.server.requests[0][2])
+        self.assertEqual(config["Image"], "fedora")
+        self.assertEqual(config["Entrypoint"], ["/bin/probe"])
+        self.assertEqual(config["Env"], ["A=1"])
+        self.assertEqual(config["HostConfig"]["Binds"],
+                         ["/tmp/x:/var/tmp/x:Z"])
+
+    def test_create_container_raises_on_error(self):
+        self.server.responses = dict(self.responses)
+        self.server.responses[("POST", "/containers/create")] = (
+            500, {"message": "boom"}, False)
+        self.assertRaises(introexceptions.CannotCreateContainer,
+                          self.docker.create_container,
+                          ["run", "--name", "x", "fedora"])
+
+    def test_create_container_raises_on_exit_code(self):
+        self.server.responses = dict(self.responses)
+        self.server.responses[("POST", "/containers/c0ffee/wait")] = (
+            200, {"StatusCode": 1}, False)
+        self.server.responses[("GET", "/containers/c0ffee/logs")] = (
+            200, "\x02\x00\x00\x00\x00\x00\x00\x0bprobe fail\n", False)
+        try:
+            self.docker.create_container(["run", "--name", "x", "fedora"])
+        except introexceptions.CannotCreateContainer as e:
+            self.assertIn("Exit code:1", e.msg)
+            self.assertIn("probe fail", e.msg)
+        else:
+            self.fail("CannotCreateContainer not raised")
+
+    def test_chunked_response(self):
+        inspection = self.docker.query_image_inspection("fedora")
+        self.assertEqual(inspection["Config"]["Env"], ["A=" + "x" * 100])
+
+    def test_chunked_request(self):
+        archive = "layer data " * 10000
+        self.docker.load_image_stream(StringIO(archive))
+        method, path, body = self.server.requests[0]
+        self.assertEqual((method, path), ("POST", "/images/load"))
+        self.assertEqual(body, archive)
+
+    def test_stream_response(self):
+        archive = self.docker.save_image_stream(
+            "fedora", lambda stream: stream.read())
+        self.assertEqual(archive, "tar stream " * 50)
+
+
+class DockerAPIExecTest(FakeDockerTestCase):
+
+    responses = {
+        ("POST", "/containers/warm/exec"): (201, {"Id": "e1"}, False),
+        ("POST", "/exec/e1/start"): (200, "probe output", True),
+        ("GET", "/exec/e1/json"): (200, {"ExitCode": 0}, False),
+    }
+
+    def setUp(self):
+        FakeDockerTestCase.setUp(self)
+        # errors are described by the installed config, which may predate
+        # the errors of this tree
+        with open(os.path.join(ROOT_DIR, "etc", "Introspection",
+                               introexceptions.PROBE_CONFIG)) as fin:
+            introexceptions.PROBE_ERRORS.update(json.load(fin))
+
+    def test_exec_runs_cmd(self):
+        self.docker.exec_in_container("warm", ["/bin/probe"],
+                                      env={"A": "1"}, user="root")
+        config = json.loads(self.server.requests[0][2])
+        self.assertEqual(config["Cmd"], ["/bin/probe"])
+        self.assertEqual(config["Env"], ["A=1"])
+        self.assertEqual(config["User"], "root")
+        self.assertEqual([request[:2] for request in self.server.requests], [
+            ("POST", "/containers/warm/exec"),
+            ("POST", "/exec/e1/start"),
+            ("GET", "/exec/e1/json"),
+        ])
+
+    def assertExecFails(self, path, response):
+        self.server.responses = dict(self.responses)
+        self.server.responses[path] = response
+        self.assertRaises(introexceptions.CannotExecInContainer,
+                          self.docker.exec_in_container, "warm",
+                          ["/bin/probe"])
+
+    def test_exec_start_error_raises(self):
+        self.assertExecFails(("POST", "/exec/e1/start"),
+                             (409, {"message": "not running"}, False))
+
+    def test_exec_failure_raises(self):
+        self.assertExecFails(("GET", "/exec/e1/json"),
+                             (200, {"ExitCode": 1}, False))
+
+    def test_exec_without_exit_code_raises(self):
+        self.assertExecFails(("GET", "/exec/e1/json"),
+                             (200, {"ExitCode": None}, False))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from struct import pack
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "Introspection"))
+
+try:
+    import elf_tests
+except ImportError:
+    # rpm bindings come with rpm, they can not be installed by pip
+    elf_tests = None
+
+# virtual address the single PT_LOAD segment of built files is mapped at
+BASE_ADDRESS = 0x400000
+
+
+def build_elf(elf_class=2, data=1, elf_type=3, machine=62, interpreter="",
+              needed=(), soname="", runpath="", flags_1=0):
+    """
+    Contents of an ELF file with a program interpreter, if any, and a
+    dynamic section of given entries
+    """
+    order = "<" if data == 1 else ">"
+    header_size = 64 if elf_class == 2 else 52
+    phdr_format = order + elf_tests.ELF_PHDR_FORMATS[elf_class]
+    dyn_format = order + elf_tests.ELF_DYN_FORMATS[elf_class]
+
+    strtab = "\0"
+    dynamic = []
+    for tag, values in ((elf_tests.DT_NEEDED, needed),
+                        (elf_tests.DT_SONAME, [soname] if soname else []),
+                        (elf_tests.DT_RUNPATH, [runpath] if runpath else [])):
+        for value in values:
+            dynamic.append((tag, len(strtab)))
+            strtab += value + "\0"
+    if flags_1:
+        dynamic.append((elf_tests.DT_FLAGS_1, flags_1))
+
+    phnum = 3 if interpreter else 2
+    phoff = header_size
+    interp_offset = phoff + phnum * len(pack(phdr_format, *[0] * 8))
+    interp = interpreter + "\0" if interpreter else ""
+    strtab_offset = interp_offset + len(interp)
+    dynamic_offset = strtab_offset + len(strtab)
+    dynamic += [(elf_tests.DT_STRTAB, BASE_ADDRESS + strtab_offset),
+                (elf_tests.DT_STRSZ, len(strtab)),
+                (elf_tests.DT_NULL, 0)]
+    dynamic_table = "".join(pack(dyn_format, tag, value)
+                            for tag, value in dynamic)
+    size = dynamic_offset + len(dynamic_table)
+
+    def phdr(p_type, offset, filesz):
+        vaddr = BASE_ADDRESS + offset
+        if elf_class == 2:
+            return pack(phdr_format, p_type, 0, offset, vaddr, vaddr,
+                        filesz, filesz, 0)
+        return pack(phdr_format, p_type, offset, vaddr, vaddr, filesz,
+                    filesz, 0, 0)
+
+    phdrs = phdr(elf_tests.PT_LOAD, 0, size)
+    if interpreter:
+        phdrs += phdr(elf_tests.PT_INTERP, interp_offset, len(interp))
+    phdrs += phdr(elf_tests.PT_DYNAMIC, dynamic_offset, len(dynamic_table))
+    ident = elf_tests.ELF_MAGIC + chr(elf_class) + chr(data) + chr(1) + \
+        "\0" * 9
+    header = ident + pack(order + elf_tests.ELF_HEADER_FORMATS[elf_class],
+                          elf_type, machine, 1, 0, phoff, 0, 0,
+                          header_size, len(phdr(0, 0, 0)), phnum, 0, 0, 0)
+    return header + phdrs + interp + strtab + dynamic_table
+
+
+@unittest.skipIf(elf_tests is None, "rpm bindings are not installed")
+class ELFParserTest(unittest.TestCase):
+    """
+    ELF headers, program headers and dynamic sections read by ELFTests
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.elf = elf_tests.ELFTests(package_tests=object())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as fout:
+            fout.write(content)
+        return path
+
+    def test_pie_executable(self):
+        path = self.write("app", build_elf(
+            interpreter="/lib64/ld-linux-x86-64.so.2",
+            needed=["libc.so.6", "libm.so.6"], runpath="$ORIGIN/../lib:/opt",
+            flags_1=elf_tests.DF_1_PIE))
+        elf = self.elf.parse_file(path)
+        self.assertEqual(elf["class"], "ELF64")
+        self.assertEqual(elf["endianness"], "little")
+        self.assertEqual(elf["machine"], "x86-64")
+        self.assertEqual(elf["type"], "pie_executable")
+        self.assertEqual(elf["interpreter"], "/lib64/ld-linux-x86-64.so.2")
+        self.assertEqual(elf["needed"], ["libc.so.6", "libm.so.6"])
+        self.assertEqual(elf["runpath"], ["$ORIGIN/../lib", "/opt"])
+        self.assertEqual(elf["rpath"], [])
+
+    def test_shared_object_with_interpreter(self):
+        # like libc, which can be run
+        path = self.write("libc.so.6", build_elf(
+            interpreter="/lib64/ld-linux-x86-64.so.2", soname="libc.so.6"))
+        elf = self.elf.parse_file(path)
+        self.assertEqual(elf["type"], "shared_object")
+        self.assertEqual(elf["soname"], "libc.so.6")
+
+    def test_executables_of_elf32_big_endian(self):
+        path = self.write("static", build_elf(elf_class=1, data=2,
+                                              elf_type=elf_tests.ET_EXEC,
+                                              machine=20))
+        elf = self.elf.parse_file(path)
+        self.assertEqual((elf["class"], elf["endianness"], elf["machine"],
+                          elf["type"]),
+                         ("ELF32", "big", "PowerPC", "static_executable"))
+        path = self.write("dynamic", build_elf(elf_class=1, data=2,
+                                               elf_type=elf_tests.ET_EXEC,
+                                               needed=["libc.so.6"]))
+        elf = self.elf.parse_file(path)
+        self.assertEqual(elf["type"], "dynamic_executable")
+        self.assertEqual(elf["needed"], ["libc.so.6"])
+
+    def test_other_files_are_not_elf(self):
+        script = self.write("script", "#!/bin/sh\necho hello\n" * 10)
+        self.assertEqual(self.elf.parse_file(script), None)
+        truncated = self.write("truncated", build_elf()[:20])
+        self.assertEqual(self.elf.parse_file(truncated), None)
+        bad_class = self.write("bad_class", elf_tests.ELF_MAGIC + "\x07" +
+                               "\0" * 100)
+        self.assertEqual(self.elf.parse_file(bad_class), None)
+
+    def test_classify_caches_elf_files_only(self):
+        library = self.write("libfoo.so", build_elf(soname="libfoo.so"))
+        script = self.write("script", "#!/bin/sh\n")
+        os.symlink(library, os.path.join(self.tmpdir, "link"))
+        self.assertEqual(self.elf.classify_file(script), None)
+        self.assertEqual(self.elf.classify_file(
+            os.path.join(self.tmpdir, "link")), None)
+        self.assertEqual(self.elf.classify_file(library)["soname"],
+                         "libfoo.so")
+        self.assertEqual(sorted(self.elf.parse_cache), [library])
+        # a cached file is not parsed again while unchanged
+        self.elf.parse_file = None
+        self.assertEqual(self.elf.classify_file(library)["soname"],
+                         "libfoo.so")
+
+    def test_parse_cache_is_filtered_and_bounded(self):
+        cache_file = os.path.join(self.tmpdir, elf_tests.ELF_PARSE_CACHE)
+        with open(cache_file, "wb") as fout:
+            json.dump({"/a": {"key": [1], "elf": {"type": "core"},
+                              "used": 3},
+                       "/b": {"key": [1], "elf": None, "used": 3},
+                       "/c": {"key": [1], "elf": {"type": "core"},
+                              "used": 1},
+                       "/d": {"key": [1], "elf": {"type": "core"},
+                              "used": 2}}, fout)
+        elf = elf_tests.ELFTests(cache_file, package_tests=object())
+        self.assertEqual(sorted(elf.parse_cache), ["/a", "/c", "/d"])
+        elf.save_parse_cache(max_entries=2)
+        with open(cache_file) as fin:
+            self.assertEqual(sorted(json.load(fin)), ["/a", "/d"])
+
+
+if __name__ == "__main__":
+    unittest.main()
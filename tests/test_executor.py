@@ -0,0 +1,90 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "Introspection"))
+
+from executor import (CommandCancelled, CommandTimeout,  # noqa: E402
+                      Executor)
+
+
+class ExecutorCancelTest(unittest.TestCase):
+    """
+    Commands killed by cancel() of their group
+    """
+    def setUp(self):
+        self.executor = Executor()
+
+    def run_in_thread(self, group, cmd):
+        """
+        Run cmd in group on a thread of its own, returns the thread and
+        the list the error of the command is appended to
+        """
+        errors = []
+
+        def run():
+            with self.executor.group(group):
+                try:
+                    self.executor.run(cmd, timeout=30)
+                except Exception as e:
+                    errors.append(e)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread, errors
+
+    def wait_running(self, count):
+        deadline = time.time() + 10
+        while len(self.executor.running) < count:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+
+    def test_cancel_kills_only_commands_of_group(self):
+        cancelled, cancelled_errors = self.run_in_thread("a", ["sleep", "30"])
+        other, other_errors = self.run_in_thread("b", ["sleep", "0.5"])
+        self.wait_running(2)
+        started = time.time()
+        self.executor.cancel("a")
+        cancelled.join(10)
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual(len(cancelled_errors), 1)
+        self.assertTrue(isinstance(cancelled_errors[0], CommandCancelled))
+        other.join(10)
+        self.assertEqual(other_errors, [])
+        self.assertEqual(self.executor.summary()["cancelled"], 1)
+
+    def test_cancelled_group_starts_no_commands_until_reset(self):
+        self.executor.cancel("a")
+        with self.executor.group("a"):
+            self.assertRaises(CommandCancelled, self.executor.run, ["true"])
+        # the default group is not cancelled
+        self.assertEqual(self.executor.run(["echo", "x"]), ("x\n", ""))
+        self.executor.reset("a")
+        with self.executor.group("a"):
+            self.assertEqual(self.executor.run(["echo", "y"]), ("y\n", ""))
+
+    def test_cancel_all_groups(self):
+        thread, errors = self.run_in_thread("a", ["sleep", "30"])
+        self.wait_running(1)
+        self.executor.cancel()
+        thread.join(10)
+        self.assertTrue(isinstance(errors[0], CommandCancelled))
+        self.assertRaises(CommandCancelled, self.executor.run, ["true"])
+        # resetting a single group does not undo cancelling all
+        self.executor.reset("a")
+        self.assertRaises(CommandCancelled, self.executor.run, ["true"])
+        self.executor.reset()
+        self.assertEqual(self.executor.run(["true"]), ("", ""))
+
+    def test_timeout_is_not_reported_as_cancel(self):
+        self.assertRaises(CommandTimeout, self.executor.run,
+                          ["sleep", "30"], timeout=0.2)
+        self.assertEqual(self.executor.summary()["timed_out"], 1)
+        self.assertEqual(self.executor.summary()["cancelled"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
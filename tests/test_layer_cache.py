@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "Introspection"))
+
+import constants  # noqa: E402
+
+from layer_cache import LayerCache, chain_ids  # noqa: E402
+from layer_delta import LayerDelta  # noqa: E402
+
+DIFF_IDS = ["sha256:" + "a" * 64, "sha256:" + "b" * 64,
+            "sha256:" + "c" * 64]
+
+
+class StubInspections(object):
+    """
+    Image inspections given by image name
+    """
+    def __init__(self, inspections):
+        self.inspections = inspections
+
+    def inspect_image(self, image):
+        return self.inspections[image]
+
+
+def inspection(layers, env=(), user=""):
+    return {"RootFS": {"Layers": layers},
+            "GraphDriver": {"Name": "overlay2"},
+            "Config": {"Env": list(env), "User": user}}
+
+
+class ChainIDsTest(unittest.TestCase):
+    """
+    Chain IDs of layers as docker computes them
+    """
+    def test_chain_ids(self):
+        chain = chain_ids(DIFF_IDS)
+        self.assertEqual(chain[0], DIFF_IDS[0])
+        second = "sha256:" + hashlib.sha256(
+            DIFF_IDS[0] + " " + DIFF_IDS[1]).hexdigest()
+        third = "sha256:" + hashlib.sha256(
+            second + " " + DIFF_IDS[2]).hexdigest()
+        self.assertEqual(chain[1:], [second, third])
+        self.assertEqual(chain_ids([]), [])
+
+    def test_chain_ids_depend_on_lower_layers(self):
+        self.assertNotEqual(chain_ids(DIFF_IDS[1:])[-1],
+                            chain_ids(DIFF_IDS)[-1])
+
+
+class LayerCacheTest(unittest.TestCase):
+    """
+    Results cached by chain ID and configuration
+    """
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = LayerCache(cache_dir=self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_results_are_kept_per_configuration(self):
+        self.cache.put(DIFF_IDS[0], {"packages": ["a"]}, {"mode": "fast"})
+        self.assertEqual(self.cache.get(DIFF_IDS[0], {"mode": "fast"})
+                         ["packages"], ["a"])
+        self.assertEqual(self.cache.get(DIFF_IDS[0], {"mode": "full"}),
+                         None)
+        self.assertEqual(self.cache.get(DIFF_IDS[1], {"mode": "fast"}),
+                         None)
+
+    def test_nearest_is_topmost_cached_layer(self):
+        chain = chain_ids(DIFF_IDS)
+        self.assertEqual(self.cache.nearest(chain), (None, None))
+        self.cache.put(chain[0], {"packages": ["a"]})
+        self.cache.put(chain[1], {"packages": ["b"]})
+        n, result = self.cache.nearest(chain)
+        self.assertEqual((n, result["packages"]), (1, ["b"]))
+
+    def test_least_recently_used_results_are_evicted(self):
+        self.cache.put(DIFF_IDS[0], {"data": "x" * 100})
+        os.utime(self.cache.path_of(DIFF_IDS[0]), (1, 1))
+        self.cache.max_bytes = 250
+        self.cache.put(DIFF_IDS[1], {"data": "y" * 100})
+        self.cache.put(DIFF_IDS[2], {"data": "z" * 100})
+        self.assertEqual(self.cache.get(DIFF_IDS[0]), None)
+        self.assertTrue(self.cache.get(DIFF_IDS[2]) is not None)
+
+    def test_corrupted_result_is_a_miss(self):
+        with open(self.cache.path_of(DIFF_IDS[0]), "wb") as fout:
+            fout.write("{")
+        self.assertEqual(self.cache.get(DIFF_IDS[0]), None)
+
+
+class LayerDeltaTest(unittest.TestCase):
+    """
+    Results of images reused by layer chain
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = LayerCache(cache_dir=os.path.join(self.tmpdir, "cache"))
+        self.base = inspection(DIFF_IDS[:1], ["PATH=/usr/bin"])
+        self.derived = inspection(DIFF_IDS, ["PATH=/usr/bin"])
+        self.inspections = StubInspections({"base": self.base,
+                                            "derived": self.derived})
+        self.delta = LayerDelta(cache=self.cache, config={"mode": "fast"},
+                                inspections=self.inspections)
+        self.test_dir = os.path.join(self.tmpdir, "test")
+        os.mkdir(self.test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_reports(self, packages, issues):
+        with open(os.path.join(self.test_dir, constants.PACKAGE_REPORT),
+                  "wb") as fout:
+            json.dump({"Installed_Packages": dict(
+                (name, {}) for name in packages)}, fout)
+        with open(os.path.join(self.test_dir, constants.RPM_VERIFY_REPORT),
+                  "wb") as fout:
+            json.dump({"rpmVa_issues": issues}, fout)
+
+    def upper_dir(self, files):
+        upper_dir = tempfile.mkdtemp(dir=self.tmpdir)
+        for name in files:
+            path = os.path.join(upper_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "wb").close()
+        return upper_dir
+
+    def test_layer_chain_is_keyed_by_chain_ids(self):
+        self.assertEqual([layer["key"] for layer in
+                          self.delta.layer_chain("derived")],
+                         chain_ids(DIFF_IDS))
+
+    def test_config_of_image(self):
+        self.derived["Config"].update(
+            Env=["PATH=/bin", "HOME=/root", "LD_LIBRARY_PATH=/opt/lib"],
+            User="app")
+        self.assertEqual(self.delta.config_of("derived"),
+                         {"probes": {"mode": "fast"},
+                          "env": {"PATH": "/bin",
+                                  "LD_LIBRARY_PATH": "/opt/lib"},
+                          "user": "app"})
+        self.delta.user = "root"
+        self.assertEqual(self.delta.config_of("derived")["user"], "root")
+
+    def test_stored_image_is_restored(self):
+        self.write_reports(["bash"], [])
+        self.assertTrue(self.delta.store("base", self.test_dir))
+        restored_dir = os.path.join(self.tmpdir, "restored")
+        os.mkdir(restored_dir)
+        self.assertTrue(self.delta.restore("base", restored_dir))
+        self.assertEqual(sorted(os.listdir(restored_dir)),
+                         sorted([constants.PACKAGE_REPORT,
+                                 constants.RPM_VERIFY_REPORT]))
+        # not with another image config
+        self.base["Config"]["User"] = "app"
+        self.assertFalse(self.delta.restore("base", restored_dir))
+
+    def test_derived_image_gets_delta_of_upper_layers(self):
+        self.write_reports(["bash"], [["S.5....T.", "/usr/bin/bash",
+                                       "bash"]])
+        self.delta.store("base", self.test_dir)
+        upper_dirs = [self.upper_dir(["usr/bin/tool", "etc/.wh.old"]),
+                      self.upper_dir(["opt/app/.wh..wh..opq",
+                                      "opt/app/run"])]
+        chain = self.delta.layer_chain("derived")
+        for layer, upper_dir in zip(chain[1:], upper_dirs):
+            layer["upper_dir"] = lambda u=upper_dir: u
+        delta = self.delta.find_delta(chain,
+                                      self.delta.config_of("derived"))
+        self.assertEqual(delta["parent_image"], chain[0]["key"])
+        self.assertEqual(delta["parent_packages"], ["bash"])
+        self.assertEqual(delta["changed_files"],
+                         ["/etc", "/etc/old", "/opt", "/opt/app",
+                          "/opt/app/run", "/usr", "/usr/bin",
+                          "/usr/bin/tool"])
+        self.assertEqual(delta["opaque_dirs"], ["/opt/app"])
+
+    def test_no_delta_without_upper_dir(self):
+        self.write_reports(["bash"], [])
+        self.delta.store("base", self.test_dir)
+        chain = self.delta.layer_chain("derived")
+        for layer in chain:
+            layer["upper_dir"] = lambda: None
+        self.assertEqual(self.delta.find_delta(
+            chain, self.delta.config_of("derived")), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+from cStringIO import StringIO
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "Introspection"))
+
+try:
+    import offline_analysis
+except ImportError:
+    # rpm bindings come with rpm, they can not be installed by pip
+    offline_analysis = None
+
+
+def layer_tar(members):
+    """
+    Layer tar stream of members given as (name, type, linkname or
+    content)
+    """
+    data = StringIO()
+    tar = tarfile.open(fileobj=data, mode="w")
+    for name, member_type, value in members:
+        info = tarfile.TarInfo(name)
+        info.type = member_type
+        info.mode = 0o755
+        content = None
+        if member_type == tarfile.REGTYPE:
+            info.size = len(value)
+            content = StringIO(value)
+        elif member_type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+            info.linkname = value
+        tar.addfile(info, content)
+    tar.close()
+    data.seek(0)
+    return tarfile.open(fileobj=data, mode="r|")
+
+
+def regular(name, content="x"):
+    return (name, tarfile.REGTYPE, content)
+
+
+def directory(name):
+    return (name, tarfile.DIRTYPE, None)
+
+
+def symlink(name, target):
+    return (name, tarfile.SYMTYPE, target)
+
+
+@unittest.skipIf(offline_analysis is None, "rpm bindings are not installed")
+class VirtualFSTest(unittest.TestCase):
+    """
+    Layers applied into the VirtualFS of an image
+    """
+    def setUp(self):
+        self.capture_dir = tempfile.mkdtemp()
+        self.vfs = offline_analysis.VirtualFS()
+
+    def tearDown(self):
+        shutil.rmtree(self.capture_dir)
+
+    def apply(self, *members):
+        layer = offline_analysis.LayerIndex(self.capture_dir)
+        self.vfs.apply(layer.read(layer_tar(members)))
+
+    def test_whiteout_hides_file_and_tree_of_lower_layers(self):
+        self.apply(directory("usr/"), directory("usr/bin/"),
+                   regular("usr/bin/a"), regular("usr/bin/b"),
+                   directory("opt/"), directory("opt/app/"),
+                   regular("opt/app/tool"))
+        self.apply(regular("usr/bin/.wh.a"), regular("opt/.wh.app"))
+        self.assertEqual(self.vfs.lstat("/usr/bin/a"), None)
+        self.assertEqual(self.vfs.lstat("/opt/app"), None)
+        self.assertEqual(self.vfs.lstat("/opt/app/tool"), None)
+        self.assertEqual(self.vfs.files_below("/"), ["/usr/bin/b"])
+
+    def test_whiteout_does_not_hide_file_of_its_own_layer(self):
+        self.apply(regular("usr/bin/a", "old"))
+        self.apply(regular("usr/bin/.wh.a"), regular("usr/bin/a", "new"))
+        self.assertEqual(self.vfs.lstat("/usr/bin/a").st_size, 3)
+
+    def test_opaque_directory_replaces_lower_contents(self):
+        self.apply(directory("etc/"), directory("etc/app/"),
+                   regular("etc/app/old.conf"), directory("etc/app/sub/"),
+                   regular("etc/app/sub/deep"), regular("etc/other"))
+        self.apply(directory("etc/app/"), regular("etc/app/.wh..wh..opq"),
+                   regular("etc/app/new.conf"))
+        self.assertTrue(self.vfs.lstat("/etc/app") is not None)
+        self.assertEqual(sorted(self.vfs.files_below("/etc")),
+                         ["/etc/app/new.conf", "/etc/other"])
+
+    def test_directory_replaced_by_file_loses_contents(self):
+        self.apply(directory("lib/"), regular("lib/libfoo.so"))
+        self.apply(symlink("lib", "usr/lib"),
+                   directory("usr/"), directory("usr/lib/"),
+                   regular("usr/lib/libbar.so"))
+        self.assertEqual(self.vfs.lstat("/lib/libfoo.so"), None)
+        self.assertEqual(self.vfs.realpath("/lib/libbar.so"),
+                         "/usr/lib/libbar.so")
+        self.assertTrue(self.vfs.lstat("/lib/libbar.so") is not None)
+
+    def test_hardlink_takes_data_of_its_target(self):
+        self.apply(regular("usr/bin/python2.7", "python"),
+                   ("usr/bin/python2", tarfile.LNKTYPE, "usr/bin/python2.7"))
+        self.assertEqual(self.vfs.lstat("/usr/bin/python2").st_size, 6)
+
+    def test_symlinks_to_directories_are_neither_followed_nor_listed(self):
+        self.apply(directory("usr/"), directory("usr/lib/"),
+                   regular("usr/lib/liba.so"),
+                   symlink("usr/lib/share", "/usr/share"),
+                   regular("usr/share/doc"),
+                   symlink("usr/lib/libb.so", "liba.so"),
+                   symlink("usr/lib/dangling", "missing"))
+        self.assertEqual(sorted(self.vfs.files_below("/usr/lib")),
+                         ["/usr/lib/dangling", "/usr/lib/liba.so",
+                          "/usr/lib/libb.so"])
+
+    def test_captured_files_are_read(self):
+        self.apply(directory("etc/"), regular("etc/passwd", "root:x:0:0"),
+                   regular("etc/hosts", "localhost"))
+        self.assertEqual(self.vfs.read_file("/etc/passwd"), "root:x:0:0")
+        self.assertEqual(self.vfs.read_file("/etc/hosts"), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
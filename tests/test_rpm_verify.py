@@ -0,0 +1,239 @@
+import hashlib
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "Introspection"))
+
+try:
+    import rpm_verify_tests
+    from rpm_verify_tests import NativeVerifier
+except ImportError:
+    # rpm bindings come with rpm, they can not be installed by pip
+    rpm_verify_tests = None
+    NativeVerifier = object
+
+
+class FakeStat(object):
+    """
+    lstat result of a file of StubVerifier
+    """
+    def __init__(self, mode, size=0, uid=0, gid=0, mtime=1000, rdev=0):
+        self.st_mode = mode
+        self.st_size = size
+        self.st_uid = uid
+        self.st_gid = gid
+        self.st_mtime = mtime
+        self.st_rdev = rdev
+
+
+class StubVerifier(NativeVerifier):
+    """
+    Verifier of files given as FakeStat, link target and content by path
+    """
+    def __init__(self, files, mode="fast", digest_paths=None,
+                 rpmdb=None):
+        NativeVerifier.__init__(self, rpmdb, mode, digest_paths)
+        self.files = files
+
+    def lstat(self, filepath):
+        if filepath not in self.files:
+            return None
+        return self.files[filepath][0]
+
+    def readlink(self, filepath):
+        return self.files[filepath][1]
+
+    def file_digest(self, filepath, algo):
+        content = self.files[filepath][2]
+        if content is None:
+            return None
+        return hashlib.new(rpm_verify_tests.DIGEST_ALGOS[algo],
+                           content).hexdigest()
+
+    def user_name(self, uid):
+        return {0: "root", 1000: "bob"}.get(uid)
+
+    def group_name(self, gid):
+        return {0: "root", 1000: "bob"}.get(gid)
+
+
+def attributes(filename, mode=stat.S_IFREG | 0o755, size=5, content="hello",
+               **attrs):
+    """
+    File attributes as read from an rpmdb header, those of a file
+    matching FakeStat defaults unless given
+    """
+    result = {"filename": filename, "size": size, "mode": mode,
+              "mtime": 1000, "rdev": 0, "user": "root", "group": "root",
+              "linkto": "", "digest": hashlib.sha256(content).hexdigest(),
+              "digest_algo": 8, "flags": 0, "verify_flags": -1, "state": 0}
+    result.update(attrs)
+    return result
+
+
+@unittest.skipIf(rpm_verify_tests is None, "rpm bindings are not installed")
+class NativeVerifierTest(unittest.TestCase):
+    """
+    rpm -V result strings of NativeVerifier
+    """
+    def regular(self, size=5, content="hello", mtime=1000, uid=0,
+                mode=0o755):
+        return (FakeStat(stat.S_IFREG | mode, size=size, mtime=mtime,
+                         uid=uid), None, content)
+
+    def test_unchanged_file_passes(self):
+        verifier = StubVerifier({"/usr/bin/ls": self.regular()}, "full")
+        self.assertEqual(verifier.verify_file(attributes("/usr/bin/ls")),
+                         None)
+
+    def test_changed_metadata_fast_mode(self):
+        verifier = StubVerifier({"/usr/bin/ls": self.regular(
+            size=6, content="hello!", mtime=2000)})
+        self.assertEqual(verifier.verify_file(attributes("/usr/bin/ls")),
+                         "S......T.")
+
+    def test_changed_metadata_full_mode_compares_digest(self):
+        verifier = StubVerifier({"/usr/bin/ls": self.regular(
+            size=6, content="hello!", mtime=2000)}, "full")
+        self.assertEqual(verifier.verify_file(attributes("/usr/bin/ls")),
+                         "S.5....T.")
+
+    def test_full_mode_digests_unchanged_files_of_digest_paths(self):
+        files = {"/usr/bin/ls": self.regular(content="jello"),
+                 "/usr/bin/cat": self.regular(content="jello")}
+        verifier = StubVerifier(files, "full", ["/usr/bin/ls"])
+        self.assertEqual(verifier.verify_file(attributes("/usr/bin/ls")),
+                         "..5......")
+        self.assertEqual(verifier.verify_file(attributes("/usr/bin/cat")),
+                         None)
+        fast = StubVerifier(files, "fast", ["/usr/bin/ls"])
+        self.assertEqual(fast.verify_file(attributes("/usr/bin/ls")), None)
+
+    def test_unreadable_file_digest(self):
+        verifier = StubVerifier({"/usr/bin/ls": self.regular(content=None)},
+                                "full", ["/usr/bin/ls"])
+        self.assertEqual(verifier.verify_file(attributes("/usr/bin/ls")),
+                         "..?......")
+
+    def test_owner_and_mode(self):
+        verifier = StubVerifier({"/usr/bin/ls": self.regular(
+            uid=1000, mode=0o4755)})
+        self.assertEqual(verifier.verify_file(attributes("/usr/bin/ls")),
+                         ".M...U...")
+
+    def test_directory_checks_narrowed_to_metadata(self):
+        verifier = StubVerifier({"/etc/x": (FakeStat(
+            stat.S_IFDIR | 0o700, size=4096, mtime=2000), None, None)},
+            "full")
+        attrs = attributes("/etc/x", mode=stat.S_IFDIR | 0o755, size=0)
+        self.assertEqual(verifier.verify_file(attrs), ".M.......")
+
+    def test_symlink_target(self):
+        files = {"/lib/a": (FakeStat(stat.S_IFLNK | 0o777, size=9,
+                                     mtime=2000), "libb.so.1", None),
+                 "/lib/b": (FakeStat(stat.S_IFLNK | 0o777), None, None)}
+        verifier = StubVerifier(files, "full")
+        attrs = attributes("/lib/a", mode=stat.S_IFLNK | 0o777, size=8,
+                           linkto="liba.so.1")
+        # size, mtime and mode of a symlink are not verified
+        self.assertEqual(verifier.verify_file(attrs), "....L....")
+        attrs = attributes("/lib/b", mode=stat.S_IFLNK | 0o777,
+                           linkto="libb.so.1")
+        self.assertEqual(verifier.verify_file(attrs), "....?....")
+
+    def test_regular_file_link_and_rdev_not_verified(self):
+        verifier = StubVerifier({"/usr/bin/ls": self.regular()})
+        attrs = attributes("/usr/bin/ls", linkto="elsewhere", rdev=3)
+        self.assertEqual(verifier.verify_file(attrs), None)
+
+    def test_file_states(self):
+        verifier = StubVerifier({"/usr/bin/ls": self.regular(
+            size=6, uid=1000)})
+        replaced = attributes(
+            "/usr/bin/ls", state=rpm_verify_tests.RPMFILE_STATE_REPLACED)
+        self.assertEqual(verifier.verify_file(replaced), None)
+        wrong_color = attributes(
+            "/usr/bin/ls", state=rpm_verify_tests.RPMFILE_STATE_WRONGCOLOR)
+        self.assertEqual(verifier.verify_file(wrong_color), ".....U...")
+        for state in (rpm_verify_tests.RPMFILE_STATE_NETSHARED,
+                      rpm_verify_tests.RPMFILE_STATE_NOTINSTALLED):
+            self.assertEqual(verifier.verify_file(
+                attributes("/usr/bin/gone", state=state)), None)
+
+    def test_missing_ghost_and_missingok_files(self):
+        verifier = StubVerifier({})
+        self.assertEqual(verifier.verify_file(attributes("/usr/bin/gone")),
+                         "missing")
+        for flag in (rpm_verify_tests.RPMFILE_GHOST,
+                     rpm_verify_tests.RPMFILE_MISSINGOK):
+            self.assertEqual(verifier.verify_file(
+                attributes("/usr/bin/gone", flags=flag)), None)
+
+    def test_verify_flags_of_header_are_honoured(self):
+        verifier = StubVerifier({"/usr/bin/ls": self.regular(
+            size=6, mtime=2000)})
+        attrs = attributes("/usr/bin/ls",
+                           verify_flags=rpm_verify_tests.RPMVERIFY_MTIME)
+        self.assertEqual(verifier.verify_file(attrs), ".......T.")
+
+    def test_config_files_are_not_reported(self):
+        class StubRPMDB(object):
+            def header_of_package(self, nvra):
+                return nvra
+
+            def file_attributes_of_header(self, hdr):
+                return [attributes("/etc/conf",
+                                   flags=rpm_verify_tests.RPMFILE_CONFIG),
+                        attributes("/usr/bin/gone")]
+        verifier = StubVerifier({}, rpmdb=StubRPMDB())
+        self.assertEqual(verifier.verify_packages(["pkg-1-1.x86_64"]),
+                         [("missing", "/usr/bin/gone", "pkg-1-1.x86_64")])
+
+
+@unittest.skipIf(rpm_verify_tests is None, "rpm bindings are not installed")
+class FileDigestTest(unittest.TestCase):
+    """
+    Digests with the algorithm recorded in rpmdb headers
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "file")
+        with open(self.path, "wb") as fout:
+            fout.write("content")
+        self.verifier = NativeVerifier(None, "full")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_algorithm_of_header(self):
+        for algo, name in ((1, "md5"), (2, "sha1"), (8, "sha256"),
+                           (10, "sha512")):
+            self.assertEqual(self.verifier.file_digest(self.path, algo),
+                             hashlib.new(name, "content").hexdigest())
+
+    def test_unreadable_file(self):
+        self.assertEqual(self.verifier.file_digest(
+            os.path.join(self.tmpdir, "missing"), 8), None)
+
+    def test_full_mode_verifies_digest_of_real_file(self):
+        st = os.lstat(self.path)
+        attrs = attributes(self.path, mode=st.st_mode & 0xffff, size=7,
+                           content="content", mtime=int(st.st_mtime),
+                           user=self.verifier.user_name(st.st_uid),
+                           group=self.verifier.group_name(st.st_gid))
+        verifier = NativeVerifier(None, "full", [self.path])
+        self.assertEqual(verifier.verify_file(attrs), None)
+        attrs["digest"] = hashlib.sha256("other").hexdigest()
+        self.assertEqual(verifier.verify_file(attrs), "..5......")
+        attrs.update(digest=hashlib.md5("content").hexdigest(),
+                     digest_algo=1)
+        self.assertEqual(verifier.verify_file(attrs), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
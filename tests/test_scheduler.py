@@ -0,0 +1,157 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "Introspection"))
+
+from executor import get_executor  # noqa: E402
+from scheduler import PhaseError, PhaseScheduler  # noqa: E402
+from test_registry import (CONTAINER, HOST, TestRegistry,  # noqa: E402
+                           UnknownTestError)
+
+
+class PhaseSchedulerTest(unittest.TestCase):
+    """
+    Phases run as a dependency graph
+    """
+    def setUp(self):
+        self.scheduler = PhaseScheduler()
+        self.ran = []
+
+    def phase(self, name, error=None):
+        def run():
+            self.ran.append(name)
+            if error is not None:
+                raise error
+        return run
+
+    def status(self):
+        return dict((name, result["status"]) for name, result in
+                    self.scheduler.results.iteritems())
+
+    def test_phases_run_after_their_requirements(self):
+        self.scheduler.add("report", self.phase("report"),
+                           ["inspection", "probes"])
+        self.scheduler.add("probes", self.phase("probes"), ["inspection"])
+        self.scheduler.add("inspection", self.phase("inspection"))
+        self.scheduler.run()
+        self.assertEqual(self.ran, ["inspection", "probes", "report"])
+        self.assertEqual(set(self.status().values()), set(["passed"]))
+
+    def test_independent_phases_run_concurrently(self):
+        started = threading.Event()
+
+        def first():
+            # does not return unless the other phase runs meanwhile
+            self.assertTrue(started.wait(5))
+        self.scheduler.add("first", first)
+        self.scheduler.add("second", started.set)
+        self.scheduler.run()
+        self.assertEqual(self.status(), {"first": "passed",
+                                         "second": "passed"})
+
+    def test_failed_phase_skips_its_dependents_and_is_raised(self):
+        self.scheduler.add("inspection",
+                           self.phase("inspection", ValueError("bad")))
+        self.scheduler.add("metadata", self.phase("metadata"),
+                           ["inspection"])
+        self.scheduler.add("report", self.phase("report"), ["metadata"])
+        self.scheduler.add("selinux", self.phase("selinux"))
+        self.assertRaises(ValueError, self.scheduler.run)
+        self.assertEqual(self.status(), {"inspection": "failed",
+                                         "metadata": "skipped",
+                                         "report": "skipped",
+                                         "selinux": "passed"})
+        self.assertTrue("metadata" not in self.ran)
+
+    def test_failed_phase_not_fatal_is_not_raised(self):
+        self.scheduler.add("selinux", self.phase("selinux", OSError()),
+                           fatal=False)
+        self.scheduler.add("denials", self.phase("denials"), ["selinux"])
+        self.assertEqual(self.scheduler.run()["selinux"]["status"],
+                         "failed")
+        self.assertEqual(self.status()["denials"], "skipped")
+
+    def test_cycle_and_unknown_requirement_are_rejected(self):
+        self.scheduler.add("a", self.phase("a"), ["b"])
+        self.scheduler.add("b", self.phase("b"), ["a"])
+        self.assertRaises(PhaseError, self.scheduler.run)
+        unknown = PhaseScheduler()
+        unknown.add("a", self.phase("a"), ["missing"])
+        self.assertRaises(PhaseError, unknown.run)
+        self.assertRaises(PhaseError, unknown.add, "a", self.phase("a"))
+        self.assertEqual(self.ran, [])
+
+    def test_failure_cancels_commands_of_other_phases(self):
+        scheduler = PhaseScheduler(cancel_on_failure=True)
+
+        def probes():
+            get_executor().run(["sleep", "30"], timeout=60)
+
+        def inspection():
+            time.sleep(0.2)
+            raise ValueError("bad")
+        scheduler.add("probes", probes)
+        scheduler.add("inspection", inspection)
+        scheduler.add("report", self.phase("report"), ["inspection"])
+        started = time.time()
+        self.assertRaises(ValueError, scheduler.run)
+        self.assertTrue(time.time() - started < 10)
+        self.assertEqual(scheduler.results["probes"]["status"], "cancelled")
+        self.assertEqual(scheduler.results["inspection"]["status"], "failed")
+        self.assertTrue("report" not in self.ran)
+        # the group is reset once the run is over
+        self.assertEqual(get_executor().run(["true"]), ("", ""))
+
+
+class TestRegistryTest(unittest.TestCase):
+    """
+    Selection and scheduling of registered tests
+    """
+    def setUp(self):
+        self.registry = TestRegistry()
+        self.registry.add_resource("inspection", lambda: None)
+        self.registry.add_resource("rpmdb", lambda: None)
+        self.registry.add("metadata", lambda: None, HOST,
+                          needs=["inspection"])
+        self.registry.add("selinux", lambda: None, HOST, fatal=False)
+        self.registry.add("report", lambda: None, HOST,
+                          needs=["metadata"])
+        self.registry.add("package_tests", None, CONTAINER,
+                          needs=["rpmdb"])
+
+    def test_select_all_only_and_skip(self):
+        self.assertEqual(self.registry.select(),
+                         ["metadata", "selinux", "report", "package_tests"])
+        self.assertEqual(self.registry.select(only=["report", "selinux"]),
+                         ["selinux", "report"])
+        self.assertEqual(self.registry.select(skip=["selinux"]),
+                         ["metadata", "report", "package_tests"])
+        self.assertEqual(self.registry.select(only=["selinux"],
+                                              skip=["selinux"]), [])
+
+    def test_select_rejects_unknown_names(self):
+        self.assertRaises(UnknownTestError, self.registry.select,
+                          only=["metadata", "nope"])
+        self.assertRaises(UnknownTestError, self.registry.select,
+                          skip=["nope"])
+
+    def test_scheduler_adds_needed_resources_of_location(self):
+        scheduler = self.registry.scheduler(self.registry.select(), HOST)
+        self.assertEqual(sorted(scheduler.phases),
+                         ["inspection", "metadata", "report", "selinux"])
+        self.assertEqual(scheduler.phases["report"]["requires"],
+                         ["metadata"])
+        self.assertFalse(scheduler.phases["selinux"]["fatal"])
+
+    def test_scheduler_drops_needs_on_tests_not_selected(self):
+        scheduler = self.registry.scheduler(["report"], HOST)
+        self.assertEqual(sorted(scheduler.phases), ["report"])
+        self.assertEqual(scheduler.phases["report"]["requires"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()